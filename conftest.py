@@ -0,0 +1,29 @@
+# conftest.py
+import sys
+import pytest
+
+
+@pytest.fixture
+def fake_redis_server():
+    """One in-memory Redis; share it to give sync and async clients the same data."""
+    fakeredis = pytest.importorskip("fakeredis")
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def fake_redis(fake_redis_server, monkeypatch):
+    """
+    A FakeRedis client patched in for pipeline_utils.redis_client and for
+    every imported module that holds its own reference to it (services
+    import it by name), so status updates, streams and locks all land in
+    the same fake.
+    """
+    fakeredis = pytest.importorskip("fakeredis")
+    from pipeline_utils import pipeline_utils
+
+    client = fakeredis.FakeRedis(server=fake_redis_server, decode_responses=True)
+    real = pipeline_utils.redis_client
+    for module in list(sys.modules.values()):
+        if vars(module).get("redis_client") is real:
+            monkeypatch.setattr(module, "redis_client", client)
+    return client
@@ -1,11 +1,17 @@
 # metadata/metadata.py
 import os
+import re
 import json
 import logging
 import threading
 import traceback
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, jsonify
-from mutagen.mp3 import MP3
+from mutagen import MutagenError
+from mutagen.mp3 import MP3, BitrateMode
 from pipeline_utils.pipeline_utils import (
     redis_client,
     STREAM_QUEUED,
@@ -14,8 +20,11 @@ from pipeline_utils.pipeline_utils import (
     set_file_error,
     notify_all,
     clean_string,
-    handle_auto_retry,
+    PermanentError,
+    parse_job,
+    publish_job,
 )
+from pipeline_utils.stage_runner import StageRunner
 
 # ————— Logging setup —————
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -35,75 +44,219 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 # ————— Redis Stream / consumer config —————
 GROUP_NAME = os.environ.get("METADATA_GROUP", "metadata-group")
 CONSUMER_NAME = os.environ.get("METADATA_CONSUMER", "metadata-consumer")
+# messages per extract_batch call; probes are quick, so a batch fills the pool
+BATCH_SIZE = int(os.environ.get("METADATA_BATCH_SIZE", 32))
 
-# make sure the queue stream & group exist
-try:
-    redis_client.xgroup_create(STREAM_QUEUED, GROUP_NAME, id="0", mkstream=True)
-    logger.info(f"Created consumer group {GROUP_NAME} on {STREAM_QUEUED}")
-except Exception:
-    # group already exists
-    pass
+# ————— Probe pool & cache —————
+METADATA_WORKERS   = int(os.environ.get("METADATA_WORKERS", os.cpu_count() or 1))
+PROBE_CACHE_TTL    = int(os.environ.get("METADATA_CACHE_TTL", 7 * 24 * 3600))
+PROBE_CACHE_PREFIX = "metadata:probe:"
+
+# ————— Decode validation —————
+VALIDATE_AUDIO     = os.environ.get("VALIDATE_AUDIO", "true").lower() == "true"
+VALIDATE_SAMPLES   = int(os.environ.get("VALIDATE_SAMPLES", 3))
+VALIDATE_WINDOW_S  = float(os.environ.get("VALIDATE_WINDOW_S", 0.5))
+
+# ffmpeg messages that mean the bitstream itself is damaged
+CORRUPTION_RE = re.compile(
+    r"Header missing|Invalid data found|invalid new backstep|big_values too big"
+    r"|overread|invalid block type|Error while decoding|incomplete frame",
+    re.IGNORECASE,
+)
+
+def validate_decode(mp3_path, duration, samples=None, window=None, exact=True):
+    """
+    Decode `samples` short windows spread over the file (start, middle,
+    end, ...) with ffmpeg -xerror. Raises PermanentError when a window
+    fails on corrupt data or, if `duration` is `exact` (counted from a
+    Xing/VBRI header), decodes to nothing, which means the file was
+    truncated. Without such a header the duration is a guess from the
+    first frame's bitrate and may overshoot the real end, so empty
+    windows past the start prove nothing. Any other ffmpeg failure
+    (missing file, I/O error) raises RuntimeError and is retried.
+    """
+    samples = samples or VALIDATE_SAMPLES
+    window = window or VALIDATE_WINDOW_S
+    last = max(0.0, duration - window)
+    offsets = [last * i / max(1, samples - 1) for i in range(samples)]
+    for offset in offsets:
+        proc = subprocess.run(
+            ["ffmpeg", "-nostdin", "-v", "error", "-xerror", "-ss", f"{offset:.3f}", "-t", f"{window}",
+             "-i", mp3_path, "-f", "s16le", "-ac", "1", "pipe:1"],
+            capture_output=True,
+        )
+        errors = proc.stderr.decode(errors="replace").strip()
+        if proc.returncode != 0:
+            if CORRUPTION_RE.search(errors):
+                raise PermanentError(f"decode failed at {offset:.1f}s: {errors.splitlines()[0]}")
+            raise RuntimeError(f"ffmpeg exited {proc.returncode} at {offset:.1f}s: {errors}")
+        if errors:
+            logger.warning(f"ffmpeg warnings for {mp3_path} at {offset:.1f}s: {errors}")
+        if not proc.stdout and (exact or offset == 0):
+            raise PermanentError(f"no audio at {offset:.1f}s of {duration:.1f}s (truncated?)")
 
 def extract_metadata(mp3_path):
-    """Read ID3 tags via mutagen and return a dict."""
-    audio = MP3(mp3_path)
+    """Read ID3 tags and stream info via mutagen, validate decoding, and return a dict."""
+    try:
+        audio = MP3(mp3_path)
+    except MutagenError as e:
+        if isinstance(e.__cause__ or e.__context__, OSError):
+            raise  # the file could not be read, not a bad file: retry
+        raise PermanentError(f"not a readable MP3: {e}") from None
+    info = audio.info
+    if not info.length or not info.sample_rate:
+        raise PermanentError("MP3 has no audio frames")
+    # without a Xing/VBRI header the length is extrapolated from the first frame
+    exact = info.bitrate_mode != BitrateMode.UNKNOWN
+    if VALIDATE_AUDIO:
+        validate_decode(mp3_path, info.length, exact=exact)
     tags = audio.tags or {}
     return {
         "TIT2": clean_string(tags.get("TIT2", "Unknown Title")),
         "TPE1": clean_string(tags.get("TPE1", "Unknown Artist")),
         "TALB": clean_string(tags.get("TALB", "Unknown Album")),
         "TRCK": clean_string(tags.get("TRCK", "")),
+        "duration": round(info.length, 3),
+        "duration_exact": exact,
+        "sample_rate": info.sample_rate,
+        "channels": info.channels,
+        "bitrate": info.bitrate,
     }
 
-def run_extractor():
-    logger.info("Metadata service listening on Redis Stream...")
-    while True:
-        # block until new entry arrives
-        entries = redis_client.xreadgroup(
-            GROUP_NAME, CONSUMER_NAME,
-            { STREAM_QUEUED: ">" },
-            count=1, block=5000  # ms
-        )
-        if not entries:
+_probe_pool = None
+_probe_pool_lock = threading.Lock()
+
+def get_probe_pool():
+    """Process pool for mutagen parsing (pure Python, so threads would serialise on the GIL)."""
+    global _probe_pool
+    with _probe_pool_lock:
+        if _probe_pool is None:
+            _probe_pool = ProcessPoolExecutor(
+                max_workers=METADATA_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _probe_pool
+
+def reset_probe_pool(broken):
+    global _probe_pool
+    with _probe_pool_lock:
+        if _probe_pool is broken:
+            _probe_pool = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def probe_cache_key(st):
+    """Cache key for one on-disk version of a file: same inode, size and mtime ⇒ same tags."""
+    return f"{PROBE_CACHE_PREFIX}{st.st_dev}:{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+def probe_many(paths):
+    """
+    extract_metadata for many files: cached probes come from Redis in one
+    round trip, misses are parsed in parallel on the probe pool and cached.
+    Returns a list with a metadata dict or the raised exception per path.
+    """
+    results = [None] * len(paths)
+    keys = [None] * len(paths)
+    for i, path in enumerate(paths):
+        try:
+            keys[i] = probe_cache_key(os.stat(path))
+        except OSError as e:
+            results[i] = e
+    lookup = [i for i, key in enumerate(keys) if key]
+    try:
+        cached = redis_client.mget([keys[i] for i in lookup]) if lookup else []
+    except Exception as e:
+        logger.warning(f"Probe cache lookup failed: {e}")
+        cached = [None] * len(lookup)
+    misses = []
+    for i, hit in zip(lookup, cached):
+        if hit:
+            results[i] = json.loads(hit)
+        else:
+            misses.append(i)
+    if misses:
+        logger.info(f"Probe cache: {len(lookup) - len(misses)} hits, {len(misses)} misses")
+    serial = misses
+    if len(misses) > 1 and METADATA_WORKERS > 1:
+        pool = get_probe_pool()
+        serial = []
+        futures = {i: pool.submit(extract_metadata, paths[i]) for i in misses}
+        for i, fut in futures.items():
+            try:
+                results[i] = fut.result()
+            except BrokenProcessPool:
+                serial.append(i)
+            except Exception as e:
+                results[i] = e
+        if serial:
+            logger.warning("Probe pool died; parsing the rest of the batch in-process")
+            reset_probe_pool(pool)
+    for i in serial:
+        try:
+            results[i] = extract_metadata(paths[i])
+        except Exception as e:
+            results[i] = e
+    pipe = redis_client.pipeline(transaction=False)
+    for i in misses:
+        if isinstance(results[i], dict):
+            pipe.set(keys[i], json.dumps(results[i]), ex=PROBE_CACHE_TTL)
+    try:
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Probe cache store failed: {e}")
+    return results
+
+TAG_KEYS = ("TIT2", "TPE1", "TALB", "TRCK")
+
+def write_metadata(job, meta, pipe):
+    meta_path = job["paths"]["metadata"]
+    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    # carry what downstream stages need so they don't re-read the file
+    job["tags"] = {k: meta[k] for k in TAG_KEYS if k in meta}
+    # an estimated length would mislead the splitter's chunk sizing; leave it out
+    job["duration"] = meta.get("duration") if meta.get("duration_exact") else None
+    job["audio"] = {k: meta.get(k) for k in ("sample_rate", "channels", "bitrate")}
+    set_file_status(job["file"], "metadata_extracted", pipe=pipe)
+    # push downstream
+    publish_job(STREAM_METADATA_DONE, job, pipe=pipe)
+
+def extract_file(filename):
+    [error] = extract_batch([{"file": filename}])
+    if error is not None:
+        raise error
+
+def extract_batch(items):
+    """Batch handler: extract metadata for every message; returns None or an exception per item."""
+    jobs = [parse_job(data) for data in items]
+    metas = probe_many([job["paths"]["queue"] for job in jobs])
+    results = []
+    pipe = redis_client.pipeline(transaction=False)
+    for job, meta in zip(jobs, metas):
+        if isinstance(meta, Exception):
+            results.append(meta)
             continue
+        try:
+            write_metadata(job, meta, pipe)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    pipe.execute()
+    done = sum(r is None for r in results)
+    logger.info(f"Extracted metadata for {done}/{len(items)} files")
+    return results
 
-        for _stream, messages in entries:
-            for msg_id, data in messages:
-                filename = data.get("file")
-                mp3_path = os.path.join(
-                    os.environ.get("QUEUE_DIR", "/queue"),
-                    clean_string(filename)
-                )
-
-                def _do_extract():
-                    if not os.path.exists(mp3_path):
-                        raise FileNotFoundError(mp3_path)
-                    meta = extract_metadata(mp3_path)
-                    meta_path = os.path.join(
-                        os.environ.get("META_DIR", "/metadata"),
-                        os.path.splitext(filename)[0] + ".mp3.json"
-                    )
-                    os.makedirs(os.path.dirname(meta_path), exist_ok=True)
-                    with open(meta_path, "w", encoding="utf-8") as f:
-                        json.dump(meta, f)
-                    set_file_status(filename, "metadata_extracted")
-                    logger.info(f"Extracted metadata for {filename}")
-
-                try:
-                    # retry on failures
-                    handle_auto_retry(
-                        "metadata", filename, func=_do_extract,
-                        max_retries=int(os.environ.get("MAX_RETRIES", 3)),
-                        retry_delay=int(os.environ.get("RETRY_DELAY", 5)),
-                    )
-                    # push downstream
-                    redis_client.xadd(STREAM_METADATA_EXTRACTED, {"file": filename})
-                except Exception as e:
-                    # error already logged/notified by handle_auto_retry
-                    pass
-                finally:
-                    # ack whether success or permanently failed
-                    redis_client.xack(STREAM_QUEUED, GROUP_NAME, msg_id)
+def handle_message(data):
+    [error] = extract_batch([data])
+    if error is not None:
+        raise error
+
+def run_extractor():
+    StageRunner(
+        "metadata", STREAM_QUEUED, GROUP_NAME,
+        handler=handle_message, batch_handler=extract_batch,
+        batch_size=BATCH_SIZE, consumer_prefix=CONSUMER_NAME,
+    ).run()
 
 app = Flask(__name__)
 
@@ -0,0 +1,161 @@
+# metadata/tests/test_metadata.py
+import os
+import shutil
+import subprocess
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import MagicMock
+import pytest
+from mutagen import MutagenError
+from metadata import metadata
+from pipeline_utils.pipeline_utils import PermanentError
+
+needs_ffmpeg = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+
+
+def encode(path, *args, seconds=6):
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-f", "lavfi", "-i", f"sine=f=440:d={seconds}",
+         *args, "-y", str(path)],
+        check=True,
+    )
+    return path
+
+
+@pytest.fixture
+def clean_mp3(tmp_path):
+    return encode(tmp_path / "clean.mp3", "-b:a", "128k")
+
+
+@needs_ffmpeg
+def test_clean_file_passes(clean_mp3):
+    meta = metadata.extract_metadata(str(clean_mp3))
+    assert meta["duration"] == pytest.approx(6, abs=0.1)
+    assert meta["duration_exact"] is True
+    assert meta["TIT2"] == "Unknown Title"
+
+
+@needs_ffmpeg
+def test_truncated_file_is_permanent(clean_mp3, tmp_path):
+    data = clean_mp3.read_bytes()
+    cut = tmp_path / "cut.mp3"
+    cut.write_bytes(data[: len(data) // 2])  # header still counts every frame
+    with pytest.raises(PermanentError, match="truncated"):
+        metadata.extract_metadata(str(cut))
+
+
+@needs_ffmpeg
+def test_corrupt_frame_is_permanent(clean_mp3, tmp_path):
+    data = bytearray(clean_mp3.read_bytes())
+    start = len(data) // 2  # the middle window, at 2.75s of 6s
+    for i in range(start - 1500, start + 1500, 7):
+        data[i] = 0xFF if i % 2 else 0x00
+    bad = tmp_path / "bad.mp3"
+    bad.write_bytes(bytes(data))
+    with pytest.raises(PermanentError, match="decode failed"):
+        metadata.extract_metadata(str(bad))
+
+
+@needs_ffmpeg
+def test_guessed_duration_past_the_end_is_not_truncation(tmp_path):
+    # VBR without a Xing header: mutagen extrapolates the length from the
+    # first (silent, low-bitrate) frame and overshoots the real end
+    path = tmp_path / "vbr.mp3"
+    subprocess.run(
+        ["ffmpeg", "-nostdin", "-v", "error", "-f", "lavfi", "-i",
+         "anullsrc=d=3[a];sine=f=440:d=5[b];[a][b]concat=n=2:v=0:a=1",
+         "-ac", "2", "-q:a", "2", "-write_xing", "0", "-y", str(path)],
+        check=True,
+    )
+    meta = metadata.extract_metadata(str(path))
+    assert meta["duration"] > 8.5 and meta["duration_exact"] is False
+
+    # the guess stays out of the job envelope, so the splitter never plans with it
+    job = {"file": "vbr.mp3", "paths": {"metadata": str(tmp_path / "meta" / "vbr.json")}}
+    metadata.write_metadata(job, meta, pipe=MagicMock())
+    assert job["duration"] is None
+
+
+@needs_ffmpeg
+def test_ffmpeg_failure_that_is_not_corruption_is_retried(tmp_path):
+    with pytest.raises(RuntimeError, match="No such file"):
+        metadata.validate_decode(str(tmp_path / "gone.mp3"), 6.0)
+
+
+def test_unreadable_file_is_retried_and_junk_is_permanent(tmp_path):
+    with pytest.raises(MutagenError) as exc:
+        metadata.extract_metadata(str(tmp_path / "missing.mp3"))
+    assert not isinstance(exc.value, PermanentError)
+    junk = tmp_path / "junk.mp3"
+    junk.write_bytes(b"not audio" * 100)
+    with pytest.raises(PermanentError, match="not a readable MP3"):
+        metadata.extract_metadata(str(junk))
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    calls = []
+
+    def fake_extract(path):
+        calls.append(path)
+        return {"path": path}
+    monkeypatch.setattr(metadata, "extract_metadata", fake_extract)
+    return calls
+
+
+def test_probe_cache_hits_and_invalidation(fake_redis, probes, tmp_path):
+    a, b = tmp_path / "a.mp3", tmp_path / "b.mp3"
+    a.write_bytes(b"a" * 10)
+    b.write_bytes(b"b" * 10)
+    paths = [str(a), str(b)]
+    assert metadata.probe_many(paths) == [{"path": p} for p in paths]
+    assert probes == paths
+
+    assert metadata.probe_many(paths) == [{"path": p} for p in paths]
+    assert len(probes) == 2  # both served from Redis
+
+    st = a.stat()
+    a.write_bytes(b"a" * 10)  # same size, new mtime
+    os.utime(a, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    b.write_bytes(b"b" * 11)  # new size
+    metadata.probe_many(paths)
+    assert probes[2:] == paths
+    assert len(fake_redis.keys(f"{metadata.PROBE_CACHE_PREFIX}*")) == 4
+
+
+def test_probe_errors_are_returned_and_not_cached(fake_redis, monkeypatch, tmp_path):
+    bad = tmp_path / "bad.mp3"
+    bad.write_bytes(b"x")
+
+    def fail(path):
+        raise PermanentError("not a readable MP3")
+    monkeypatch.setattr(metadata, "extract_metadata", fail)
+    missing, broken = metadata.probe_many([str(tmp_path / "missing.mp3"), str(bad)])
+    assert isinstance(missing, FileNotFoundError)
+    assert isinstance(broken, PermanentError)
+    assert fake_redis.keys("*") == []
+
+
+def test_broken_probe_pool_falls_back_to_in_process(fake_redis, probes, monkeypatch, tmp_path):
+    class DeadPool:
+        shut = False
+
+        def submit(self, fn, *args):
+            fut = Future()
+            fut.set_exception(BrokenProcessPool("worker died"))
+            return fut
+
+        def shutdown(self, wait=True, cancel_futures=False):
+            self.shut = True
+
+    pool = DeadPool()
+    monkeypatch.setattr(metadata, "METADATA_WORKERS", 4)
+    monkeypatch.setattr(metadata, "_probe_pool", pool)
+    paths = []
+    for name in ("a", "b", "c"):
+        (tmp_path / f"{name}.mp3").write_bytes(name.encode())
+        paths.append(str(tmp_path / f"{name}.mp3"))
+
+    assert metadata.probe_many(paths) == [{"path": p} for p in paths]
+    assert probes == paths  # every file parsed in-process after the pool broke
+    assert pool.shut and metadata._probe_pool is None
@@ -1,6 +1,7 @@
 # organizer/organizer.py
 
 import os
+import json
 import shutil
 import logging
 import threading
@@ -8,15 +9,17 @@ import traceback
 import datetime
 from flask import Flask, jsonify
 from pipeline_utils.pipeline_utils import (
-    redis_client,
     STREAM_PACKAGED,
     STREAM_ORGANIZED,
     set_file_status,
     set_file_error,
     notify_all,
     clean_string,
-    handle_auto_retry,
+    resolve_duplicates,
+    parse_job,
+    publish_job,
 )
+from pipeline_utils.stage_runner import StageRunner
 
 # ————— Logging setup —————
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -38,72 +41,49 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 # ————— Stream / consumer config —————
 GROUP_NAME    = os.environ.get("ORGANIZER_GROUP",    "organizer-group")
 CONSUMER_NAME = os.environ.get("ORGANIZER_CONSUMER", "organizer-consumer")
-# Ensure the consumer group exists
-try:
-    redis_client.xgroup_create(
-        STREAM_PACKAGED, GROUP_NAME, id="0", mkstream=True
-    )
-    logger.info(f"Created consumer group {GROUP_NAME} on {STREAM_PACKAGED}")
-except Exception:
-    pass  # already exists
 
 # ————— Env & retry settings —————
 OUTPUT_DIR  = os.environ.get("OUTPUT_DIR",  "/output")
 ORG_DIR     = os.environ.get("ORG_DIR",     "/organized")
-MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
-RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 10))
 
-# ————— Organizing logic —————
-def organize_file(filename):
-    # move or copy the packaged file into organized directory
-    src = os.path.join(OUTPUT_DIR, clean_string(filename))
-    if not os.path.exists(src):
-        raise FileNotFoundError(f"Packaged file not found: {src}")
+# ————— Stream consumer —————
+def organize_job(job):
+    """
+    Organize every output the packager recorded in the job (all variants);
+    jobs without outputs fall back to OUTPUT_DIR/<file>.
+    """
+    outputs = job["paths"].get("outputs") or [os.path.join(OUTPUT_DIR, clean_string(job["file"]))]
+    organized = []
+    for src in outputs:
+        name = os.path.basename(src)
+        if not os.path.exists(src):
+            raise FileNotFoundError(f"Packaged file not found: {src}")
+        os.makedirs(ORG_DIR, exist_ok=True)
+        dest = os.path.join(ORG_DIR, name)
+        shutil.copy2(src, dest)
+        logger.info(f"Organized {name} → {dest}")
+        organized.append(dest)
+    job["paths"]["organized"] = organized
+    return organized
 
-    os.makedirs(ORG_DIR, exist_ok=True)
-    dest = os.path.join(ORG_DIR, clean_string(filename))
-    shutil.copy2(src, dest)
-    logger.info(f"Organized {filename} → {dest}")
+def handle_message(data):
+    job = parse_job(data)
+    filename = job["file"]
+    organized = organize_job(job)
+    # status before duplicates: a duplicate the watcher registers after this
+    # sees "organized" and links itself; publish last so a retry of any
+    # earlier step cannot announce the file twice
+    set_file_status(filename, "organized", extra={"organized": json.dumps(organized)})
+    resolve_duplicates(filename, organized)
+    publish_job(STREAM_ORGANIZED, job)
+    logger.info(f"Published organized: {filename}")
     return True
 
-# ————— Stream consumer loop —————
 def run_organizer():
-    logger.info("Organizer listening on Redis Stream...")
-    while True:
-        entries = redis_client.xreadgroup(
-            GROUP_NAME, CONSUMER_NAME,
-            {STREAM_PACKAGED: ">"},
-            count=1, block=5000
-        )
-        if not entries:
-            continue
-
-        for _stream, messages in entries:
-            for msg_id, data in messages:
-                filename = data.get("file")
-
-                def _do_organize():
-                    result = organize_file(filename)
-                    if result is True:
-                        set_file_status(filename, "organized")
-                        redis_client.xadd(STREAM_ORGANIZED, {"file": filename})
-                        logger.info(f"Published organized: {filename}")
-                        return True
-                    raise Exception(result)
-
-                try:
-                    handle_auto_retry(
-                        "organizer", filename,
-                        func=_do_organize,
-                        max_retries=MAX_RETRIES,
-                        retry_delay=RETRY_DELAY,
-                    )
-                except Exception:
-                    # final failure already logged / notified
-                    pass
-                finally:
-                    # ack the message to avoid reprocessing
-                    redis_client.xack(STREAM_PACKAGED, GROUP_NAME, msg_id)
+    StageRunner(
+        "organizer", STREAM_PACKAGED, GROUP_NAME,
+        handler=handle_message, consumer_prefix=CONSUMER_NAME,
+    ).run()
 
 # ————— Flask health endpoint —————
 app = Flask(__name__)
@@ -1,5 +1,8 @@
 # organizer/tests/test_organizer.py
-from organizer.organizer import is_valid_karaoke_mp3, app
+import pytest
+from pipeline_utils import pipeline_utils
+from organizer import organizer
+from organizer.organizer import app
 
 
 def test_healthcheck():
@@ -8,26 +11,24 @@ def test_healthcheck():
         assert resp.status_code == 200
 
 
-def test_is_valid_karaoke_mp3():
-    assert is_valid_karaoke_mp3("foo_karaoke.mp3")
-    assert not is_valid_karaoke_mp3("foo.mp3")
-
-
-def test_organize_file_creates_structure(tmp_path, monkeypatch):
-    # Setup dummy mp3 file and metadata json
+def test_organize_job_copies_every_output(tmp_path, monkeypatch):
     output = tmp_path / "output"
     output.mkdir()
     org = tmp_path / "organized"
-    meta_dir = tmp_path / "meta"
-    meta_dir.mkdir()
-    mp3 = output / "file_karaoke.mp3"
-    mp3.write_bytes(b"ID3" + b"\0" * 1000)
-    meta = meta_dir / "file.mp3.json"
-    meta.write_text('{"TPE1":"Art","TALB":"Alb","TIT2":"Title"}')
-    monkeypatch.setattr("organizer.organizer.ORG_DIR", str(org))
-    monkeypatch.setattr("organizer.organizer.META_DIR", str(meta_dir))
-    from organizer.organizer import organize_file
+    monkeypatch.setattr(organizer, "ORG_DIR", str(org))
+    outputs = []
+    for name in ("file.mp3", "file_backing.mp3", "file_master.flac"):
+        (output / name).write_bytes(name.encode())
+        outputs.append(str(output / name))
+    job = pipeline_utils.make_job("file.mp3")
+    job["paths"]["outputs"] = outputs
+
+    organized = organizer.organize_job(job)
+    assert organized == [str(org / "file.mp3"), str(org / "file_backing.mp3"), str(org / "file_master.flac")]
+    assert job["paths"]["organized"] == organized
+    assert [(org / n).read_bytes() for n in ("file.mp3", "file_backing.mp3")] == [b"file.mp3", b"file_backing.mp3"]
 
-    organize_file(str(mp3), "file.mp3")
-    dest = org / "Art" / "Alb" / "file_karaoke.mp3"
-    assert dest.exists()
+    # a missing variant fails the job instead of organizing a partial set
+    job["paths"]["outputs"].append(str(output / "file_instrumental.mp3"))
+    with pytest.raises(FileNotFoundError, match="file_instrumental"):
+        organizer.organize_job(job)
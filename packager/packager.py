@@ -5,21 +5,26 @@ import logging
 import json
 import time
 import threading
+import tempfile
 import traceback
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, jsonify
 from pydub import AudioSegment
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
 from pipeline_utils.pipeline_utils import (
-    redis_client,
     STREAM_SPLIT_DONE,
     STREAM_PACKAGED,
     set_file_status,
     set_file_error,
     notify_all,
     clean_string,
-    handle_auto_retry,
+    make_job,
+    parse_job,
+    publish_job,
+    job_param,
 )
+from pipeline_utils.stage_runner import StageRunner
 
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
 LEVELS = {
@@ -38,22 +43,57 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 GROUP_NAME = os.environ.get("PACKAGER_GROUP", "packager-group")
 CONSUMER_NAME = os.environ.get("PACKAGER_CONSUMER", "packager-consumer")
 
-try:
-    redis_client.xgroup_create(
-        STREAM_SPLIT_DONE, GROUP_NAME, id="0", mkstream=True
-    )
-    logger.info(f"Created consumer group {GROUP_NAME} on {STREAM_SPLIT_DONE}")
-except Exception:
-    pass
-
 STEMS_DIR = os.environ.get("STEMS_DIR", "/stems")
 META_DIR = os.environ.get("META_DIR", "/metadata")
 OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "/output")
 STEM_TYPE = [
     s.strip().lower() for s in os.environ.get("STEM_TYPE", "vocals,accompaniment").split(",") if s.strip()
 ]
-MAX_RETRIES = int(os.environ.get("MAX_RETRIES", 3))
-RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 10))
+MIX_BLOCK_FRAMES = int(os.environ.get("MIX_BLOCK_FRAMES", 262144))
+MIX_CLIP_MODE = os.environ.get("MIX_CLIP_MODE", "normalize").lower()  # normalize | clip
+OUTPUT_BITRATE = os.environ.get("OUTPUT_BITRATE", "")  # empty: encoder default
+
+def parse_gains(spec):
+    """Parse "vocals:-12,drums:0" into {stem: gain_db}."""
+    gains = {}
+    for part in (spec or "").split(","):
+        if ":" in part:
+            stem, db = part.split(":", 1)
+            gains[stem.strip().lower()] = float(db)
+    return gains
+
+STEM_GAINS = parse_gains(os.environ.get("STEM_GAINS", ""))
+
+def load_variants(spec, default_stems=None):
+    """
+    Parse PACKAGER_VARIANTS, a JSON list of output variants such as
+    [{"suffix": "", "format": "mp3", "bitrate": "320k"},
+     {"suffix": "_backing", "stems": ["vocals", "accompaniment"], "gains": {"vocals": -12}},
+     {"suffix": "_master", "format": "flac"}].
+    Missing fields fall back to `default_stems` (STEM_TYPE) / STEM_GAINS /
+    mp3 / OUTPUT_BITRATE. The first variant should keep suffix "" and
+    format mp3: that file is the one the organizer picks up. `spec` may
+    also be an already parsed list (a job's "variants" param).
+    """
+    default_stems = default_stems or STEM_TYPE
+    if isinstance(spec, list):
+        variants = spec or [{}]
+    else:
+        variants = json.loads(spec) if spec else [{}]
+    out = []
+    for i, v in enumerate(variants):
+        fmt = v.get("format", "mp3").lower()
+        out.append({
+            "name": v.get("name") or f"variant{i}",
+            "suffix": v.get("suffix", ""),
+            "stems": [st.lower() for st in v.get("stems", default_stems)],
+            "gains": {k.lower(): float(db) for k, db in v.get("gains", STEM_GAINS).items()},
+            "format": fmt,
+            "bitrate": v.get("bitrate", OUTPUT_BITRATE if fmt == "mp3" else None),
+        })
+    return out
+
+VARIANTS = load_variants(os.environ.get("PACKAGER_VARIANTS", ""))
 
 def robust_load_metadata(meta_path):
     try:
@@ -62,74 +102,251 @@ def robust_load_metadata(meta_path):
     except Exception:
         return {}
 
-def mix_selected_stems(stems_folder, stems_to_mix):
-    final = None
-    for stem in stems_to_mix:
-        for ext in ["wav", "mp3", "flac"]:
-            stem_file = os.path.join(stems_folder, f"{stem}.{ext}")
-            if os.path.exists(stem_file):
-                seg = AudioSegment.from_file(stem_file)
-                final = seg if final is None else final.overlay(seg)
-                break
-    if final is None:
-        raise RuntimeError("No stems found to mix.")
-    return final
-
-def apply_metadata(mp3_path, metadata):
-    try:
-        audio = MP3(mp3_path, ID3=EasyID3)
-        field_map = {"TIT2": "title", "TPE1": "artist", "TALB": "album", "TRCK": "tracknumber"}
-        for k, v in field_map.items():
-            if k in metadata:
-                audio[v] = str(metadata[k])
-        audio.save()
-    except Exception as e:
-        logging.warning(f"Metadata tagging failed: {e}")
-
-def process_packaging(song_name):
-    stems_path = os.path.join(STEMS_DIR, clean_string(song_name))
-    meta_path = os.path.join(META_DIR, f"{song_name}.mp3.json")
-    output_mp3 = os.path.join(OUTPUT_DIR, f"{song_name}.mp3")
+# ————— Vectorized stem mixing —————
+WAV_DTYPES = {(1, 16): ("<i2", 1 / 32768.0), (1, 32): ("<i4", 1 / 2147483648.0), (3, 32): ("<f4", 1.0)}
+
+def wav_layout(path):
+    """
+    Parse a RIFF/WAVE header. Returns (format_tag, channels, sample_rate,
+    bits, data_offset, data_size) or None if the file isn't a plain WAV.
+    """
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return None
+            cid, size = header[:4], int.from_bytes(header[4:], "little")
+            if cid == b"fmt ":
+                body = f.read(size)
+                tag = int.from_bytes(body[0:2], "little")
+                if tag == 0xFFFE and size >= 26:  # WAVE_FORMAT_EXTENSIBLE
+                    tag = int.from_bytes(body[24:26], "little")
+                fmt = (tag, int.from_bytes(body[2:4], "little"),
+                       int.from_bytes(body[4:8], "little"), int.from_bytes(body[14:16], "little"))
+            elif cid == b"data":
+                if fmt is None:
+                    return None
+                offset = f.tell()
+                return fmt + (offset, min(size, os.fstat(f.fileno()).st_size - offset))
+            else:
+                f.seek(size + (size & 1), 1)
+
+def load_stem(path, sample_rate=None, channels=None):
+    """
+    Return (samples, scale, sample_rate) for a stem file. PCM/float WAVs
+    are memory‑mapped; anything else is decoded once through pydub.
+    Multiply samples by scale to get float32 in [-1, 1].
+    """
+    layout = wav_layout(path) if path.endswith(".wav") else None
+    if layout:
+        tag, ch, rate, bits, offset, size = layout
+        dtype = WAV_DTYPES.get((tag, bits))
+        frames = size // (ch * bits // 8)
+        if dtype and frames and sample_rate in (None, rate):
+            samples = np.memmap(path, dtype=dtype[0], mode="r", offset=offset, shape=(frames, ch))
+            return samples, dtype[1], rate
+    seg = AudioSegment.from_file(path)
+    if sample_rate:
+        seg = seg.set_frame_rate(sample_rate)
+    if channels:
+        seg = seg.set_channels(channels)
+    samples = np.array(seg.get_array_of_samples()).reshape(-1, seg.channels)
+    return samples, 1.0 / (1 << (8 * seg.sample_width - 1)), seg.frame_rate
+
+class StemMixer:
+    """
+    Sums stems as float32 blocks with per‑stem gain (dB) and clipping
+    protection. Stems are opened once; every call to blocks() or mix()
+    reuses them, so several mixes of the same song share one decode.
+    """
+
+    def __init__(self, stems_folder, stems_to_mix):
+        self.sources = {}
+        self.sample_rate = None
+        self.channels = 0
+        for stem in stems_to_mix:
+            for ext in ["wav", "mp3", "flac"]:
+                stem_file = os.path.join(stems_folder, f"{stem}.{ext}")
+                if os.path.exists(stem_file):
+                    samples, scale, rate = load_stem(stem_file, self.sample_rate)
+                    self.sample_rate = self.sample_rate or rate
+                    self.sources[stem] = (samples, scale)
+                    self.channels = max(self.channels, samples.shape[1])
+                    break
+        if not self.sources:
+            raise RuntimeError("No stems found to mix.")
+        self.frames = max(samples.shape[0] for samples, _ in self.sources.values())
+
+    def _weights(self, gains, stems=None):
+        gains = STEM_GAINS if gains is None else gains
+        return {
+            stem: np.float32(scale * 10 ** (gains.get(stem, 0.0) / 20.0))
+            for stem, (_, scale) in self.sources.items()
+            if stems is None or stem in stems
+        }
+
+    def _raw_blocks(self, weights, block_frames):
+        for start in range(0, self.frames, block_frames):
+            n = min(block_frames, self.frames - start)
+            out = np.zeros((n, self.channels), dtype=np.float32)
+            for stem, weight in weights.items():
+                part = self.sources[stem][0][start:start + n]
+                if len(part):
+                    out[:len(part)] += part * weight
+            yield out
+
+    def peak(self, gains=None, block_frames=None, stems=None):
+        weights = self._weights(gains, stems)
+        return max(
+            (float(np.abs(b).max()) for b in self._raw_blocks(weights, block_frames or MIX_BLOCK_FRAMES)),
+            default=0.0,
+        )
+
+    def blocks(self, gains=None, block_frames=None, stems=None):
+        """Yield the mix of `stems` (default: all) as float32 (frames, channels) blocks in [-1, 1]."""
+        block_frames = block_frames or MIX_BLOCK_FRAMES
+        weights = self._weights(gains, stems)
+        norm = np.float32(1.0)
+        if MIX_CLIP_MODE == "normalize":
+            peak = self.peak(gains, block_frames, stems)
+            if peak > 1.0:
+                norm = np.float32(1.0 / peak)
+        for out in self._raw_blocks(weights, block_frames):
+            if norm != 1.0:
+                out *= norm
+            np.clip(out, -1.0, 1.0, out=out)
+            yield out
+
+    def mix(self, gains=None, stems=None):
+        """Return the whole mix as one float32 (frames, channels) array in [-1, 1]."""
+        out = np.empty((self.frames, self.channels), dtype=np.float32)
+        pos = 0
+        for block in self._raw_blocks(self._weights(gains, stems), MIX_BLOCK_FRAMES):
+            out[pos:pos + len(block)] = block
+            pos += len(block)
+        if MIX_CLIP_MODE == "normalize":
+            peak = float(np.abs(out).max()) if len(out) else 0.0
+            if peak > 1.0:
+                out *= np.float32(1.0 / peak)
+        np.clip(out, -1.0, 1.0, out=out)
+        return out
+
+def mix_selected_stems(stems_folder, stems_to_mix, gains=None):
+    mixer = StemMixer(stems_folder, stems_to_mix)
+    pcm = (mixer.mix(gains) * 32767.0).astype("<i2")
+    return AudioSegment(
+        data=pcm.tobytes(), sample_width=2,
+        frame_rate=mixer.sample_rate, channels=mixer.channels,
+    )
+
+# ————— Streaming encode —————
+TAG_FIELDS = {"TIT2": "title", "TPE1": "artist", "TALB": "album", "TRCK": "track"}
+CODECS = {"mp3": "libmp3lame", "flac": "flac", "wav": "pcm_s16le"}
+
+def encoder_command(output_path, sample_rate, channels, fmt="mp3", bitrate=None, metadata=None):
+    """ffmpeg command that reads float32 PCM on stdin and writes a tagged file."""
+    cmd = [
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "f32le", "-ar", str(sample_rate), "-ac", str(channels), "-i", "pipe:0",
+        "-codec:a", CODECS.get(fmt, fmt),
+    ]
+    if bitrate and fmt == "mp3":
+        cmd += ["-b:a", bitrate]
+    if fmt == "mp3":
+        cmd += ["-id3v2_version", "3"]
+    for frame, key in TAG_FIELDS.items():
+        if (metadata or {}).get(frame):
+            cmd += ["-metadata", f"{key}={metadata[frame]}"]
+    return cmd + ["-f", fmt, output_path]
+
+def encode_stream(blocks, sample_rate, channels, output_path, fmt="mp3", bitrate=None, metadata=None):
+    """
+    Pipe float32 PCM blocks into one ffmpeg process that encodes and tags
+    in a single pass. Output goes to a temp name and is renamed into place.
+    """
+    tmp_path = f"{output_path}.part"
+    with tempfile.TemporaryFile() as err:
+        proc = subprocess.Popen(
+            encoder_command(tmp_path, sample_rate, channels, fmt, bitrate, metadata),
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=err,
+        )
+        try:
+            for block in blocks:
+                proc.stdin.write(np.ascontiguousarray(block, dtype="<f4").tobytes())
+        except BrokenPipeError:
+            pass  # ffmpeg exited early; its stderr says why
+        except Exception:
+            proc.kill()
+            raise
+        finally:
+            proc.stdin.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            err.seek(0)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise RuntimeError(f"ffmpeg encode error: {err.read().decode(errors='replace').strip()}")
+    os.replace(tmp_path, output_path)
+    return output_path
+
+def process_packaging(song_name, variants=None, meta=None, stems_path=None):
+    """
+    Decode the song's stems once and encode every output variant from them
+    concurrently. Returns the output paths in variant order. Tags come from
+    `meta` when the job carries them, else from the metadata JSON.
+    """
+    variants = variants or VARIANTS
+    stems_path = stems_path or os.path.join(STEMS_DIR, clean_string(song_name))
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    meta = robust_load_metadata(meta_path)
-    audio = mix_selected_stems(stems_path, STEM_TYPE)
-    audio.export(output_mp3, format="mp3")
-    apply_metadata(output_mp3, meta)
-    return output_mp3
+    if meta is None:
+        meta = robust_load_metadata(os.path.join(META_DIR, f"{song_name}.mp3.json"))
+    mixer = StemMixer(stems_path, sorted({st for v in variants for st in v["stems"]}))
 
-def run_packager():
-    logger.info("Packager listening on Redis Stream...")
-    while True:
-        entries = redis_client.xreadgroup(
-            GROUP_NAME, CONSUMER_NAME,
-            {STREAM_SPLIT_DONE: ">"},
-            count=1, block=5000
+    def _encode(variant):
+        output = os.path.join(OUTPUT_DIR, f"{song_name}{variant['suffix']}.{variant['format']}")
+        encode_stream(
+            mixer.blocks(variant["gains"], stems=variant["stems"]),
+            mixer.sample_rate, mixer.channels, output,
+            fmt=variant["format"], bitrate=variant["bitrate"], metadata=meta,
         )
-        if not entries:
-            continue
-
-        for _stream, messages in entries:
-            for msg_id, data in messages:
-                filename = data.get("file")
-                song = os.path.splitext(filename)[0]
-
-                def _do_package():
-                    path = process_packaging(song)
-                    set_file_status(filename, "packaged")
-                    redis_client.xadd(STREAM_PACKAGED, {"file": filename})
-                    logger.info(f"Packaged and published: {filename}")
-                    return True
-
-                try:
-                    handle_auto_retry(
-                        "packager", filename, func=_do_package,
-                        max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY,
-                    )
-                except Exception:
-                    # Already logged
-                    pass
-                finally:
-                    redis_client.xack(STREAM_SPLIT_DONE, GROUP_NAME, msg_id)
+        logger.info(f"Encoded {variant['name']} → {output}")
+        return output
+
+    with ThreadPoolExecutor(max_workers=len(variants)) as pool:
+        return list(pool.map(_encode, variants))
+
+def job_variants(job):
+    """The job's own variants / stem selection, or the env defaults."""
+    variants = job_param(job, "variants")
+    stem_types = job_param(job, "stem_types")
+    if variants is None and stem_types is None:
+        return VARIANTS
+    return load_variants(variants or os.environ.get("PACKAGER_VARIANTS", ""), stem_types)
+
+def package_file(filename, job=None):
+    job = job or make_job(filename)
+    outputs = process_packaging(
+        job["song"], job_variants(job), meta=job.get("tags"), stems_path=job["paths"]["stems"],
+    )
+    job["paths"]["outputs"] = outputs
+    set_file_status(filename, "packaged")
+    publish_job(STREAM_PACKAGED, job)
+    logger.info(f"Packaged and published: {filename}")
+    return True
+
+def handle_message(data):
+    job = parse_job(data)
+    package_file(job["file"], job)
+
+def run_packager():
+    StageRunner(
+        "packager", STREAM_SPLIT_DONE, GROUP_NAME,
+        handler=handle_message, consumer_prefix=CONSUMER_NAME,
+    ).run()
 
 app = Flask(__name__)
 
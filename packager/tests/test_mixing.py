@@ -0,0 +1,114 @@
+# packager/tests/test_mixing.py
+import os
+import wave
+import shutil
+import numpy as np
+import pytest
+from packager.packager import StemMixer, parse_gains, wav_layout
+
+
+def write_wav(path, pcm, rate=44100):
+    with wave.open(str(path), "wb") as w:
+        w.setnchannels(pcm.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.astype("<i2").tobytes())
+
+
+def test_parse_gains():
+    assert parse_gains("vocals:-12, drums:3") == {"vocals": -12.0, "drums": 3.0}
+    assert parse_gains("") == {}
+
+
+def test_stem_mixer_sums_with_gain_and_memmaps_wav(tmp_path):
+    write_wav(tmp_path / "vocals.wav", np.full((100, 2), 8192))
+    write_wav(tmp_path / "drums.wav", np.full((50, 1), 8192))
+    assert wav_layout(str(tmp_path / "vocals.wav"))[:4] == (1, 2, 44100, 16)
+
+    mixer = StemMixer(str(tmp_path), ["vocals", "drums", "missing"])
+    assert isinstance(mixer.sources["vocals"][0], np.memmap)
+    assert (mixer.frames, mixer.channels, mixer.sample_rate) == (100, 2, 44100)
+
+    out = mixer.mix({"vocals": 0.0, "drums": -6.0})
+    assert out.dtype == np.float32 and out.shape == (100, 2)
+    assert out[0, 1] == pytest.approx(0.25 + 0.25 * 10 ** (-6 / 20), rel=1e-4)
+    assert out[80, 0] == pytest.approx(0.25, rel=1e-4)
+
+
+def test_stem_mixer_clipping_protection(tmp_path, monkeypatch):
+    from packager import packager
+
+    write_wav(tmp_path / "a.wav", np.full((10, 2), 30000))
+    write_wav(tmp_path / "b.wav", np.full((10, 2), 30000))
+    mixer = StemMixer(str(tmp_path), ["a", "b"])
+    assert np.abs(mixer.mix({})).max() == pytest.approx(1.0)
+    monkeypatch.setattr(packager, "MIX_CLIP_MODE", "clip")
+    blocks = list(mixer.blocks({}, block_frames=4))
+    assert [len(b) for b in blocks] == [4, 4, 2]
+    assert all(np.abs(b).max() <= 1.0 for b in blocks)
+
+
+def test_stem_mixer_no_stems(tmp_path):
+    with pytest.raises(RuntimeError):
+        StemMixer(str(tmp_path), ["vocals"])
+
+
+def test_encoder_command_embeds_tags():
+    from packager.packager import encoder_command
+
+    cmd = encoder_command("/out/a.mp3.part", 44100, 2, "mp3", "320k", {"TIT2": "Song", "TPE1": "Band"})
+    assert cmd[cmd.index("-i") + 1] == "pipe:0"
+    assert "title=Song" in cmd and "artist=Band" in cmd
+    assert cmd[cmd.index("-b:a") + 1] == "320k"
+    assert cmd[-3:] == ["-f", "mp3", "/out/a.mp3.part"]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+def test_encode_stream_writes_tagged_mp3(tmp_path):
+    from mutagen.easyid3 import EasyID3
+    from packager.packager import encode_stream
+
+    blocks = (np.zeros((44100, 2), dtype=np.float32) for _ in range(2))
+    out = tmp_path / "song.mp3"
+    encode_stream(blocks, 44100, 2, str(out), metadata={"TIT2": "Song", "TALB": "Album"})
+    assert out.exists() and not (tmp_path / "song.mp3.part").exists()
+    tags = EasyID3(str(out))
+    assert tags["title"] == ["Song"] and tags["album"] == ["Album"]
+
+
+def test_load_variants_defaults_and_overrides(monkeypatch):
+    from packager import packager
+
+    monkeypatch.setattr(packager, "STEM_TYPE", ["accompaniment"])
+    default = packager.load_variants("")
+    assert default[0]["suffix"] == "" and default[0]["format"] == "mp3"
+    assert default[0]["stems"] == ["accompaniment"]
+
+    variants = packager.load_variants(
+        '[{"bitrate": "320k"}, {"suffix": "_backing", "stems": ["vocals", "accompaniment"],'
+        ' "gains": {"vocals": -12}}, {"suffix": "_master", "format": "FLAC"}]'
+    )
+    assert [v["format"] for v in variants] == ["mp3", "mp3", "flac"]
+    assert variants[1]["gains"] == {"vocals": -12.0}
+    assert variants[2]["bitrate"] is None
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+def test_process_packaging_fans_out_variants(tmp_path, monkeypatch):
+    from packager import packager
+
+    stems = tmp_path / "stems" / "song"
+    stems.mkdir(parents=True)
+    write_wav(stems / "vocals.wav", np.full((44100, 2), 4000))
+    write_wav(stems / "accompaniment.wav", np.full((44100, 2), 4000))
+    monkeypatch.setattr(packager, "STEMS_DIR", str(tmp_path / "stems"))
+    monkeypatch.setattr(packager, "META_DIR", str(tmp_path / "meta"))
+    monkeypatch.setattr(packager, "OUTPUT_DIR", str(tmp_path / "out"))
+    variants = packager.load_variants(
+        '[{"stems": ["accompaniment"], "bitrate": "128k"},'
+        ' {"suffix": "_backing", "stems": ["vocals", "accompaniment"], "gains": {"vocals": -12}},'
+        ' {"suffix": "_master", "stems": ["accompaniment"], "format": "flac"}]'
+    )
+    outputs = packager.process_packaging("song", variants)
+    assert [os.path.basename(p) for p in outputs] == ["song.mp3", "song_backing.mp3", "song_master.flac"]
+    assert all(os.path.getsize(p) > 0 for p in outputs)
@@ -0,0 +1,61 @@
+"""
+One-shot migration: build the status index sets from existing file:* hashes.
+
+    python -m pipeline_utils.migrate_status_index [--rebuild] [--batch 1000]
+
+Walks the keyspace with SCAN (never KEYS) and writes the index with
+pipelined ZADDs, so it is safe to run against a live Redis. Hashes that
+predate the index have no updated_at field and are scored 0, which
+sorts them as the oldest entries.
+"""
+
+import argparse
+from pipeline_utils.pipeline_utils import (
+    redis_client,
+    logger,
+    STATUS_INDEX_PREFIX,
+    FILES_BY_UPDATE,
+)
+
+def migrate_status_index(rebuild=False, batch=1000):
+    if rebuild:
+        stale = list(redis_client.scan_iter(f"{STATUS_INDEX_PREFIX}*", count=batch))
+        if stale:
+            redis_client.delete(*stale)
+        redis_client.delete(FILES_BY_UPDATE)
+
+    indexed = 0
+    keys = []
+
+    def _flush():
+        nonlocal indexed
+        read = redis_client.pipeline(transaction=False)
+        for key in keys:
+            read.hmget(key, "status", "updated_at")
+        write = redis_client.pipeline(transaction=False)
+        for key, (status, updated_at) in zip(keys, read.execute()):
+            if not status:
+                continue
+            filename = key[len("file:"):]
+            score = float(updated_at or 0)
+            write.zadd(f"{STATUS_INDEX_PREFIX}{status}", {filename: score})
+            write.zadd(FILES_BY_UPDATE, {filename: score})
+            indexed += 1
+        write.execute()
+        keys.clear()
+
+    for key in redis_client.scan_iter("file:*", count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            _flush()
+    if keys:
+        _flush()
+    logger.info(f"Status index built for {indexed} files")
+    return indexed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the Redis status index from file:* hashes.")
+    parser.add_argument("--rebuild", action="store_true", help="drop existing index sets first")
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+    migrate_status_index(rebuild=args.rebuild, batch=args.batch)
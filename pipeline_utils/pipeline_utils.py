@@ -7,8 +7,10 @@ Added Redis Streams topics & helpers for event-driven pipelines:
   - STREAM_SPLIT_DONE
   - STREAM_PACKAGED
   - STREAM_ORGANIZED
+  - STREAM_DEAD_LETTER (jobs that can no longer be retried)
 
-Publish with `publish_*`, consume with `consume`.
+Publish with `publish_*`, consume with `consume`. Stage-to-stage messages
+carry a versioned job envelope (`make_job` / `publish_job` / `parse_job`).
 """
 
 import os
@@ -20,6 +22,15 @@ from email.message import EmailMessage
 import traceback
 import datetime
 import time
+import shutil
+import hashlib
+import fcntl
+import json
+import random
+import uuid
+import queue
+import atexit
+import threading
 
 # -------- LOGGING SETUP --------
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -46,8 +57,14 @@ SMTP_SERVER         = os.environ.get("SMTP_SERVER")
 SMTP_PORT           = int(os.environ.get("SMTP_PORT", 587))
 SMTP_USERNAME       = os.environ.get("SMTP_USERNAME")
 SMTP_PASSWORD       = os.environ.get("SMTP_PASSWORD")
+NOTIFY_ASYNC        = os.environ.get("NOTIFY_ASYNC", "true").lower() == "true"
+NOTIFY_QUEUE_SIZE   = int(os.environ.get("NOTIFY_QUEUE_SIZE", 1000))
+NOTIFY_WINDOW       = int(os.environ.get("NOTIFY_WINDOW", 60))
+NOTIFY_BURST        = int(os.environ.get("NOTIFY_BURST", 3))
 REDIS_HOST          = os.environ.get("REDIS_HOST", "redis")
 REDIS_PORT          = int(os.environ.get("REDIS_PORT", 6379))
+RETRY_BASE_DELAY    = float(os.environ.get("RETRY_BASE_DELAY", 5))
+RETRY_MAX_DELAY     = float(os.environ.get("RETRY_MAX_DELAY", 600))
 
 # -------- DIRECTORY CONFIG --------
 QUEUE_DIR  = os.environ.get("QUEUE_DIR", "/queue")
@@ -67,6 +84,7 @@ STREAM_METADATA_DONE   = "stream:metadata_done"
 STREAM_SPLIT_DONE      = "stream:split_done"
 STREAM_PACKAGED        = "stream:packaged"
 STREAM_ORGANIZED       = "stream:organized"
+STREAM_DEAD_LETTER     = "stream:dead_letter"
 
 # -------- STRING SANITIZATION --------
 def clean_string(s):
@@ -75,34 +93,184 @@ def clean_string(s):
         s = str(s)
     return s.replace("\x00", "").replace("/", "-").replace("\\", "-").strip()
 
+# -------- CONTENT HASHING & FILE HAND-OFF --------
+def audio_payload_range(f, size):
+    """(start, end) of the audio payload in an open MP3, excluding ID3v2/ID3v1 tags."""
+    start, end = 0, size
+    f.seek(0)
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b"ID3":
+        tag_size = ((header[6] & 0x7F) << 21 | (header[7] & 0x7F) << 14
+                    | (header[8] & 0x7F) << 7 | (header[9] & 0x7F))
+        start = min(size, 10 + tag_size + (10 if header[5] & 0x10 else 0))
+    if end - start >= 128:
+        f.seek(end - 128)
+        if f.read(3) == b"TAG":
+            end -= 128
+    return start, end
+
+def audio_content_hash(path, block_size=1 << 20):
+    """
+    SHA-256 of the audio payload of `path`, ignoring a leading ID3v2 tag and
+    a trailing ID3v1 tag, so re-tagged or renamed copies hash the same.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        start, end = audio_payload_range(f, size)
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            h.update(block)
+            remaining -= len(block)
+    return h.hexdigest()
+
+def audio_sample_hash(path, samples=8, block_size=64 << 10):
+    """
+    Cheap fingerprint of the audio payload: its length plus `samples`
+    evenly spaced blocks. Equal files always match; a match only suggests
+    equality and should be confirmed with audio_content_hash.
+    """
+    size = os.path.getsize(path)
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        start, end = audio_payload_range(f, size)
+        length = end - start
+        h.update(str(length).encode())
+        if length <= samples * block_size:
+            offsets = [start]
+            block_size = length
+        else:
+            step = (length - block_size) // (samples - 1)
+            offsets = [start + i * step for i in range(samples)]
+        for offset in offsets:
+            f.seek(offset)
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+FICLONE = 0x40049409  # Linux ioctl: share extents between two files (btrfs, XFS, ...)
+
+def reflink(src, dst):
+    """Copy-on-write clone of src to a new file dst. Raises OSError where unsupported."""
+    # O_EXCL: never open (and truncate) an existing file, which may share src's inode
+    fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    with open(src, "rb") as fsrc, os.fdopen(fd, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+HANDOFF_MODES = ("rename", "hardlink", "reflink", "copy")
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def link_or_copy(src, dst, modes=("hardlink", "reflink", "copy")):
+    """
+    Place `src` at `dst` without copying data when possible, trying
+    `modes` in order: "rename" (moves src), "hardlink", "reflink" and
+    finally a plain "copy". Returns the mode used. `dst` appears
+    atomically in every mode.
+    """
+    # unique per call: threads and stale files from a crash never share it
+    tmp = f"{dst}.tmp-{uuid.uuid4().hex}"
+    for mode in modes:
+        try:
+            if mode == "rename":
+                os.replace(src, dst)
+                return mode
+            if mode == "hardlink":
+                os.link(src, tmp)
+            elif mode == "reflink":
+                reflink(src, tmp)
+            elif mode == "copy":
+                shutil.copy2(src, tmp)
+            else:
+                raise ValueError(f"Unknown hand-off mode: {mode}")
+        except OSError:
+            if mode != "rename":
+                _discard(tmp)
+            if mode == "copy":
+                raise
+            continue
+        try:
+            os.replace(tmp, dst)
+        except OSError:
+            _discard(tmp)
+            raise
+        return mode
+    raise OSError(f"No hand-off mode in {modes} could place {src} at {dst}")
+
 # -------- STATUS & ERROR MANAGEMENT (HASHES) --------
-def set_file_status(filename, status, error=None, extra=None):
+# Each file:<name> hash is mirrored into a sorted set per status
+# (status_index:<status>) and one over all files (files:by_update), all
+# scored by last update time, so lookups and counts never scan keys.
+STATUS_INDEX_PREFIX = "status_index:"
+FILES_BY_UPDATE     = "files:by_update"
+
+# KEYS[1] = file hash; ARGV = filename, status, updated_at, field, value, ...
+_SET_STATUS_LUA = f"""
+local old = redis.call('HGET', KEYS[1], 'status')
+redis.call('HSET', KEYS[1], 'status', ARGV[2], 'updated_at', ARGV[3], unpack(ARGV, 4))
+if old and old ~= ARGV[2] then
+    redis.call('ZREM', '{STATUS_INDEX_PREFIX}' .. old, ARGV[1])
+end
+redis.call('ZADD', '{STATUS_INDEX_PREFIX}' .. ARGV[2], ARGV[3], ARGV[1])
+redis.call('ZADD', '{FILES_BY_UPDATE}', ARGV[3], ARGV[1])
+return old
+"""
+_set_status_script = redis_client.register_script(_SET_STATUS_LUA)
+
+def set_file_status(filename, status, error=None, extra=None, pipe=None):
+    """
+    Update file:<filename> and move it between status index sets in one
+    atomic step. Pass a pipeline as `pipe` to batch several updates.
+    """
     key = f"file:{filename}"
-    value = {"status": status}
+    value = {}
     if error:
         value["error"] = error
     if extra:
         value.update(extra)
+    args = [filename, status, time.time()]
+    for field, val in value.items():
+        args += [field, val]
     try:
-        redis_client.hset(key, mapping=value)
+        _set_status_script(keys=[key], args=args, client=pipe or redis_client)
     except Exception as e:
         logger.error(f"Redis set_file_status error: {e}")
 
-def get_files_by_status(status):
+def get_files_by_status(status, offset=0, limit=None):
+    """Filenames in `status`, oldest update first; page with offset/limit."""
+    end = -1 if limit is None else offset + limit - 1
     try:
-        keys = redis_client.keys("file:*")
+        return redis_client.zrange(f"{STATUS_INDEX_PREFIX}{status}", offset, end)
     except Exception as e:
         logger.error(f"Redis get_files_by_status error: {e}")
         return []
-    out = []
-    for key in keys:
-        try:
-            data = redis_client.hgetall(key)
-            if data.get("status") == status:
-                out.append(key.replace("file:", ""))
-        except Exception:
-            continue
-    return out
+
+def count_files_by_status(status):
+    try:
+        return redis_client.zcard(f"{STATUS_INDEX_PREFIX}{status}")
+    except Exception as e:
+        logger.error(f"Redis count_files_by_status error: {e}")
+        return 0
+
+def is_file_status(filename, status):
+    try:
+        return redis_client.zscore(f"{STATUS_INDEX_PREFIX}{status}", filename) is not None
+    except Exception as e:
+        logger.error(f"Redis is_file_status error: {e}")
+        return False
 
 def set_file_error(filename, error):
     set_file_status(filename, "error", error=error)
@@ -110,20 +278,75 @@ def set_file_error(filename, error):
 def clear_file_error(filename):
     key = f"file:{filename}"
     try:
-        redis_client.hset(key, "status", "queued")
+        set_file_status(filename, "queued")
         for stage in ["metadata", "splitter", "packager", "organizer"]:
             redis_client.delete(f"{stage}_retries:{filename}")
         redis_client.hdel(key, "error")
     except Exception as e:
         logger.error(f"Redis clear_file_error error: {e}")
 
+# -------- DUPLICATE RESULTS --------
+# Files the watcher found to be byte-identical (audio payload) to an earlier
+# upload are not processed again; they get the owner's organized output.
+DUPLICATES_PREFIX = "ingest:dupes:"
+
+def register_duplicate(owner, filename):
+    """Record `filename` as a duplicate that should share `owner`'s results."""
+    redis_client.sadd(f"{DUPLICATES_PREFIX}{owner}", filename)
+    set_file_status(filename, "duplicate", extra={"duplicate_of": owner})
+
+def duplicate_output_name(name, owner, duplicate):
+    """`name` of one of owner's outputs, renamed for `duplicate` (song stem swapped)."""
+    owner_song = os.path.splitext(owner)[0]
+    dup_song = os.path.splitext(duplicate)[0]
+    if name.startswith(owner_song):
+        return dup_song + name[len(owner_song):]
+    return f"{dup_song}_{name}"
+
+def resolve_duplicates(owner, organized=None):
+    """
+    Link `owner`'s organized outputs to every registered duplicate, next to
+    the originals and named after the duplicate's song. `organized` is the
+    list of paths organize_job produced; by default the list recorded on
+    the owner's status hash. Safe to repeat: links are replaced atomically,
+    and a duplicate that cannot be linked is marked as errored and kept
+    registered. Returns the names resolved.
+    """
+    if organized is None:
+        organized = json.loads(redis_client.hget(f"file:{owner}", "organized") or "[]")
+    resolved = []
+    for dup in redis_client.smembers(f"{DUPLICATES_PREFIX}{owner}"):
+        try:
+            if not organized:
+                raise FileNotFoundError(f"no organized outputs recorded for {owner}")
+            links = []
+            for src in organized:
+                dst = os.path.join(os.path.dirname(src), duplicate_output_name(os.path.basename(src), owner, dup))
+                mode = link_or_copy(src, dst)
+                links.append(dst)
+        except Exception as e:
+            logger.error(f"Could not link results of {owner} to {dup}: {e}")
+            set_file_status(dup, "error", error=f"Linking results of {owner} failed: {e}")
+            continue
+        set_file_status(dup, "organized", extra={
+            "duplicate_of": owner, "handoff": mode, "organized": json.dumps(links),
+        })
+        redis_client.srem(f"{DUPLICATES_PREFIX}{owner}", dup)
+        resolved.append(dup)
+    if resolved:
+        logger.info(f"Linked results of {owner} to duplicates: {', '.join(resolved)}")
+    return resolved
+
 # -------- NOTIFICATIONS --------
+# one pooled HTTP session for all webhook calls (keep-alive per host)
+http_session = requests.Session()
+
 def send_telegram_message(message):
     if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
         url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
         data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
         try:
-            resp = requests.post(url, data=data, timeout=5)
+            resp = http_session.post(url, data=data, timeout=5)
             if not resp.ok:
                 logger.warning(f"Telegram notification failed: {resp.text}")
         except Exception as e:
@@ -134,7 +357,7 @@ def send_telegram_message(message):
 def send_slack_message(message):
     if SLACK_WEBHOOK_URL:
         try:
-            resp = requests.post(SLACK_WEBHOOK_URL, json={"text": message}, timeout=5)
+            resp = http_session.post(SLACK_WEBHOOK_URL, json={"text": message}, timeout=5)
             if not resp.ok:
                 logger.warning(f"Slack notification failed: {resp.text}")
         except Exception as e:
@@ -142,24 +365,192 @@ def send_slack_message(message):
     else:
         logger.debug("Slack skipped")
 
+def email_configured():
+    return bool(NOTIFY_EMAILS and SMTP_SERVER and SMTP_USERNAME and SMTP_PASSWORD)
+
+def build_email(subject, message):
+    msg = EmailMessage()
+    msg.set_content(message)
+    msg["Subject"] = subject
+    msg["From"]    = SMTP_USERNAME
+    msg["To"]      = [e.strip() for e in NOTIFY_EMAILS.split(",")]
+    return msg
+
+def smtp_connect():
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10)
+    server.starttls()
+    server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    return server
+
 def send_email(subject, message):
-    if NOTIFY_EMAILS and SMTP_SERVER and SMTP_USERNAME and SMTP_PASSWORD:
+    if email_configured():
         try:
-            msg = EmailMessage()
-            msg.set_content(message)
-            msg["Subject"] = subject
-            msg["From"]    = SMTP_USERNAME
-            msg["To"]      = [e.strip() for e in NOTIFY_EMAILS.split(",")]
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls()
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.send_message(msg)
+            with smtp_connect() as server:
+                server.send_message(build_email(subject, message))
         except Exception as e:
             logger.warning(f"Email notification error: {e}")
     else:
         logger.debug("Email skipped")
 
+class NotificationDispatcher:
+    """
+    Background sender for notify_all. Producers only enqueue (never block);
+    a single thread delivers over the pooled HTTP session and one
+    persistent SMTP connection.
+
+    Per subject, the first `burst` messages in each `window` seconds are
+    sent as-is; the rest are coalesced into one digest at the end of the
+    window ("37 × Pipeline Error [splitter] in the last 60s"). When the
+    queue is full new messages are dropped and counted.
+    """
+
+    SMTP_IDLE = 300
+    DIGEST_SAMPLES = 5
+
+    def __init__(self, maxsize=None, window=None, burst=None, deliver=None):
+        self.queue = queue.Queue(maxsize or NOTIFY_QUEUE_SIZE)
+        self.window = window if window is not None else NOTIFY_WINDOW
+        self.burst = burst if burst is not None else NOTIFY_BURST
+        self.deliver = deliver or self._deliver
+        self.dropped = 0
+        self._windows = {}  # subject -> [window start, sent, suppressed, samples]
+        self._smtp = None
+        self._smtp_used = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # ---- producer side ----
+    def submit(self, subject, message):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((subject, message))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                logger.warning(f"Notification queue full; {self.dropped} messages dropped so far")
+
+    def _ensure_started(self):
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if not (self._thread and self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, daemon=True, name="notify-dispatcher")
+                self._thread.start()
+
+    def close(self, timeout=5):
+        """Drain the queue, send pending digests and drop the SMTP connection."""
+        if self._thread and self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join(timeout)
+
+    # ---- dispatcher thread ----
+    def _run(self):
+        while True:
+            try:
+                item = self.queue.get(timeout=self._next_deadline())
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                self._dispatch(*item)
+            self._flush_digests()
+            self._close_idle_smtp()
+        self._flush_digests(force=True)
+        self._close_smtp()
+
+    def _next_deadline(self):
+        if not self._windows:
+            return self.SMTP_IDLE if self._smtp else None
+        now = time.monotonic()
+        return max(0.05, min(start + self.window for start, *_ in self._windows.values()) - now)
+
+    def _dispatch(self, subject, message):
+        now = time.monotonic()
+        state = self._windows.setdefault(subject, [now, 0, 0, []])
+        if state[1] < self.burst:
+            state[1] += 1
+            self._safe_deliver(subject, message)
+        else:
+            state[2] += 1
+            if len(state[3]) < self.DIGEST_SAMPLES:
+                state[3].append(message.splitlines()[0] if message else "")
+
+    def _flush_digests(self, force=False):
+        now = time.monotonic()
+        for subject, (start, _sent, suppressed, samples) in list(self._windows.items()):
+            if not force and now - start < self.window:
+                continue
+            del self._windows[subject]
+            if suppressed:
+                lines = [f"{suppressed} × {subject} in the last {self.window}s (coalesced)"]
+                lines += [f"  - {m}" for m in samples]
+                if suppressed > len(samples):
+                    lines.append(f"  … and {suppressed - len(samples)} more")
+                if self.dropped:
+                    lines.append(f"{self.dropped} notifications dropped (queue full)")
+                self._safe_deliver(f"{subject} (digest)", "\n".join(lines))
+
+    def _safe_deliver(self, subject, message):
+        try:
+            self.deliver(subject, message)
+        except Exception as e:
+            logger.warning(f"Notification delivery error: {e}")
+
+    def _deliver(self, subject, message):
+        send_telegram_message(message)
+        send_slack_message(message)
+        self._send_email(subject, message)
+
+    # ---- persistent SMTP ----
+    def _send_email(self, subject, message):
+        if not email_configured():
+            logger.debug("Email skipped")
+            return
+        msg = build_email(subject, message)
+        for attempt in (1, 2):
+            try:
+                if self._smtp is None:
+                    self._smtp = smtp_connect()
+                self._smtp.send_message(msg)
+                self._smtp_used = time.monotonic()
+                return
+            except (smtplib.SMTPServerDisconnected, OSError) as e:
+                # server closed the idle connection; reconnect once
+                self._close_smtp()
+                if attempt == 2:
+                    logger.warning(f"Email notification error: {e}")
+            except Exception as e:
+                logger.warning(f"Email notification error: {e}")
+                return
+
+    def _close_idle_smtp(self):
+        if self._smtp and time.monotonic() - self._smtp_used > self.SMTP_IDLE:
+            self._close_smtp()
+
+    def _close_smtp(self):
+        if self._smtp is not None:
+            try:
+                self._smtp.quit()
+            except Exception:
+                pass
+            self._smtp = None
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = NotificationDispatcher()
+            atexit.register(_dispatcher.close)
+    return _dispatcher
+
 def notify_all(subject, message):
+    if NOTIFY_ASYNC:
+        get_dispatcher().submit(subject, message)
+        return
     send_telegram_message(message)
     send_slack_message(message)
     send_email(subject, message)
@@ -186,6 +577,10 @@ def reset_retry(stage, filename):
         pass
 
 def handle_auto_retry(stage, filename, func, max_retries=3, retry_delay=5, notify_fail=True):
+    """
+    Run func with blocking in-place retries. Stage workers no longer use
+    this (see schedule_retry), because sleeping here stalls the consumer.
+    """
     for attempt in range(1, max_retries + 1):
         try:
             result = func()
@@ -204,6 +599,89 @@ def handle_auto_retry(stage, filename, func, max_retries=3, retry_delay=5, notif
             if attempt == max_retries:
                 raise
 
+# -------- DELAYED RETRY QUEUE --------
+# Failed jobs are parked in one sorted set scored by due time and pushed
+# back onto their stage's input stream when due, so workers never sleep.
+RETRY_SCHEDULE = "retry:schedule"
+
+# KEYS[1] = schedule; ARGV = now, limit. Each member is a JSON job.
+_RELEASE_RETRIES_LUA = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, member in ipairs(due) do
+    redis.call('ZREM', KEYS[1], member)
+    local job = cjson.decode(member)
+    local fields = {'attempt', tostring(job.attempt)}
+    for k, v in pairs(job.data) do
+        table.insert(fields, k)
+        table.insert(fields, tostring(v))
+    end
+    redis.call('XADD', job.stream, '*', unpack(fields))
+end
+return #due
+"""
+_release_retries_script = redis_client.register_script(_RELEASE_RETRIES_LUA)
+
+def retry_backoff(attempt, base=None, cap=None):
+    """Exponential backoff with jitter: uniform in [d/2, d], d = base * 2^(attempt-1)."""
+    base = RETRY_BASE_DELAY if base is None else base
+    cap = RETRY_MAX_DELAY if cap is None else cap
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return random.uniform(delay / 2, delay)
+
+class PermanentError(Exception):
+    """A failure retrying cannot fix (corrupt or unsupported input); the job is dead-lettered at once."""
+
+def fail_job(stage, stream_key, data, error, msg_id=""):
+    """Mark the job's file as errored, dead-letter it and notify."""
+    filename = data.get("file")
+    timestamp = datetime.datetime.now().isoformat()
+    set_file_error(filename, f"{timestamp}\n{error}")
+    publish_dead_letter(stage, stream_key, msg_id, data, error)
+    notify_all(f"Pipeline Error [{stage}]", f"{stage} FAILED: {filename}\n{error}")
+
+def schedule_retry(stage, stream_key, data, error, max_retries=3, msg_id="", base_delay=None):
+    """
+    Record a failed attempt and schedule the job back onto stream_key after
+    a backoff delay. Once max_retries attempts have failed, or at once for
+    a PermanentError, the job goes to STREAM_DEAD_LETTER instead. Returns
+    True if a retry was scheduled.
+    """
+    filename = data.get("file")
+    if isinstance(error, PermanentError):
+        fail_job(stage, stream_key, data, f"permanent: {error}", msg_id)
+        logger.error(f"{stage} rejected {filename} without retry: {error}")
+        return False
+    attempt = increment_retry(stage, filename)
+    timestamp = datetime.datetime.now().isoformat()
+    if attempt >= max_retries:
+        fail_job(stage, stream_key, data, error, msg_id)
+        logger.error(f"{stage} gave up on {filename} after {attempt} attempts")
+        return False
+    delay = retry_backoff(attempt, base_delay)
+    job = {
+        "stream": stream_key,
+        "stage": stage,
+        "attempt": attempt,
+        "data": {k: v for k, v in data.items() if k != "attempt"},
+        "scheduled_at": time.time(),
+    }
+    try:
+        redis_client.zadd(RETRY_SCHEDULE, {json.dumps(job, sort_keys=True): time.time() + delay})
+    except Exception as e:
+        logger.error(f"Redis schedule_retry error: {e}")
+        return False
+    set_file_status(filename, "retrying", error=f"{timestamp}\n{error}")
+    logger.warning(f"{stage} attempt {attempt}/{max_retries} failed for {filename}; retry in {delay:.1f}s")
+    return True
+
+def release_due_retries(limit=100):
+    """Move due jobs from the retry schedule back onto their streams. Safe to run from every worker."""
+    try:
+        return _release_retries_script(keys=[RETRY_SCHEDULE], args=[time.time(), limit], client=redis_client)
+    except Exception as e:
+        logger.error(f"Redis release_due_retries error: {e}")
+        return 0
+
 # -------- FILE STATUS SUMMARY --------
 def get_file_status(filename):
     key = f"file:{filename}"
@@ -217,11 +695,66 @@ def get_file_status(filename):
     except Exception as e:
         return {"filename": filename, "status": "unknown", "last_error": str(e)}
 
+def file_status_row(filename, data):
+    """API view of a file:<filename> hash."""
+    return {
+        "filename":   filename,
+        "status":     data.get("status", "unknown"),
+        "last_error": data.get("error", ""),
+        "updated_at": float(data["updated_at"]) if data.get("updated_at") else None,
+    }
+
+def get_file_statuses(filenames):
+    """get_file_status for many files in one pipelined round trip (plus updated_at)."""
+    if not filenames:
+        return []
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for filename in filenames:
+            pipe.hgetall(f"file:{filename}")
+        rows = pipe.execute()
+    except Exception as e:
+        return [{"filename": f, "status": "unknown", "last_error": str(e)} for f in filenames]
+    return [file_status_row(filename, data) for filename, data in zip(filenames, rows)]
+
+def queue_page(pipe, statuses=None, offset=0, limit=100, descending=True):
+    """Queue the reads for one page_files() page on `pipe` (sync or asyncio pipeline)."""
+    keys = [f"{STATUS_INDEX_PREFIX}{st}" for st in statuses] if statuses else [FILES_BY_UPDATE]
+    end = offset + limit - 1
+    for key in keys:
+        pipe.zcard(key)
+        if len(keys) == 1:
+            pipe.zrange(key, offset, end, desc=descending, withscores=True)
+        else:
+            pipe.zrange(key, 0, end, desc=descending, withscores=True)
+    return pipe
+
+def merge_page(replies, offset=0, limit=100, descending=True):
+    """(filenames, total) from the replies to queue_page()."""
+    total = sum(replies[0::2])
+    pages = replies[1::2]
+    entries = [entry for page in pages for entry in page]
+    if len(pages) > 1:
+        entries.sort(key=lambda e: e[1], reverse=descending)
+        entries = entries[offset:offset + limit]
+    return [name for name, _score in entries], total
+
+def page_files(statuses=None, offset=0, limit=100, descending=True):
+    """
+    One page of filenames ordered by last update, from the status index.
+    `statuses` filters to those status sets (None: every file). Returns
+    (filenames, total). Several statuses are merged from their sets'
+    first offset+limit entries, so cost grows with page depth, not with
+    the library size.
+    """
+    pipe = queue_page(redis_client.pipeline(transaction=False), statuses, offset, limit, descending)
+    return merge_page(pipe.execute(), offset, limit, descending)
+
 # -------- REDIS STREAM HELPERS --------
-def ensure_consumer_group(stream_key: str, group_name: str):
+def ensure_consumer_group(stream_key: str, group_name: str, start_id: str = "$"):
     """Create consumer group if it doesn’t already exist."""
     try:
-        redis_client.xgroup_create(stream_key, group_name, id="$", mkstream=True)
+        redis_client.xgroup_create(stream_key, group_name, id=start_id, mkstream=True)
     except redis.exceptions.ResponseError as e:
         # ignore “BUSYGROUP” if already created
         if "BUSYGROUP" not in str(e):
@@ -252,3 +785,76 @@ def consume(stream_key: str, group_name: str, consumer_name: str,
     except Exception as e:
         logger.error(f"Error consuming from {stream_key}: {e}")
         return []
+
+# -------- JOB ENVELOPE --------
+# Stream entries carry {"file": name, "v": version, "job": <JSON>}. "file"
+# stays top-level so retry, dead-letter and status tooling keep working on
+# any message. The job accumulates what each stage learned, so later
+# stages do not have to re-derive paths or re-read earlier outputs:
+#   file, song, content_hash, duration (seconds; only when counted from a
+#   Xing/VBRI header), audio{sample_rate, channels, bitrate},
+#   tags{TIT2, TPE1, TALB, TRCK}, stems[...],
+#   paths{queue, metadata, stems, outputs[...], organized[...]},
+#   params{profile, splitter, stems, stem_types[...], variants[...]}
+# Empty params mean "use the service's env defaults".
+JOB_VERSION = 1
+
+def make_job(filename, params=None, **fields):
+    """A fresh job envelope for `filename` with its default artifact paths resolved."""
+    song = os.path.splitext(filename)[0]
+    job = {
+        "v": JOB_VERSION,
+        "file": filename,
+        "song": song,
+        "paths": {
+            "queue": os.path.join(QUEUE_DIR, clean_string(filename)),
+            "metadata": os.path.join(META_DIR, f"{song}.mp3.json"),
+            "stems": os.path.join(STEMS_DIR, song),
+        },
+        "params": dict(params or {}),
+    }
+    job.update({k: v for k, v in fields.items() if v is not None})
+    return job
+
+def parse_job(data):
+    """
+    The job envelope from a stream entry. Entries without one (published
+    by older services or by hand) get a default envelope for their file.
+    """
+    raw = data.get("job")
+    if not raw:
+        return make_job(data.get("file") or data.get("filename"))
+    job = json.loads(raw)
+    if int(job.get("v", 0)) > JOB_VERSION:
+        logger.warning(f"Job for {job.get('file')} has newer envelope v{job['v']}; using known fields")
+    defaults = make_job(job["file"])
+    job.setdefault("params", {})
+    job["paths"] = {**defaults["paths"], **job.get("paths", {})}
+    return job
+
+def job_param(job, name, default=None):
+    value = job.get("params", {}).get(name)
+    return default if value in (None, "", []) else value
+
+def publish_job(stream_key, job, pipe=None):
+    """XADD the envelope to stream_key (on `pipe` when given)."""
+    return (pipe or redis_client).xadd(stream_key, {
+        "file": job["file"],
+        "v": str(job.get("v", JOB_VERSION)),
+        "job": json.dumps(job, separators=(",", ":")),
+    })
+
+def publish_dead_letter(stage: str, source_stream: str, msg_id: str, data: dict, reason: str):
+    """Park a job that will not be retried again on STREAM_DEAD_LETTER."""
+    entry = {k: v for k, v in (data or {}).items() if v is not None}
+    entry.update({
+        "stage": stage,
+        "source_stream": source_stream,
+        "source_id": msg_id,
+        "reason": str(reason)[:2000],
+        "failed_at": datetime.datetime.now().isoformat(),
+    })
+    try:
+        redis_client.xadd(STREAM_DEAD_LETTER, entry)
+    except Exception as e:
+        logger.error(f"Error publishing to {STREAM_DEAD_LETTER}: {e}")
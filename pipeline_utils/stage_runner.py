@@ -0,0 +1,325 @@
+"""
+Reusable Redis Streams stage runner shared by the pipeline services.
+
+A service only declares a handler for one message's data dict; the runner
+owns the xreadgroup → handle → xack loop:
+
+    StageRunner("splitter", STREAM_METADATA_DONE, GROUP_NAME,
+                handler=handle_message, consumer_prefix=CONSUMER_NAME).run()
+
+Settings (env, overridable per runner):
+  - STAGE_WORKERS      concurrent workers per process (default 1)
+  - STAGE_WORKER_MODE  "thread" (I/O-bound stages) or "process" (CPU-bound)
+  - STAGE_BATCH_SIZE   messages fetched per XREADGROUP call (default 1; a
+                       fetched message sits in this worker's PEL until
+                       handled, so only stages with short jobs or a
+                       batch_handler should raise it)
+  - STAGE_BLOCK_MS     how long an idle read blocks (default 5000)
+
+Scale-out across replicas: every worker has its own consumer name and
+keeps a heartbeat key alive. Workers periodically reclaim pending
+entries (PEL) left behind by consumers whose heartbeat has expired; a
+live consumer's entries are never taken, however long its job runs.
+STAGE_CLAIM_MAX_IDLE_MS opts in to an extra XAUTOCLAIM sweep of anything
+idle that long regardless of owner (for workers that hang while their
+heartbeat thread lives on); set it well above the longest legitimate job,
+or the same job runs twice. An entry delivered more than
+STAGE_MAX_DELIVERIES times goes to STREAM_DEAD_LETTER instead of being
+handled again.
+  - STAGE_HEARTBEAT_TTL      seconds a heartbeat stays valid (default 30)
+  - STAGE_CLAIM_INTERVAL     seconds between reclaim passes (default 15)
+  - STAGE_CLAIM_IDLE_MS      min idle time before a dead consumer's entry is claimed (default 30000)
+  - STAGE_CLAIM_MAX_IDLE_MS  idle time after which any entry is claimed, even from a live consumer (default 0: off)
+  - STAGE_MAX_DELIVERIES     deliveries before an entry is dead-lettered (default 5)
+
+Stages that gain from amortising work across messages (e.g. a process
+pool) can pass `batch_handler`: it receives the data dicts of a whole
+XREADGROUP batch and returns one result per message, None for success or
+the exception that message failed with.
+
+Handler failures never block a worker: the entry is acked and the job is
+parked on the delayed retry schedule (pipeline_utils.schedule_retry) with
+exponential backoff. A releaser thread pushes due jobs back onto their
+stream; after MAX_RETRIES failed attempts the job is dead-lettered. A
+handler raising pipeline_utils.PermanentError is dead-lettered at once.
+  - MAX_RETRIES              attempts per job before giving up (default 3)
+  - STAGE_RETRY_POLL         seconds between retry-schedule polls (default 1)
+
+Every runner also takes part in stream retention
+(pipeline_utils.stream_retention): every STREAM_RETENTION_INTERVAL
+seconds one replica archives and trims entries no consumer group needs.
+"""
+
+import os
+import time
+import socket
+import threading
+import multiprocessing
+from pipeline_utils.pipeline_utils import (
+    redis_client,
+    logger,
+    ensure_consumer_group,
+    publish_dead_letter,
+    set_file_error,
+    schedule_retry,
+    release_due_retries,
+    reset_retry,
+)
+from pipeline_utils.stream_retention import STREAM_RETENTION_INTERVAL, enforce_retention
+
+STAGE_WORKERS     = int(os.environ.get("STAGE_WORKERS", 1))
+STAGE_WORKER_MODE = os.environ.get("STAGE_WORKER_MODE", "thread").lower()
+STAGE_BATCH_SIZE  = int(os.environ.get("STAGE_BATCH_SIZE", 1))
+STAGE_BLOCK_MS    = int(os.environ.get("STAGE_BLOCK_MS", 5000))
+STAGE_HEARTBEAT_TTL     = int(os.environ.get("STAGE_HEARTBEAT_TTL", 30))
+STAGE_CLAIM_INTERVAL    = int(os.environ.get("STAGE_CLAIM_INTERVAL", 15))
+STAGE_CLAIM_IDLE_MS     = int(os.environ.get("STAGE_CLAIM_IDLE_MS", 30000))
+STAGE_CLAIM_MAX_IDLE_MS = int(os.environ.get("STAGE_CLAIM_MAX_IDLE_MS", 0))
+STAGE_MAX_DELIVERIES    = int(os.environ.get("STAGE_MAX_DELIVERIES", 5))
+STAGE_RETRY_POLL        = float(os.environ.get("STAGE_RETRY_POLL", 1))
+MAX_RETRIES             = int(os.environ.get("MAX_RETRIES", 3))
+
+def consumer_name(prefix, index):
+    """Unique consumer identity: <prefix>-<host>-<pid>-<worker index>."""
+    return f"{prefix}-{socket.gethostname()}-{os.getpid()}-{index}"
+
+def heartbeat_key(group_name, consumer):
+    return f"consumer_heartbeat:{group_name}:{consumer}"
+
+class StageRunner:
+    def __init__(self, stage, stream_key, group_name, handler, consumer_prefix=None,
+                 workers=None, mode=None, batch_size=None, block_ms=None, initializer=None,
+                 max_retries=None, batch_handler=None):
+        self.stage = stage
+        self.stream_key = stream_key
+        self.group_name = group_name
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.consumer_prefix = consumer_prefix or f"{stage}-consumer"
+        self.workers = workers or STAGE_WORKERS
+        self.mode = mode or STAGE_WORKER_MODE
+        self.batch_size = batch_size or STAGE_BATCH_SIZE
+        self.block_ms = block_ms if block_ms is not None else STAGE_BLOCK_MS
+        self.initializer = initializer
+        self.max_retries = max_retries or MAX_RETRIES
+        self._stop = threading.Event()
+        self._workers = []
+
+    # ---- lifecycle ----
+    def start(self):
+        ensure_consumer_group(self.stream_key, self.group_name, start_id="0")
+        threading.Thread(target=self._retry_loop, daemon=True,
+                         name=f"{self.stage}-retry-releaser").start()
+        if STREAM_RETENTION_INTERVAL:
+            threading.Thread(target=self._retention_loop, daemon=True,
+                             name=f"{self.stage}-retention").start()
+        if self.mode == "process":
+            ctx = multiprocessing.get_context("spawn")
+            for i in range(self.workers):
+                p = ctx.Process(target=self._process_main, args=(i,), daemon=True,
+                                name=f"{self.stage}-worker-{i}")
+                p.start()
+                self._workers.append(p)
+        else:
+            if self.initializer:
+                self.initializer()
+            consumers = [consumer_name(self.consumer_prefix, i) for i in range(self.workers)]
+            self._start_heartbeat(consumers)
+            for i, consumer in enumerate(consumers):
+                t = threading.Thread(target=self._worker_loop, args=(consumer,),
+                                     daemon=True, name=f"{self.stage}-worker-{i}")
+                t.start()
+                self._workers.append(t)
+        logger.info(
+            f"{self.stage}: {self.workers} {self.mode} worker(s) consuming "
+            f"{self.stream_key} as group {self.group_name} (batch {self.batch_size})"
+        )
+        return self
+
+    def run(self):
+        """Start the workers and block until they exit."""
+        self.start()
+        self.join()
+
+    def join(self):
+        for w in self._workers:
+            w.join()
+
+    def stop(self):
+        self._stop.set()
+
+    # ---- workers ----
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_stop"] = None
+        state["_workers"] = []
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stop = threading.Event()
+
+    def _process_main(self, index):
+        if self.initializer:
+            self.initializer()
+        consumer = consumer_name(self.consumer_prefix, index)
+        self._start_heartbeat([consumer])
+        self._worker_loop(consumer)
+
+    # ---- heartbeats ----
+    def _start_heartbeat(self, consumers):
+        self._beat(consumers)
+        threading.Thread(target=self._heartbeat_loop, args=(consumers,), daemon=True,
+                         name=f"{self.stage}-heartbeat").start()
+
+    def _beat(self, consumers):
+        pipe = redis_client.pipeline()
+        for consumer in consumers:
+            pipe.set(heartbeat_key(self.group_name, consumer), int(time.time()), ex=STAGE_HEARTBEAT_TTL)
+        pipe.execute()
+
+    def _heartbeat_loop(self, consumers):
+        while not self._stop.wait(max(1, STAGE_HEARTBEAT_TTL // 3)):
+            try:
+                self._beat(consumers)
+            except Exception as e:
+                logger.warning(f"{self.stage}: heartbeat failed: {e}")
+
+    # ---- delayed retries ----
+    def _retry_loop(self):
+        # the release script is atomic, so every replica can run this
+        while not self._stop.wait(STAGE_RETRY_POLL):
+            release_due_retries()
+
+    # ---- stream retention ----
+    def _retention_loop(self):
+        # enforce_retention takes a Redis lock, so replicas do not overlap
+        while not self._stop.wait(STREAM_RETENTION_INTERVAL):
+            try:
+                enforce_retention()
+            except Exception as e:
+                logger.warning(f"{self.stage}: stream retention failed: {e}")
+
+    # ---- pending-entry reclaim ----
+    def _dead_consumers(self):
+        dead = set()
+        for info in redis_client.xinfo_consumers(self.stream_key, self.group_name):
+            name = info["name"]
+            if redis_client.exists(heartbeat_key(self.group_name, name)):
+                continue
+            if info["pending"]:
+                dead.add(name)
+            else:
+                redis_client.xgroup_delconsumer(self.stream_key, self.group_name, name)
+        return dead
+
+    def reclaim(self, consumer):
+        """
+        Claim pending entries abandoned by dead consumers (and, if enabled,
+        anything idle past STAGE_CLAIM_MAX_IDLE_MS) for `consumer`. Entries that have
+        been delivered too often are dead-lettered. Returns [(id, data)]
+        still to be handled.
+        """
+        claimed = []
+        dead = self._dead_consumers()
+        if dead:
+            pending = redis_client.xpending_range(
+                self.stream_key, self.group_name, min="-", max="+",
+                count=self.batch_size * 10, idle=STAGE_CLAIM_IDLE_MS,
+            )
+            ids = [p["message_id"] for p in pending if p["consumer"] in dead][:self.batch_size]
+            if ids:
+                claimed += redis_client.xclaim(
+                    self.stream_key, self.group_name, consumer, STAGE_CLAIM_IDLE_MS, ids
+                )
+        if STAGE_CLAIM_MAX_IDLE_MS and len(claimed) < self.batch_size:
+            _next, messages, *_ = redis_client.xautoclaim(
+                self.stream_key, self.group_name, consumer, STAGE_CLAIM_MAX_IDLE_MS,
+                start_id="0-0", count=self.batch_size - len(claimed),
+            )
+            claimed += messages
+        if claimed:
+            logger.info(f"{self.stage}: {consumer} reclaimed {len(claimed)} pending entries")
+
+        ready = []
+        for msg_id, data in claimed:
+            if data is None:
+                # entry was trimmed from the stream; nothing left to process
+                redis_client.xack(self.stream_key, self.group_name, msg_id)
+                continue
+            info = redis_client.xpending_range(
+                self.stream_key, self.group_name, min=msg_id, max=msg_id, count=1
+            )
+            deliveries = info[0]["times_delivered"] if info else 0
+            if deliveries > STAGE_MAX_DELIVERIES:
+                reason = f"delivered {deliveries} times without being acknowledged"
+                logger.error(f"{self.stage}: dead-lettering {msg_id} ({reason})")
+                publish_dead_letter(self.stage, self.stream_key, msg_id, data, reason)
+                if data.get("file"):
+                    set_file_error(data["file"], f"{self.stage}: {reason}")
+                redis_client.xack(self.stream_key, self.group_name, msg_id)
+                continue
+            ready.append((msg_id, data))
+        return ready
+
+    def _worker_loop(self, consumer):
+        logger.info(f"{self.stage}: worker {consumer} listening on {self.stream_key}")
+        next_claim = time.time() + STAGE_CLAIM_INTERVAL
+        while not self._stop.is_set():
+            if time.time() >= next_claim:
+                next_claim = time.time() + STAGE_CLAIM_INTERVAL
+                try:
+                    self.dispatch(self.reclaim(consumer))
+                except Exception as e:
+                    logger.warning(f"{self.stage}: reclaim failed: {e}")
+            try:
+                entries = redis_client.xreadgroup(
+                    self.group_name, consumer,
+                    {self.stream_key: ">"},
+                    count=self.batch_size, block=self.block_ms,
+                )
+            except Exception as e:
+                logger.error(f"{self.stage}: read from {self.stream_key} failed: {e}")
+                self._stop.wait(1)
+                continue
+            for _stream, messages in entries or []:
+                self.dispatch(messages)
+
+    def dispatch(self, messages):
+        if self.batch_handler and len(messages) > 1:
+            self.handle_batch(messages)
+        else:
+            for msg_id, data in messages:
+                self.handle(msg_id, data)
+
+    def handle(self, msg_id, data):
+        filename = data.get("file")
+        try:
+            self.handler(data)
+            if filename:
+                reset_retry(self.stage, filename)
+        except Exception as e:
+            logger.error(f"{self.stage}: handler failed for {msg_id} ({filename}): {e}")
+            schedule_retry(self.stage, self.stream_key, data, e,
+                           max_retries=self.max_retries, msg_id=msg_id)
+        finally:
+            redis_client.xack(self.stream_key, self.group_name, msg_id)
+
+    def handle_batch(self, messages):
+        try:
+            results = self.batch_handler([data for _id, data in messages])
+        except Exception as e:
+            logger.error(f"{self.stage}: batch handler failed ({e}); handling one by one")
+            for msg_id, data in messages:
+                self.handle(msg_id, data)
+            return
+        for (msg_id, data), error in zip(messages, results):
+            filename = data.get("file")
+            if error is None:
+                if filename:
+                    reset_retry(self.stage, filename)
+            else:
+                logger.error(f"{self.stage}: handler failed for {msg_id} ({filename}): {error}")
+                schedule_retry(self.stage, self.stream_key, data, error,
+                               max_retries=self.max_retries, msg_id=msg_id)
+        redis_client.xack(self.stream_key, self.group_name, *[msg_id for msg_id, _ in messages])
@@ -0,0 +1,264 @@
+"""
+Bounded retention for the pipeline streams, with on-disk archival.
+
+    python -m pipeline_utils.stream_retention trim [--dry-run]
+    python -m pipeline_utils.stream_retention query stream:queued [--since 2026-10-01] [--file song.mp3]
+
+A pass picks, per stream, the first entry to keep: everything older than
+STREAM_RETENTION_SECONDS or beyond the newest STREAM_MAXLEN entries may
+go, but never an entry a consumer group still needs (its oldest pending
+entry, or the first one after its last-delivered id). Entries below that
+point are appended to gzipped NDJSON under STREAM_ARCHIVE_DIR, one file
+per stream per UTC day rolled into numbered parts at
+STREAM_ARCHIVE_MAX_BYTES, and only then removed with XTRIM MINID ~.
+Approximate trimming may leave a few archived entries behind for a later
+pass; a per-stream cursor (retention:archived:<stream>) keeps them from
+being archived twice. A pass that dies between writing the archive and
+saving the cursor archives those entries again (at-least-once).
+
+StageRunner runs a pass every STREAM_RETENTION_INTERVAL seconds under a
+Redis lock, so only one replica trims at a time.
+  - STREAM_RETENTION_SECONDS   age kept in Redis (default 604800, 0 disables)
+  - STREAM_MAXLEN              entries kept per stream (default 10000, 0 disables)
+  - STREAM_RETENTION_INTERVAL  seconds between passes (default 300, 0 disables)
+  - STREAM_RETENTION_BATCH     entries archived per stream per pass (default 50000)
+  - STREAM_ARCHIVE_DIR         archive root (default $LOGS_DIR/streams)
+  - STREAM_ARCHIVE_MAX_BYTES   size at which a day's archive rolls over (default 64 MiB)
+"""
+
+import os
+import re
+import gzip
+import json
+import time
+import argparse
+import datetime
+import redis
+from pipeline_utils.pipeline_utils import (
+    redis_client,
+    logger,
+    LOGS_DIR,
+    STREAM_QUEUED,
+    STREAM_METADATA_DONE,
+    STREAM_SPLIT_DONE,
+    STREAM_PACKAGED,
+    STREAM_ORGANIZED,
+    STREAM_DEAD_LETTER,
+)
+
+STREAM_RETENTION_SECONDS  = int(os.environ.get("STREAM_RETENTION_SECONDS", 7 * 24 * 3600))
+STREAM_MAXLEN             = int(os.environ.get("STREAM_MAXLEN", 10000))
+STREAM_RETENTION_INTERVAL = int(os.environ.get("STREAM_RETENTION_INTERVAL", 300))
+STREAM_RETENTION_BATCH    = int(os.environ.get("STREAM_RETENTION_BATCH", 50000))
+STREAM_ARCHIVE_DIR        = os.environ.get("STREAM_ARCHIVE_DIR", os.path.join(LOGS_DIR, "streams"))
+STREAM_ARCHIVE_MAX_BYTES  = int(os.environ.get("STREAM_ARCHIVE_MAX_BYTES", 64 << 20))
+
+RETAINED_STREAMS = [
+    STREAM_QUEUED, STREAM_METADATA_DONE, STREAM_SPLIT_DONE,
+    STREAM_PACKAGED, STREAM_ORGANIZED, STREAM_DEAD_LETTER,
+]
+ARCHIVED_PREFIX = "retention:archived:"
+RETENTION_LOCK  = "retention:lock"
+
+def parse_id(msg_id):
+    ms, _, seq = msg_id.partition("-")
+    return int(ms), int(seq or 0)
+
+def next_id(msg_id):
+    ms, seq = parse_id(msg_id)
+    return f"{ms}-{seq + 1}"
+
+def group_floor(stream):
+    """Lowest entry id any consumer group on `stream` still needs; None without groups."""
+    try:
+        groups = redis_client.xinfo_groups(stream)
+    except redis.exceptions.ResponseError:
+        return None  # stream does not exist yet
+    floor = None
+    for group in groups:
+        if group["pending"]:
+            need = redis_client.xpending(stream, group["name"])["min"]
+        else:
+            need = next_id(group["last-delivered-id"])
+        if floor is None or parse_id(need) < parse_id(floor):
+            floor = need
+    return floor
+
+# ---- archive files ----
+_PART_RE = re.compile(r"^(\d{4}-\d{2}-\d{2})(?:\.(\d+))?\.ndjson\.gz$")
+
+def archive_folder(stream, root=None):
+    return os.path.join(root or STREAM_ARCHIVE_DIR, stream.replace(":", "_"))
+
+def archive_files(stream, root=None):
+    """[(day, part, path)] of `stream`'s archive, oldest first."""
+    folder = archive_folder(stream, root)
+    if not os.path.isdir(folder):
+        return []
+    files = []
+    for name in os.listdir(folder):
+        m = _PART_RE.match(name)
+        if m:
+            files.append((m.group(1), int(m.group(2) or 0), os.path.join(folder, name)))
+    return sorted(files)
+
+class ArchiveWriter:
+    """Appends entries to per-day gzip NDJSON files (one gzip member per pass)."""
+
+    def __init__(self, stream, root=None, max_bytes=None):
+        self.stream = stream
+        self.folder = archive_folder(stream, root)
+        self.max_bytes = max_bytes or STREAM_ARCHIVE_MAX_BYTES
+        self.files = {}
+
+    def _open(self, day):
+        os.makedirs(self.folder, exist_ok=True)
+        part = 0
+        while True:
+            name = f"{day}.ndjson.gz" if part == 0 else f"{day}.{part}.ndjson.gz"
+            path = os.path.join(self.folder, name)
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_bytes:
+                return gzip.open(path, "at", encoding="utf-8")
+            part += 1
+
+    def write(self, msg_id, data):
+        ms, _seq = parse_id(msg_id)
+        day = datetime.datetime.fromtimestamp(ms / 1000, datetime.timezone.utc).strftime("%Y-%m-%d")
+        if day not in self.files:
+            self.files[day] = self._open(day)
+        self.files[day].write(json.dumps({"id": msg_id, "ts": ms, "data": data}, separators=(",", ":")) + "\n")
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def query_archive(stream, since=None, until=None, filename=None, root=None):
+    """
+    Yield archived entries of `stream` ({"id", "ts", "data"}), oldest
+    first. `since`/`until` are datetimes (naive ones are taken as UTC);
+    `filename` keeps only entries for that file.
+    """
+    def to_ms(dt):
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=datetime.timezone.utc)
+        return int(dt.timestamp() * 1000)
+
+    low = to_ms(since) if since else None
+    high = to_ms(until) if until else None
+    for day, _part, path in archive_files(stream, root):
+        if since and day < since.strftime("%Y-%m-%d"):
+            continue
+        if until and day > until.strftime("%Y-%m-%d"):
+            continue
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                rec = json.loads(line)
+                if low is not None and rec["ts"] < low:
+                    continue
+                if high is not None and rec["ts"] > high:
+                    continue
+                if filename and filename not in (rec["data"].get("file"), rec["data"].get("filename")):
+                    continue
+                yield rec
+
+# ---- trimming ----
+def enforce_stream(stream, now=None, limit=None, approximate=True, dry_run=False, root=None):
+    """
+    Archive and trim one stream. Returns (entries archived, MINID trimmed
+    to or None). Reads from the head of the stream up to the first entry
+    the policy or a consumer group keeps, at most `limit` entries.
+    """
+    limit = limit or STREAM_RETENTION_BATCH
+    safe = group_floor(stream)
+    safe = parse_id(safe) if safe else None
+    age_floor = None
+    if STREAM_RETENTION_SECONDS:
+        age_floor = (int(((now or time.time()) - STREAM_RETENTION_SECONDS) * 1000), 0)
+    excess = redis_client.xlen(stream) - STREAM_MAXLEN if STREAM_MAXLEN else 0
+    archived_upto = redis_client.get(f"{ARCHIVED_PREFIX}{stream}")
+    archived_upto = parse_id(archived_upto) if archived_upto else None
+
+    minid = last = None
+    seen = archived = 0
+    start = "-"
+    with ArchiveWriter(stream, root) as out:
+        while minid is None and seen < limit:
+            entries = redis_client.xrange(stream, start, "+", count=min(1000, limit - seen))
+            if not entries:
+                break
+            for msg_id, data in entries:
+                key = parse_id(msg_id)
+                expired = seen < excess or (age_floor is not None and key < age_floor)
+                if not expired or (safe is not None and key >= safe):
+                    minid = msg_id
+                    break
+                if archived_upto is None or key > archived_upto:
+                    if not dry_run:
+                        out.write(msg_id, data)
+                    archived += 1
+                last = msg_id
+                seen += 1
+            start = f"({entries[-1][0]}"
+    if last is None:
+        return 0, None
+    minid = minid or next_id(last)
+    if not dry_run:
+        redis_client.set(f"{ARCHIVED_PREFIX}{stream}", last)
+        redis_client.xtrim(stream, minid=minid, approximate=approximate)
+    return archived, minid
+
+def enforce_retention(streams=None, dry_run=False, **kwargs):
+    """
+    One retention pass over `streams` (default RETAINED_STREAMS) under the
+    cluster-wide lock. Returns {stream: entries archived}, or None when
+    another replica holds the lock.
+    """
+    lock = redis_client.lock(RETENTION_LOCK, timeout=max(60, STREAM_RETENTION_INTERVAL))
+    if not lock.acquire(blocking=False):
+        return None
+    try:
+        result = {}
+        for stream in streams or RETAINED_STREAMS:
+            archived, minid = enforce_stream(stream, dry_run=dry_run, **kwargs)
+            result[stream] = archived
+            if archived:
+                logger.info(f"Retention: archived {archived} entries of {stream}, trimmed below {minid}")
+        return result
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Trim the pipeline streams and query their archive.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    trim = sub.add_parser("trim", help="run one retention pass now")
+    trim.add_argument("--dry-run", action="store_true", help="count what would be archived, change nothing")
+    query = sub.add_parser("query", help="print archived entries as NDJSON")
+    query.add_argument("stream")
+    query.add_argument("--since", type=datetime.datetime.fromisoformat)
+    query.add_argument("--until", type=datetime.datetime.fromisoformat)
+    query.add_argument("--file", help="only entries for this filename")
+    args = parser.parse_args()
+
+    if args.command == "trim":
+        result = enforce_retention(dry_run=args.dry_run)
+        if result is None:
+            print("another retention pass is running")
+        else:
+            for stream, archived in result.items():
+                print(f"{stream}: {archived} entries {'to archive' if args.dry_run else 'archived'}")
+    else:
+        for rec in query_archive(args.stream, args.since, args.until, args.file):
+            print(json.dumps(rec, separators=(",", ":")))
+
+if __name__ == "__main__":
+    main()
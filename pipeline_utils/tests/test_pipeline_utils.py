@@ -0,0 +1,109 @@
+# pipeline_utils/tests/test_pipeline_utils.py
+import os
+from pipeline_utils import pipeline_utils
+
+
+def test_status_index_follows_status_changes(fake_redis):
+    pipeline_utils.set_file_status("a.mp3", "queued")
+    pipeline_utils.set_file_status("b.mp3", "queued")
+    pipeline_utils.set_file_status("a.mp3", "error", error="boom")
+
+    assert pipeline_utils.get_files_by_status("queued") == ["b.mp3"]
+    assert pipeline_utils.get_files_by_status("error") == ["a.mp3"]
+    assert pipeline_utils.count_files_by_status("queued") == 1
+    assert pipeline_utils.is_file_status("a.mp3", "error")
+    assert fake_redis.hget("file:a.mp3", "error") == "boom"
+    assert fake_redis.zcard(pipeline_utils.FILES_BY_UPDATE) == 2
+
+    pipeline_utils.clear_file_error("a.mp3")
+    assert pipeline_utils.get_files_by_status("error") == []
+    assert pipeline_utils.get_files_by_status("queued", offset=0, limit=10) == ["b.mp3", "a.mp3"]
+
+
+def test_migrate_status_index_from_existing_hashes(fake_redis, monkeypatch):
+    from pipeline_utils import migrate_status_index as migration
+
+    monkeypatch.setattr(migration, "redis_client", fake_redis)
+    fake_redis.hset("file:old.mp3", mapping={"status": "organized"})
+    fake_redis.hset("file:new.mp3", mapping={"status": "error", "updated_at": "5"})
+    assert migration.migrate_status_index(batch=1) == 2
+    assert pipeline_utils.get_files_by_status("organized") == ["old.mp3"]
+    assert pipeline_utils.count_files_by_status("error") == 1
+
+
+
+def test_page_files_orders_filters_and_counts(fake_redis):
+    for i, status in enumerate(["queued", "error", "queued", "organized", "error"]):
+        pipeline_utils.set_file_status(f"{i}.mp3", status)
+        score = {f"{i}.mp3": 100 + i}
+        fake_redis.zadd(f"{pipeline_utils.STATUS_INDEX_PREFIX}{status}", score)
+        fake_redis.zadd(pipeline_utils.FILES_BY_UPDATE, score)
+
+    assert pipeline_utils.page_files(offset=0, limit=2) == (["4.mp3", "3.mp3"], 5)
+    assert pipeline_utils.page_files(offset=4, limit=2) == (["0.mp3"], 5)
+    assert pipeline_utils.page_files(["queued"], 0, 10, descending=False) == (["0.mp3", "2.mp3"], 2)
+    assert pipeline_utils.page_files(["queued", "error"], 1, 2) == (["2.mp3", "1.mp3"], 4)
+
+    [row] = pipeline_utils.get_file_statuses(["1.mp3"])
+    assert row["status"] == "error" and row["updated_at"] is not None
+
+
+def test_link_or_copy_never_writes_through_a_stale_temp_link(tmp_path, monkeypatch):
+    import uuid
+
+    src = tmp_path / "song.mp3"
+    src.write_bytes(b"original audio")
+    dst = tmp_path / "queue.mp3"
+    token = uuid.UUID(int=1)
+    monkeypatch.setattr(pipeline_utils.uuid, "uuid4", lambda: token)
+    # a crash left the temp name behind as a hardlink to src
+    stale = tmp_path / f"queue.mp3.tmp-{token.hex}"
+    os.link(src, stale)
+
+    mode = pipeline_utils.link_or_copy(str(src), str(dst), ("hardlink", "reflink", "copy"))
+    assert mode in ("reflink", "copy")
+    assert src.read_bytes() == b"original audio"
+    assert dst.read_bytes() == b"original audio"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["queue.mp3", "song.mp3"]
+
+def test_notification_dispatcher_coalesces_bursts():
+    sent = []
+    dispatcher = pipeline_utils.NotificationDispatcher(
+        maxsize=100, window=3600, burst=2, deliver=lambda s, m: sent.append((s, m)),
+    )
+    for i in range(5):
+        dispatcher.submit("Pipeline Error [splitter]", f"splitter FAILED: {i}.mp3")
+    dispatcher.submit("File Retry", "reset x.mp3")
+    dispatcher.close()
+
+    subjects = [s for s, _ in sent]
+    assert subjects.count("Pipeline Error [splitter]") == 2
+    assert subjects.count("File Retry") == 1
+    [digest] = [m for s, m in sent if s == "Pipeline Error [splitter] (digest)"]
+    assert digest.startswith("3 × Pipeline Error [splitter]")
+    assert "4.mp3" in digest
+
+
+def test_notification_dispatcher_never_blocks_when_full():
+    dispatcher = pipeline_utils.NotificationDispatcher(maxsize=1, deliver=lambda s, m: None)
+    dispatcher._ensure_started = lambda: None  # keep the queue from draining
+    for i in range(3):
+        dispatcher.submit("s", str(i))
+    assert dispatcher.dropped == 2
+
+
+def test_job_envelope_round_trip(fake_redis):
+    job = pipeline_utils.make_job("My Song.mp3", params={"stems": 4}, duration=12.5)
+    assert job["song"] == "My Song"
+    assert job["paths"]["stems"].endswith("My Song")
+    pipeline_utils.publish_job("stream:test", job)
+    [(_, data)] = fake_redis.xrange("stream:test")
+    assert data["file"] == "My Song.mp3"
+    parsed = pipeline_utils.parse_job(data)
+    assert parsed == job
+    assert pipeline_utils.job_param(parsed, "stems") == 4
+    assert pipeline_utils.job_param(parsed, "splitter", "SPLEETER") == "SPLEETER"
+
+    # plain {"file": ...} entries from older publishers still parse
+    legacy = pipeline_utils.parse_job({"file": "old.mp3", "attempt": "2"})
+    assert legacy["file"] == "old.mp3" and legacy["params"] == {}
@@ -0,0 +1,137 @@
+# pipeline_utils/tests/test_stage_runner.py
+import time
+from pipeline_utils import pipeline_utils, stage_runner
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_consumer_names_are_unique_per_worker():
+    assert stage_runner.consumer_name("splitter", 0) != stage_runner.consumer_name("splitter", 1)
+
+
+def test_stage_runner_workers_handle_and_ack(fake_redis):
+    seen = []
+
+    def handler(data):
+        seen.append(data["file"])
+        if data["file"] == "bad.mp3":
+            raise RuntimeError("boom")
+
+    for name in ["a.mp3", "bad.mp3", "c.mp3"]:
+        fake_redis.xadd("stream:test", {"file": name})
+    runner = stage_runner.StageRunner(
+        "test", "stream:test", "test-group", handler, workers=2, batch_size=2, block_ms=10,
+    ).start()
+    try:
+        assert wait_for(lambda: len(seen) == 3)
+        assert wait_for(lambda: fake_redis.xpending("stream:test", "test-group")["pending"] == 0)
+    finally:
+        runner.stop()
+        runner.join()
+    assert sorted(seen) == ["a.mp3", "bad.mp3", "c.mp3"]
+
+
+def test_reclaim_takes_over_dead_consumer_entries(fake_redis, monkeypatch):
+    monkeypatch.setattr(stage_runner, "STAGE_CLAIM_IDLE_MS", 0)
+    monkeypatch.setattr(stage_runner, "STAGE_MAX_DELIVERIES", 2)
+    monkeypatch.setattr(pipeline_utils, "set_file_status", lambda *a, **k: None)
+    monkeypatch.setattr(stage_runner, "set_file_error", lambda *a, **k: None)
+    fake_redis.xgroup_create("stream:test", "g", id="0", mkstream=True)
+    fake_redis.xadd("stream:test", {"file": "a.mp3"})
+    # a live consumer (heartbeat present) and a dead one both hold entries
+    fake_redis.set(stage_runner.heartbeat_key("g", "alive"), 1)
+    fake_redis.xreadgroup("g", "dead", {"stream:test": ">"}, count=1)
+    fake_redis.xadd("stream:test", {"file": "b.mp3"})
+    fake_redis.xreadgroup("g", "alive", {"stream:test": ">"}, count=1)
+    time.sleep(0.002)  # fakeredis' XPENDING IDLE filter is strict: idle must exceed 0 ms
+
+    runner = stage_runner.StageRunner("test", "stream:test", "g", lambda d: None, batch_size=5)
+    ready = runner.reclaim("me")
+    assert [data["file"] for _id, data in ready] == ["a.mp3"]
+
+    # "me" dies too: the next reclaim exceeds STAGE_MAX_DELIVERIES and dead-letters
+    ready = runner.reclaim("me-again")
+    assert ready == []
+    dead = fake_redis.xrange(pipeline_utils.STREAM_DEAD_LETTER)
+    assert len(dead) == 1 and dead[0][1]["file"] == "a.mp3" and dead[0][1]["stage"] == "test"
+    assert fake_redis.xpending("stream:test", "g")["pending"] == 1  # only alive's entry left
+
+
+
+def test_reclaim_leaves_long_running_live_consumer_alone(fake_redis, monkeypatch):
+    monkeypatch.setattr(stage_runner, "STAGE_CLAIM_IDLE_MS", 0)
+    fake_redis.xgroup_create("stream:test", "g", id="0", mkstream=True)
+    fake_redis.xadd("stream:test", {"file": "long.mp3"})
+    fake_redis.set(stage_runner.heartbeat_key("g", "busy"), 1)
+    fake_redis.xreadgroup("g", "busy", {"stream:test": ">"}, count=1)
+    time.sleep(0.002)
+
+    runner = stage_runner.StageRunner("test", "stream:test", "g", lambda d: None, batch_size=5)
+    assert runner.reclaim("me") == []
+    [entry] = fake_redis.xpending_range("stream:test", "g", min="-", max="+", count=10)
+    assert entry["consumer"] == "busy" and entry["times_delivered"] == 1
+
+def test_failed_jobs_are_scheduled_and_released(fake_redis, monkeypatch):
+    monkeypatch.setattr(pipeline_utils, "RETRY_BASE_DELAY", 0)
+    notified = []
+    monkeypatch.setattr(pipeline_utils, "notify_all", lambda *a: notified.append(a))
+    fake_redis.xgroup_create("stream:test", "g", id="0", mkstream=True)
+    runner = stage_runner.StageRunner(
+        "test", "stream:test", "g", lambda data: 1 / 0, max_retries=2,
+    )
+
+    runner.handle("1-0", {"file": "a.mp3"})
+    assert fake_redis.zcard(pipeline_utils.RETRY_SCHEDULE) == 1
+    assert pipeline_utils.is_file_status("a.mp3", "retrying")
+    assert pipeline_utils.release_due_retries() == 1
+    assert fake_redis.zcard(pipeline_utils.RETRY_SCHEDULE) == 0
+    [(msg_id, data)] = fake_redis.xrange("stream:test")
+    assert data == {"file": "a.mp3", "attempt": "1"}
+
+    # second failure exhausts the retries and dead-letters the job
+    runner.handle(msg_id, data)
+    assert fake_redis.zcard(pipeline_utils.RETRY_SCHEDULE) == 0
+    [(_, dead)] = fake_redis.xrange(pipeline_utils.STREAM_DEAD_LETTER)
+    assert dead["source_id"] == msg_id and dead["stage"] == "test"
+    assert pipeline_utils.is_file_status("a.mp3", "error")
+    assert notified
+
+
+def test_batch_handler_acks_batch_and_retries_failures(fake_redis, monkeypatch):
+    monkeypatch.setattr(pipeline_utils, "RETRY_BASE_DELAY", 0)
+    fake_redis.xgroup_create("stream:test", "g", id="0", mkstream=True)
+    batches = []
+
+    def batch_handler(items):
+        batches.append([d["file"] for d in items])
+        return [RuntimeError("bad") if d["file"] == "b.mp3" else None for d in items]
+
+    runner = stage_runner.StageRunner(
+        "test", "stream:test", "g", handler=None, batch_handler=batch_handler,
+    )
+    runner.dispatch([("1-0", {"file": "a.mp3"}), ("2-0", {"file": "b.mp3"})])
+    assert batches == [["a.mp3", "b.mp3"]]
+    assert fake_redis.zcard(pipeline_utils.RETRY_SCHEDULE) == 1
+    assert pipeline_utils.is_file_status("b.mp3", "retrying")
+
+
+def test_permanent_errors_skip_retries(fake_redis, monkeypatch):
+    monkeypatch.setattr(pipeline_utils, "notify_all", lambda *a: None)
+    fake_redis.xgroup_create("stream:test", "g", id="0", mkstream=True)
+
+    def handler(data):
+        raise pipeline_utils.PermanentError("truncated")
+
+    runner = stage_runner.StageRunner("test", "stream:test", "g", handler, max_retries=5)
+    runner.handle("1-0", {"file": "bad.mp3"})
+    assert fake_redis.zcard(pipeline_utils.RETRY_SCHEDULE) == 0
+    [(_, dead)] = fake_redis.xrange(pipeline_utils.STREAM_DEAD_LETTER)
+    assert dead["reason"] == "permanent: truncated"
+    assert pipeline_utils.is_file_status("bad.mp3", "error")
@@ -0,0 +1,32 @@
+# pipeline_utils/tests/test_stream_retention.py
+from pipeline_utils import stream_retention
+
+
+def test_trim_archives_but_keeps_pending_entries(fake_redis, monkeypatch, tmp_path):
+    monkeypatch.setattr(stream_retention, "STREAM_MAXLEN", 2)
+    monkeypatch.setattr(stream_retention, "STREAM_RETENTION_SECONDS", 0)
+    ids = [fake_redis.xadd("stream:test", {"file": f"{i}.mp3"}) for i in range(6)]
+    fake_redis.xgroup_create("stream:test", "g", id="0")
+    fake_redis.xreadgroup("g", "c", {"stream:test": ">"}, count=3)
+    fake_redis.xack("stream:test", "g", ids[0], ids[1])  # ids[2] stays pending
+
+    archived, minid = stream_retention.enforce_stream("stream:test", approximate=False, root=tmp_path)
+    assert (archived, minid) == (2, ids[2])
+    assert [e[0] for e in fake_redis.xrange("stream:test")] == ids[2:]
+
+    # once acked, the count bound applies and nothing is archived twice
+    fake_redis.xack("stream:test", "g", ids[2])
+    fake_redis.xreadgroup("g", "c", {"stream:test": ">"})
+    fake_redis.xack("stream:test", "g", *ids[3:])
+    assert stream_retention.enforce_stream("stream:test", approximate=False, root=tmp_path) == (2, ids[4])
+    assert fake_redis.xlen("stream:test") == 2
+
+    records = list(stream_retention.query_archive("stream:test", root=tmp_path))
+    assert [r["id"] for r in records] == ids[:4]
+    [hit] = stream_retention.query_archive("stream:test", filename="3.mp3", root=tmp_path)
+    assert hit["data"] == {"file": "3.mp3"}
+
+
+def test_retention_pass_is_exclusive(fake_redis, tmp_path):
+    fake_redis.set(stream_retention.RETENTION_LOCK, "other-replica")
+    assert stream_retention.enforce_retention(root=tmp_path) is None
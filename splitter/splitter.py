@@ -2,13 +2,20 @@
 
 import os
 import time
+import wave
+import shutil
 import logging
 import tempfile
+import threading
 import subprocess
 import traceback
+import multiprocessing
+import numpy as np
+from collections import deque, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from flask import Flask, jsonify
 from pydub import AudioSegment
-from pydub.utils import make_chunks
 from pipeline_utils.pipeline_utils import (
     redis_client,
     STREAM_METADATA_DONE,
@@ -16,9 +23,14 @@ from pipeline_utils.pipeline_utils import (
     set_file_status,
     set_file_error,
     notify_all,
-    clean_string,
-    handle_auto_retry,
+    audio_content_hash,
+    link_or_copy,
+    make_job,
+    parse_job,
+    publish_job,
+    job_param,
 )
+from pipeline_utils.stage_runner import StageRunner
 
 # ————— Logging setup —————
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -41,26 +53,23 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 # ————— Stream / consumer config —————
 GROUP_NAME    = os.environ.get("SPLITTER_GROUP",    "splitter-group")
 CONSUMER_NAME = os.environ.get("SPLITTER_CONSUMER", "splitter-consumer")
-# Ensure the group exists
-try:
-    redis_client.xgroup_create(
-        STREAM_METADATA_DONE, GROUP_NAME, id="0", mkstream=True
-    )
-    logger.info(f"Created consumer group {GROUP_NAME} on {STREAM_METADATA_DONE}")
-except Exception:
-    pass  # group already exists
 
 # ————— Env‐driven splitter settings —————
 QUEUE_DIR           = os.environ.get("QUEUE_DIR", "/queue")
 STEMS_DIR           = os.environ.get("STEMS_DIR", "/stems")
-MAX_RETRIES         = int(os.environ.get("MAX_RETRIES",     3))
-RETRY_DELAY         = int(os.environ.get("RETRY_DELAY",     10))
 CHUNKING_ENABLED    = os.environ.get("CHUNKING_ENABLED", "false").lower() == "true"
 CHUNK_LENGTH_MS     = int(os.environ.get("CHUNK_LENGTH_MS",      240000))
 MIN_CHUNK_LENGTH_MS = int(os.environ.get("MIN_CHUNK_LENGTH_MS", str(CHUNK_LENGTH_MS // 2)))
 CHUNK_MAX_ATTEMPTS  = int(os.environ.get("CHUNK_MAX_ATTEMPTS",  3))
+CHUNK_WORKERS       = int(os.environ.get("CHUNK_WORKERS",       1))
+CHUNK_RETRIES       = int(os.environ.get("CHUNK_RETRIES",       2))
 SPLITTER_TYPE       = os.environ.get("SPLITTER_TYPE",     "SPLEETER").upper()
+STEM_FORMAT         = os.environ.get("STEM_FORMAT", "").lower()  # empty: keep separator output format
+SEPARATION_ENGINE   = os.environ.get("SEPARATION_ENGINE", "inprocess").lower()
 STEMS               = int(os.environ.get("STEMS",                2))
+STEM_CACHE_ENABLED  = os.environ.get("STEM_CACHE_ENABLED", "true").lower() == "true"
+STEM_CACHE_DIR      = os.environ.get("STEM_CACHE_DIR", os.path.join(STEMS_DIR, ".cache"))
+STEM_CACHE_MAX_BYTES = int(os.environ.get("STEM_CACHE_MAX_BYTES", 20 * 1024 ** 3))
 STEM_TYPE           = [
     s.strip().lower()
     for s in os.environ
@@ -72,10 +81,16 @@ STEM_TYPE           = [
 logger.info(
     f"CHUNKING_ENABLED={CHUNKING_ENABLED}, "
     f"CHUNK_LENGTH_MS={CHUNK_LENGTH_MS}, MIN_CHUNK_LENGTH_MS={MIN_CHUNK_LENGTH_MS}, "
-    f"CHUNK_MAX_ATTEMPTS={CHUNK_MAX_ATTEMPTS}"
+    f"CHUNK_MAX_ATTEMPTS={CHUNK_MAX_ATTEMPTS}, CHUNK_WORKERS={CHUNK_WORKERS}, "
+    f"CHUNK_RETRIES={CHUNK_RETRIES}"
+)
+logger.info(
+    f"SPLITTER_TYPE={SPLITTER_TYPE}, STEMS={STEMS}, STEM_TYPE={STEM_TYPE}, "
+    f"SEPARATION_ENGINE={SEPARATION_ENGINE}"
 )
 logger.info(
-    f"SPLITTER_TYPE={SPLITTER_TYPE}, STEMS={STEMS}, STEM_TYPE={STEM_TYPE}"
+    f"STEM_CACHE_ENABLED={STEM_CACHE_ENABLED}, STEM_CACHE_DIR={STEM_CACHE_DIR}, "
+    f"STEM_CACHE_MAX_BYTES={STEM_CACHE_MAX_BYTES}"
 )
 
 # ————— Model definitions —————
@@ -113,6 +128,15 @@ def get_demucs_model_name(stems_num):
     else:
         return "htdemucs"
 
+def get_model_name(splitter_type, stems_num):
+    if splitter_type == "DEMUCS":
+        return get_demucs_model_name(stems_num)
+    return f"spleeter:{stems_num}stems"
+
+def get_keep_stems(splitter_type, stems_num, stem_types=None):
+    supported = get_supported_stems(splitter_type, stems_num)
+    return [s for s in (stem_types or STEM_TYPE) if s in supported] or supported
+
 # ————— Subprocess runners —————
 def run_spleeter(input_path, output_dir, stems_num):
     model = f"spleeter:{stems_num}stems"
@@ -152,140 +176,618 @@ def run_demucs(input_path, output_dir, stems_num):
             return dpath
     raise RuntimeError("Demucs output folder not found.")
 
-def filter_and_export_stems(stems_folder, keep_stems, dest_dir, splitter_type, stems_num):
+# ————— In‑process separation engine —————
+def segment_to_array(seg):
+    """Convert a pydub AudioSegment to a float32 (samples, channels) array in [-1, 1]."""
+    samples = np.array(seg.get_array_of_samples(), dtype=np.float32)
+    samples = samples.reshape(-1, seg.channels)
+    return samples / float(1 << (8 * seg.sample_width - 1))
+
+def write_wav(path, array, sample_rate):
+    """Write a float32 (samples, channels) array as 16‑bit PCM WAV."""
+    pcm = (np.clip(array, -1.0, 1.0) * 32767.0).astype("<i2")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(pcm.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm.tobytes())
+
+class SeparatorEngine:
+    """
+    Long‑lived Spleeter/Demucs model for one (splitter_type, stems) pair.
+    The model is loaded once and every call only pays for inference.
+    Stem names match what the CLI writes, so callers can treat the output
+    folder exactly like the one from run_spleeter/run_demucs.
+    """
+
+    def __init__(self, splitter_type, stems_num):
+        self.splitter_type = splitter_type
+        self.stems_num = stems_num
+        self._lock = threading.Lock()
+        start = time.time()
+        if splitter_type == "SPLEETER":
+            from spleeter.separator import Separator
+            self._model = Separator(f"spleeter:{stems_num}stems", multiprocess=False)
+            self.sample_rate = 44100
+        elif splitter_type == "DEMUCS":
+            from demucs.pretrained import get_model
+            self._model = get_model(get_demucs_model_name(stems_num))
+            self._model.eval()
+            self.sample_rate = self._model.samplerate
+        else:
+            raise ValueError(f"Unknown SPLITTER_TYPE: {splitter_type}")
+        logger.info(
+            f"Loaded {splitter_type} {stems_num}-stem model in-process "
+            f"in {time.time() - start:.1f}s"
+        )
+
+    def separate(self, waveform, sample_rate):
+        """
+        Separate a float32 (samples, channels) array.
+        Returns {stem_name: float32 array} at self.sample_rate.
+        """
+        if sample_rate != self.sample_rate:
+            raise ValueError(f"Expected {self.sample_rate}Hz input, got {sample_rate}Hz")
+        with self._lock:
+            if self.splitter_type == "SPLEETER":
+                return {k: v.astype(np.float32) for k, v in self._model.separate(waveform).items()}
+            return self._separate_demucs(waveform)
+
+    def _separate_demucs(self, waveform):
+        import torch
+        from demucs.apply import apply_model
+        wav = torch.from_numpy(np.ascontiguousarray(waveform.T))
+        ref = wav.mean(0)
+        mean, std = ref.mean(), ref.std() + 1e-8
+        with torch.no_grad():
+            sources = apply_model(
+                self._model, ((wav - mean) / std)[None], device="cpu", progress=False
+            )[0]
+        sources = sources * std + mean
+        out = {
+            name: src.numpy().T.astype(np.float32)
+            for name, src in zip(self._model.sources, sources)
+        }
+        if self.stems_num == 2:
+            vocals = out.pop("vocals")
+            out = {"vocals": vocals, "no_vocals": sum(out.values())}
+        return out
+
+    def separate_file(self, input_path, output_dir):
+        """Decode input_path, separate it and write one WAV per stem; returns the stem folder."""
+        seg = AudioSegment.from_file(input_path).set_frame_rate(self.sample_rate).set_channels(2)
+        stems = self.separate(segment_to_array(seg), self.sample_rate)
+        stem_dir = os.path.join(output_dir, os.path.splitext(os.path.basename(input_path))[0])
+        os.makedirs(stem_dir, exist_ok=True)
+        for name, array in stems.items():
+            write_wav(os.path.join(stem_dir, f"{name}.wav"), array, self.sample_rate)
+        return stem_dir
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+def get_engine(splitter_type, stems_num):
+    """Return the cached SeparatorEngine for this config, loading it on first use."""
+    key = (splitter_type, stems_num)
+    with _ENGINES_LOCK:
+        engine = _ENGINES.get(key)
+        if engine is None:
+            engine = _ENGINES[key] = SeparatorEngine(splitter_type, stems_num)
+        return engine
+
+def run_separator(input_path, output_dir, stems_num, splitter_type=None):
+    """
+    Separate input_path into output_dir using the in‑process engine when
+    available, falling back to the spleeter/demucs CLI otherwise.
+    """
+    splitter_type = splitter_type or SPLITTER_TYPE
+    if SEPARATION_ENGINE == "inprocess":
+        try:
+            engine = get_engine(splitter_type, stems_num)
+        except ImportError as e:
+            logger.warning(f"In-process {splitter_type} engine unavailable ({e}); using CLI")
+        else:
+            return engine.separate_file(input_path, output_dir)
+    if splitter_type == "SPLEETER":
+        return run_spleeter(input_path, output_dir, stems_num)
+    return run_demucs(input_path, output_dir, stems_num)
+
+def _find_stem_file(folder, stem):
+    for ext in ["wav", "mp3", "flac"]:
+        path = os.path.join(folder, f"{stem}.{ext}")
+        if os.path.exists(path):
+            return path
+    return None
+
+def filter_and_export_stems(stems_folder, keep_stems, dest_dir, splitter_type=None, stems_num=None,
+                            move=False, target_format=None):
+    """
+    Put the kept stems into dest_dir as <stem>.<ext>.
+    When no format change is needed the separator output is renamed
+    (move=True) or hardlinked/reflinked instead of being decoded and
+    re‑encoded. Stems that do need converting are encoded in parallel.
+    """
+    splitter_type = splitter_type or SPLITTER_TYPE
+    stems_num = stems_num or STEMS
+    target_format = target_format if target_format is not None else STEM_FORMAT
     os.makedirs(dest_dir, exist_ok=True)
     exported = []
+    conversions = []
     for stem in keep_stems:
         out_stem = map_demucs_stem_name(stem, stems_num) if splitter_type == "DEMUCS" else stem
-        for ext in ["wav", "mp3", "flac"]:
-            src = os.path.join(stems_folder, f"{out_stem}.{ext}")
-            if os.path.exists(src):
-                AudioSegment.from_file(src).export(
-                    os.path.join(dest_dir, f"{stem}.{ext}"), format=ext
-                )
-                exported.append(stem)
-                break
+        src = _find_stem_file(stems_folder, out_stem)
+        if not src:
+            continue
+        ext = os.path.splitext(src)[1][1:]
+        fmt = target_format or ext
+        dst = os.path.join(dest_dir, f"{stem}.{fmt}")
+        if fmt != ext:
+            conversions.append((src, dst, fmt))
+        elif os.path.abspath(src) != os.path.abspath(dst):
+            if move:
+                try:
+                    os.replace(src, dst)
+                except OSError:
+                    link_or_copy(src, dst)
+            else:
+                link_or_copy(src, dst)
+        exported.append(stem)
+
+    if conversions:
+        with ThreadPoolExecutor(max_workers=len(conversions)) as pool:
+            list(pool.map(
+                lambda job: AudioSegment.from_file(job[0]).export(job[1], format=job[2]),
+                conversions,
+            ))
     return exported
 
-# ————— Core split logic with dynamic chunk‐fallback —————
-def process_file(file_path, song_name):
-    for attempt in range(1, MAX_RETRIES + 1):
+# ————— Parallel chunk separation —————
+_CHUNK_POOL = None
+_CHUNK_POOL_LOCK = threading.Lock()
+
+def _init_chunk_worker(splitter_type, stems_num):
+    """Pool initializer: load the model once per worker process."""
+    if SEPARATION_ENGINE == "inprocess":
         try:
-            # single‐pass
-            if not CHUNKING_ENABLED:
-                logger.info("Chunking disabled; full‐track split")
-                out_dir = os.path.join(STEMS_DIR, song_name)
-                os.makedirs(out_dir, exist_ok=True)
-                stem_src = (
-                    run_spleeter(file_path, out_dir, STEMS)
-                    if SPLITTER_TYPE=="SPLEETER"
-                    else run_demucs(file_path, out_dir, STEMS)
-                )
-                supported = get_supported_stems(SPLITTER_TYPE, STEMS)
-                keep = [s for s in STEM_TYPE if s in supported] or supported
-                exported = filter_and_export_stems(
-                    stem_src, keep, out_dir, SPLITTER_TYPE, STEMS
-                )
-                logger.info(f"Exported stems: {exported}")
-                return True
+            get_engine(splitter_type, stems_num)
+        except Exception as e:
+            logger.warning(f"Chunk worker could not preload {splitter_type} engine: {e}")
 
-            # chunk‐mode with fallback
-            logger.info(f"Chunking enabled; start length {CHUNK_LENGTH_MS}ms")
-            audio = AudioSegment.from_file(file_path)
-            chunk_length = CHUNK_LENGTH_MS
+def _separate_chunk(chunk_path, out_dir, stems_num, splitter_type):
+    os.makedirs(out_dir, exist_ok=True)
+    return run_separator(chunk_path, out_dir, stems_num, splitter_type)
 
-            for split_try in range(1, CHUNK_MAX_ATTEMPTS + 1):
-                logger.info(f"Chunk attempt {split_try}/{CHUNK_MAX_ATTEMPTS} at {chunk_length}ms")
-                try:
-                    chunks = make_chunks(audio, chunk_length)
-                    merged = {s: AudioSegment.empty() for s in STEM_TYPE}
-                    with tempfile.TemporaryDirectory() as td:
-                        for idx, chunk in enumerate(chunks):
-                            cp = os.path.join(td, f"chunk_{idx}.mp3")
-                            chunk.export(cp, format="mp3")
-                            od = os.path.join(td, f"out_{idx}")
-                            os.makedirs(od, exist_ok=True)
-                            stem_src = (
-                                run_spleeter(cp, od, STEMS)
-                                if SPLITTER_TYPE=="SPLEETER"
-                                else run_demucs(cp, od, STEMS)
-                            )
-                            supported = get_supported_stems(SPLITTER_TYPE, STEMS)
-                            keep = [s for s in STEM_TYPE if s in supported] or supported
-                            for s in keep:
-                                fname = map_demucs_stem_name(s, STEMS) if SPLITTER_TYPE=="DEMUCS" else s
-                                for ext in ["wav","mp3","flac"]:
-                                    sf = os.path.join(stem_src, f"{fname}.{ext}")
-                                    if os.path.exists(sf):
-                                        seg = AudioSegment.from_file(sf)
-                                        merged[s] += seg
-                                        break
-                        final_dir = os.path.join(STEMS_DIR, song_name)
-                        os.makedirs(final_dir, exist_ok=True)
-                        for s, seg in merged.items():
-                            if len(seg)>0:
-                                seg.export(os.path.join(final_dir, f"{s}.wav"), format="wav")
-                        logger.info(f"Chunked stems exported to {final_dir}")
-                    return True
+def get_chunk_pool(broken=None):
+    """
+    Return the shared chunk worker pool, creating it on first use. Workers
+    stay alive between tracks so each keeps its model loaded. Passing the
+    pool that just raised BrokenProcessPool replaces it with a fresh one.
+    """
+    global _CHUNK_POOL
+    with _CHUNK_POOL_LOCK:
+        if broken is not None and broken is _CHUNK_POOL:
+            logger.warning("Chunk worker pool broke; starting a new one")
+            broken.shutdown(wait=False, cancel_futures=True)
+            _CHUNK_POOL = None
+        if _CHUNK_POOL is None:
+            _CHUNK_POOL = ProcessPoolExecutor(
+                max_workers=CHUNK_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_chunk_worker,
+                initargs=(SPLITTER_TYPE, STEMS),
+            )
+        return _CHUNK_POOL
+
+def iter_separated_chunks(count, prepare_chunk, work_dir, stems_num=None, splitter_type=None):
+    """
+    Separate `count` chunks and yield their stem folders in chunk order.
+
+    prepare_chunk(idx) is called lazily, in index order, right before a
+    chunk is submitted and must return the chunk's input path, so only a
+    bounded window of chunks (twice the worker count) exists on disk at
+    any time. With count=None chunks are taken until prepare_chunk
+    returns None. With
+    CHUNK_WORKERS > 1 chunks fan out across the process pool. A failed
+    chunk is retried up to CHUNK_RETRIES times on its own; chunks that
+    already finished are kept.
+    """
+    stems_num = stems_num or STEMS
+    splitter_type = splitter_type or SPLITTER_TYPE
+    failures = defaultdict(int)
+
+    def _out_dir(idx):
+        return os.path.join(work_dir, f"out_{idx}")
 
+    def _record_failure(idx, err):
+        failures[idx] += 1
+        if failures[idx] > CHUNK_RETRIES:
+            raise RuntimeError(f"Chunk {idx} failed after {failures[idx]} attempts: {err}")
+        logger.warning(f"Chunk {idx} failed ({err}); retry {failures[idx]}/{CHUNK_RETRIES}")
+
+    if CHUNK_WORKERS <= 1:
+        idx = 0
+        while count is None or idx < count:
+            chunk_path = prepare_chunk(idx)
+            if chunk_path is None:
+                return
+            while True:
+                try:
+                    stem_src = _separate_chunk(chunk_path, _out_dir(idx), stems_num, splitter_type)
+                    break
                 except Exception as e:
-                    logger.error(f"Chunk error {split_try}: {e}")
-                    if split_try < CHUNK_MAX_ATTEMPTS:
-                        new_len = max(MIN_CHUNK_LENGTH_MS, chunk_length // 2)
-                        if new_len < chunk_length:
-                            logger.info(f"Reducing chunk length {chunk_length}→{new_len}")
-                            chunk_length = new_len
-                        else:
-                            logger.warning("At minimum chunk size; retrying same size")
-                        continue
-                    raise
+                    _record_failure(idx, e)
+            yield stem_src
+            idx += 1
+        return
 
-        except Exception as e:
-            logger.error(f"Splitter attempt {attempt} failed: {e}\n{traceback.format_exc()}")
-            if attempt < MAX_RETRIES:
-                time.sleep(RETRY_DELAY)
+    chunk_paths = {}
+    results = {}
+    pending = {}
+    isolate = deque()  # chunks caught in a pool crash, re-run one at a time
+    next_submit = next_yield = 0
+    max_in_flight = CHUNK_WORKERS * 2
+
+    def _submit(idx):
+        pool = get_chunk_pool()
+        pending[pool.submit(
+            _separate_chunk, chunk_paths[idx], _out_dir(idx), stems_num, splitter_type
+        )] = (idx, pool)
+
+    try:
+        while count is None or next_yield < count:
+            if isolate:
+                if not pending:
+                    _submit(isolate.popleft())
+            else:
+                while (count is None or next_submit < count) and next_submit - next_yield < max_in_flight:
+                    chunk_path = prepare_chunk(next_submit)
+                    if chunk_path is None:
+                        count = next_submit
+                        break
+                    chunk_paths[next_submit] = chunk_path
+                    _submit(next_submit)
+                    next_submit += 1
+            if next_yield == count:
+                break
+            if next_yield in results:
+                yield results.pop(next_yield)
+                next_yield += 1
                 continue
-            return str(e)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut not in pending:
+                    continue  # already requeued with its broken pool
+                idx, pool = pending.pop(fut)
+                try:
+                    results[idx] = fut.result()
+                except BrokenProcessPool as e:
+                    # A crash fails every chunk on the pool, but only one of
+                    # them caused it: charge a chunk only when it ran alone,
+                    # otherwise re-run the lot one by one to find it.
+                    get_chunk_pool(broken=pool)
+                    victims = [idx] + [i for f, (i, p) in list(pending.items()) if p is pool]
+                    for f in [f for f, (_i, p) in pending.items() if p is pool]:
+                        del pending[f]
+                    if len(victims) == 1:
+                        _record_failure(idx, e)
+                        _submit(idx)
+                    else:
+                        logger.warning(f"Chunk pool crashed with chunks {sorted(victims)} in flight; isolating them")
+                        isolate.extend(sorted(victims))
+                except Exception as e:
+                    _record_failure(idx, e)
+                    _submit(idx)
+    finally:
+        for fut in pending:
+            fut.cancel()
 
-# ————— Stream consumer loop —————
-def run_splitter():
-    logger.info("Splitter service listening on Redis Stream...")
-    while True:
-        entries = redis_client.xreadgroup(
-            GROUP_NAME, CONSUMER_NAME,
-            {STREAM_METADATA_DONE: ">"},
-            count=1, block=5000
-        )
-        if not entries:
-            continue
+# ————— Streaming chunk decode & stem assembly —————
+def decode_window(file_path, start_ms, length_ms, dest_path):
+    """Decode only [start_ms, start_ms+length_ms) of file_path into a 16‑bit PCM WAV."""
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-y",
+         "-ss", f"{start_ms / 1000:.3f}", "-t", f"{length_ms / 1000:.3f}",
+         "-i", file_path, "-vn", "-acodec", "pcm_s16le", dest_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg decode error: {result.stderr.strip()}")
+    return dest_path
+
+class StemWriter:
+    """
+    Appends separated chunks straight into a stem WAV file, so memory use
+    doesn't grow with track length. `expected_ms` only sizes the
+    preallocation; the header and file length come from the frames
+    actually written.
+    """
 
-        for _stream, messages in entries:
-            for msg_id, data in messages:
-                filename = data.get("file")
-                path = os.path.join(QUEUE_DIR, clean_string(filename))
-                song = os.path.splitext(filename)[0]
-
-                def _split():
-                    result = process_file(path, song)
-                    if result is True:
-                        set_file_status(filename, "split")
-                        redis_client.xadd(STREAM_SPLIT_DONE, {"file": filename})
-                        logger.info(f"Split succeeded for {filename}")
-                        return True
-                    raise Exception(result)
+    def __init__(self, path, expected_ms=None):
+        self.path = path
+        self.expected_ms = expected_ms
+        self._file = None
+        self._wav = None
 
+    def append(self, seg):
+        if self._wav is None:
+            self._file = open(self.path, "wb")
+            self._wav = wave.open(self._file, "wb")
+            self._wav.setnchannels(seg.channels)
+            self._wav.setsampwidth(seg.sample_width)
+            self._wav.setframerate(seg.frame_rate)
+            expected_frames = int((self.expected_ms or 0) * seg.frame_rate / 1000)
+            if hasattr(os, "posix_fallocate") and expected_frames:
                 try:
-                    handle_auto_retry(
-                        "splitter", filename, func=_split,
-                        max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY,
-                    )
-                except Exception:
-                    # final failure already notified inside handle_auto_retry
+                    os.posix_fallocate(self._file.fileno(), 0, 44 + expected_frames * seg.frame_width)
+                except OSError:
                     pass
-                finally:
-                    redis_client.xack(
-                        STREAM_METADATA_DONE, GROUP_NAME, msg_id
-                    )
+        else:
+            seg = (seg.set_frame_rate(self._wav.getframerate())
+                      .set_channels(self._wav.getnchannels())
+                      .set_sample_width(self._wav.getsampwidth()))
+        self._wav.writeframesraw(seg.raw_data)
+
+    def close(self):
+        if self._wav is None:
+            return False
+        self._wav.close()  # patches the header with the frame count written
+        self._file.truncate(self._file.tell())
+        self._file.close()
+        self._wav = self._file = None
+        return True
+
+def split_chunked(file_path, song_name, chunk_length, splitter_type=None, stems_num=None,
+                  keep=None, final_dir=None, duration=None):
+    """
+    Split file_path window by window: each chunk is decoded on its own to
+    lossless WAV, separated, appended to the per‑stem output files and
+    deleted, so peak memory and temp disk stay flat for any track length.
+    Windows are decoded until one comes back empty: header-less VBR files
+    report a guessed length, so `duration` (ms) only sizes preallocation.
+    """
+    splitter_type = splitter_type or SPLITTER_TYPE
+    stems_num = stems_num or STEMS
+    keep = keep or get_keep_stems(splitter_type, stems_num)
+    final_dir = final_dir or os.path.join(STEMS_DIR, song_name)
+    os.makedirs(final_dir, exist_ok=True)
+    writers = {s: StemWriter(os.path.join(final_dir, f"{s}.wav.part"), duration) for s in keep}
+    logger.info(f"Streaming chunks of {chunk_length}ms from {file_path}")
+
+    with tempfile.TemporaryDirectory() as td:
+        def _prepare(idx):
+            chunk_path = decode_window(
+                file_path, idx * chunk_length, chunk_length, os.path.join(td, f"chunk_{idx}.wav")
+            )
+            with wave.open(chunk_path) as w:
+                if w.getnframes():
+                    return chunk_path
+            os.remove(chunk_path)  # past the last audio frame
+            if idx == 0:
+                raise RuntimeError(f"no audio decoded from {file_path}")
+            return None
+
+        try:
+            chunks = iter_separated_chunks(None, _prepare, td, stems_num, splitter_type)
+            for idx, stem_src in enumerate(chunks):
+                for s in keep:
+                    fname = map_demucs_stem_name(s, stems_num) if splitter_type=="DEMUCS" else s
+                    sf = _find_stem_file(stem_src, fname)
+                    if sf:
+                        writers[s].append(AudioSegment.from_file(sf))
+                os.remove(os.path.join(td, f"chunk_{idx}.wav"))
+                shutil.rmtree(os.path.join(td, f"out_{idx}"), ignore_errors=True)
+        except Exception:
+            for w in writers.values():
+                w.close()
+                if os.path.exists(w.path):
+                    os.remove(w.path)
+            raise
+
+    for s, w in writers.items():
+        if w.close():
+            os.replace(w.path, os.path.join(final_dir, f"{s}.wav"))
+    logger.info(f"Chunked stems exported to {final_dir}")
+
+# ————— Core split logic with dynamic chunk‐fallback —————
+def process_file(file_path, song_name, splitter_type=None, stems_num=None, keep=None,
+                 out_dir=None, duration_ms=None):
+    """One split attempt; failed jobs are retried later by the stage runner."""
+    splitter_type = splitter_type or SPLITTER_TYPE
+    stems_num = stems_num or STEMS
+    keep = keep or get_keep_stems(splitter_type, stems_num)
+    out_dir = out_dir or os.path.join(STEMS_DIR, song_name)
+    try:
+        # single‐pass
+        if not CHUNKING_ENABLED:
+            logger.info("Chunking disabled; full‐track split")
+            os.makedirs(out_dir, exist_ok=True)
+            stem_src = run_separator(file_path, out_dir, stems_num, splitter_type)
+            exported = filter_and_export_stems(
+                stem_src, keep, out_dir, splitter_type, stems_num, move=True
+            )
+            logger.info(f"Exported stems: {exported}")
+            return True
+
+        # chunk‐mode with fallback
+        logger.info(f"Chunking enabled; start length {CHUNK_LENGTH_MS}ms")
+        chunk_length = CHUNK_LENGTH_MS
+
+        for split_try in range(1, CHUNK_MAX_ATTEMPTS + 1):
+            logger.info(f"Chunk attempt {split_try}/{CHUNK_MAX_ATTEMPTS} at {chunk_length}ms")
+            try:
+                split_chunked(file_path, song_name, chunk_length, splitter_type, stems_num,
+                              keep, out_dir, duration_ms)
+                return True
+
+            except Exception as e:
+                logger.error(f"Chunk error {split_try}: {e}")
+                if split_try < CHUNK_MAX_ATTEMPTS:
+                    new_len = max(MIN_CHUNK_LENGTH_MS, chunk_length // 2)
+                    if new_len < chunk_length:
+                        logger.info(f"Reducing chunk length {chunk_length}→{new_len}")
+                        chunk_length = new_len
+                    else:
+                        logger.warning("At minimum chunk size; retrying same size")
+                    continue
+                raise
+
+    except Exception as e:
+        logger.error(f"Split failed: {e}\n{traceback.format_exc()}")
+        return str(e)
+
+# ————— Content‑addressed stem cache —————
+STEM_CACHE_LRU   = "stem_cache:lru"    # zset: entry key -> last use (epoch seconds)
+STEM_CACHE_SIZES = "stem_cache:sizes"  # hash: entry key -> bytes on disk
+STEM_CACHE_STATS = "stem_cache:stats"  # hash: hits / misses / bytes
+
+def stem_cache_key(file_path, splitter_type=None, stems_num=None, content_hash=None):
+    """Cache key: audio content hash plus the separation config that produced the stems."""
+    splitter_type = splitter_type or SPLITTER_TYPE
+    stems_num = stems_num or STEMS
+    model = get_model_name(splitter_type, stems_num).replace(":", "-")
+    content_hash = content_hash or audio_content_hash(file_path)
+    return f"{content_hash}-{splitter_type.lower()}-{stems_num}-{model}"
+
+def stem_cache_lookup(key, dest_dir, stems):
+    """Link a cached entry's stems into dest_dir. Returns True on a hit."""
+    entry = os.path.join(STEM_CACHE_DIR, key)
+    files = [_find_stem_file(entry, s) for s in stems] if os.path.isdir(entry) else [None]
+    if not all(files):
+        redis_client.hincrby(STEM_CACHE_STATS, "misses", 1)
+        return False
+    os.makedirs(dest_dir, exist_ok=True)
+    for src in files:
+        link_or_copy(src, os.path.join(dest_dir, os.path.basename(src)))
+    pipe = redis_client.pipeline()
+    pipe.zadd(STEM_CACHE_LRU, {key: time.time()})
+    pipe.hincrby(STEM_CACHE_STATS, "hits", 1)
+    pipe.execute()
+    return True
+
+def stem_cache_store(key, src_dir, stems):
+    """
+    Hardlink the finished stems in src_dir into the cache, then enforce the
+    size bound. An existing entry (stored for a different stem selection)
+    gets the stems it lacks merged in, so later lookups for this set hit.
+    """
+    entry = os.path.join(STEM_CACHE_DIR, key)
+    found = {s: _find_stem_file(src_dir, s) for s in stems}
+    found = {s: f for s, f in found.items() if f}
+    if not found:
+        return
+    added = []
+    if not os.path.isdir(entry):
+        os.makedirs(STEM_CACHE_DIR, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=f"{key}.tmp-", dir=STEM_CACHE_DIR)
+        for src in found.values():
+            link_or_copy(src, os.path.join(tmp, os.path.basename(src)))
+        try:
+            os.rename(tmp, entry)
+            added = list(found.values())
+        except OSError:
+            # another worker stored the entry first; merge into theirs below
+            shutil.rmtree(tmp, ignore_errors=True)
+    if not added:
+        for stem, src in found.items():
+            if not _find_stem_file(entry, stem):
+                link_or_copy(src, os.path.join(entry, os.path.basename(src)))
+                added.append(src)
+    if not added:
+        return
+    size = sum(os.path.getsize(f) for f in added)
+    pipe = redis_client.pipeline()
+    pipe.hincrby(STEM_CACHE_SIZES, key, size)
+    pipe.zadd(STEM_CACHE_LRU, {key: time.time()})
+    pipe.hincrby(STEM_CACHE_STATS, "bytes", size)
+    pipe.execute()
+    stem_cache_evict()
+
+def stem_cache_evict():
+    """Drop least‐recently‐used entries until the cache fits STEM_CACHE_MAX_BYTES."""
+    while int(redis_client.hget(STEM_CACHE_STATS, "bytes") or 0) > STEM_CACHE_MAX_BYTES:
+        oldest = redis_client.zrange(STEM_CACHE_LRU, 0, 0)
+        if not oldest:
+            break
+        key = oldest[0]
+        if not redis_client.zrem(STEM_CACHE_LRU, key):
+            continue  # another replica is evicting it
+        shutil.rmtree(os.path.join(STEM_CACHE_DIR, key), ignore_errors=True)
+        size = int(redis_client.hget(STEM_CACHE_SIZES, key) or 0)
+        pipe = redis_client.pipeline()
+        pipe.hdel(STEM_CACHE_SIZES, key)
+        pipe.hincrby(STEM_CACHE_STATS, "bytes", -size)
+        pipe.execute()
+        logger.info(f"Evicted stem cache entry {key} ({size} bytes)")
+
+def get_stem_cache_stats():
+    stats = redis_client.hgetall(STEM_CACHE_STATS)
+    return {
+        "hits": int(stats.get("hits", 0)),
+        "misses": int(stats.get("misses", 0)),
+        "bytes": int(stats.get("bytes", 0)),
+        "entries": redis_client.zcard(STEM_CACHE_LRU),
+        "max_bytes": STEM_CACHE_MAX_BYTES,
+    }
+
+# ————— Stream consumer —————
+def split_file(filename, job=None):
+    """
+    Separate one queued file with the job's params (splitter, stems,
+    stem_types), falling back to this service's env defaults, and publish
+    the enriched job to STREAM_SPLIT_DONE.
+    """
+    job = job or make_job(filename)
+    splitter_type = str(job_param(job, "splitter", SPLITTER_TYPE)).upper()
+    stems_num = int(job_param(job, "stems", STEMS))
+    keep = get_keep_stems(splitter_type, stems_num, job_param(job, "stem_types"))
+    path = job["paths"]["queue"]
+    song_dir = job["paths"]["stems"]
+    duration_ms = int(job["duration"] * 1000) if job.get("duration") else None
+    job["params"].update(splitter=splitter_type, stems=stems_num)
+    job["stems"] = keep
+    cache_key = None
+    if STEM_CACHE_ENABLED:
+        try:
+            job.setdefault("content_hash", audio_content_hash(path))
+            cache_key = stem_cache_key(path, splitter_type, stems_num, job["content_hash"])
+            if stem_cache_lookup(cache_key, song_dir, keep):
+                set_file_status(filename, "split")
+                publish_job(STREAM_SPLIT_DONE, job)
+                logger.info(f"Split served from stem cache for {filename}")
+                return True
+        except Exception as e:
+            logger.warning(f"Stem cache lookup failed for {filename}: {e}")
+    result = process_file(path, job["song"], splitter_type, stems_num, keep, song_dir, duration_ms)
+    if result is True and cache_key:
+        try:
+            stem_cache_store(cache_key, song_dir, keep)
+        except Exception as e:
+            logger.warning(f"Stem cache store failed for {filename}: {e}")
+    if result is True:
+        set_file_status(filename, "split")
+        publish_job(STREAM_SPLIT_DONE, job)
+        logger.info(f"Split succeeded for {filename}")
+        return True
+    raise Exception(result)
+
+def handle_message(data):
+    job = parse_job(data)
+    split_file(job["file"], job)
+
+def preload_engine():
+    # with a chunk pool every separation runs in the pool's workers, which load their own model
+    if SEPARATION_ENGINE == "inprocess" and not (CHUNKING_ENABLED and CHUNK_WORKERS > 1):
+        try:
+            get_engine(SPLITTER_TYPE, STEMS)
+        except Exception as e:
+            logger.warning(f"Could not preload {SPLITTER_TYPE} engine: {e}")
+
+def run_splitter():
+    StageRunner(
+        "splitter", STREAM_METADATA_DONE, GROUP_NAME,
+        handler=handle_message, consumer_prefix=CONSUMER_NAME,
+        initializer=preload_engine,
+    ).run()
 
 # ————— Flask health endpoint —————
 app = Flask(__name__)
@@ -294,6 +796,10 @@ app = Flask(__name__)
 def health():
     return jsonify({"status": "ok"}), 200
 
+@app.route("/cache-stats")
+def cache_stats():
+    return jsonify(get_stem_cache_stats()), 200
+
 if __name__ == "__main__":
     import threading
     t = threading.Thread(target=run_splitter, daemon=True)
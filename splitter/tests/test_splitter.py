@@ -1,4 +1,5 @@
 # splitter/tests/test_splitter.py
+import os
 from splitter.splitter import get_supported_stems, filter_and_export_stems
 
 
@@ -29,12 +30,10 @@ def test_filter_and_export_stems(tmp_path):
 
 
 def test_process_file_handles_error(monkeypatch):
-    # Simulate process_file raising error and max retries hit
+    # Simulate a failed split attempt; retries are scheduled by the stage runner
     from splitter import splitter
 
     monkeypatch.setenv("CHUNKING_ENABLED", "false")
-    monkeypatch.setenv("MAX_RETRIES", "1")
-    monkeypatch.setenv("RETRY_DELAY", "0")
 
     def bad_run(*a, **k):
         raise RuntimeError("fail")
@@ -45,3 +44,245 @@ def test_process_file_handles_error(monkeypatch):
     )
     result = splitter.process_file("/tmp/foo.mp3", "foo")
     assert "fail" in result
+
+
+def test_run_separator_uses_cached_engine(tmp_path, monkeypatch):
+    import numpy as np
+    from splitter import splitter
+
+    loads = []
+
+    class FakeEngine(splitter.SeparatorEngine):
+        def __init__(self, splitter_type, stems_num):
+            loads.append((splitter_type, stems_num))
+            self.sample_rate = 44100
+            self._lock = splitter.threading.Lock()
+
+        def separate_file(self, input_path, output_dir):
+            stems = {"vocals": np.zeros((10, 2), dtype=np.float32)}
+            stem_dir = os.path.join(output_dir, "song")
+            os.makedirs(stem_dir, exist_ok=True)
+            for name, arr in stems.items():
+                splitter.write_wav(os.path.join(stem_dir, f"{name}.wav"), arr, 44100)
+            return stem_dir
+
+    monkeypatch.setattr(splitter, "SEPARATION_ENGINE", "inprocess")
+    monkeypatch.setattr(splitter, "SeparatorEngine", FakeEngine)
+    monkeypatch.setattr(splitter, "_ENGINES", {})
+    for _ in range(3):
+        out = splitter.run_separator("song.mp3", str(tmp_path), 2, "SPLEETER")
+    assert loads == [("SPLEETER", 2)]
+    assert os.path.exists(os.path.join(out, "vocals.wav"))
+
+
+def test_run_separator_falls_back_to_cli(monkeypatch):
+    from splitter import splitter
+
+    def missing(*a, **k):
+        raise ImportError("no spleeter")
+
+    monkeypatch.setattr(splitter, "SEPARATION_ENGINE", "inprocess")
+    monkeypatch.setattr(splitter, "get_engine", missing)
+    monkeypatch.setattr(splitter, "run_spleeter", lambda *a: "cli-out")
+    assert splitter.run_separator("a.mp3", "/tmp", 2, "SPLEETER") == "cli-out"
+
+
+def test_separate_chunks_retries_only_failed_chunk(tmp_path, monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from splitter import splitter
+
+    calls = []
+
+    def flaky(chunk_path, out_dir, stems_num, splitter_type):
+        calls.append(chunk_path)
+        if chunk_path == "c1" and calls.count("c1") == 1:
+            raise RuntimeError("transient")
+        return f"{chunk_path}-stems"
+
+    pool = ThreadPoolExecutor(max_workers=3)
+    monkeypatch.setattr(splitter, "CHUNK_WORKERS", 3)
+    monkeypatch.setattr(splitter, "CHUNK_RETRIES", 1)
+    monkeypatch.setattr(splitter, "get_chunk_pool", lambda broken=None: pool)
+    monkeypatch.setattr(splitter, "_separate_chunk", flaky)
+    chunks = ["c0", "c1", "c2"]
+    result = list(splitter.iter_separated_chunks(3, chunks.__getitem__, str(tmp_path)))
+    assert result == ["c0-stems", "c1-stems", "c2-stems"]
+    assert sorted(calls) == ["c0", "c1", "c1", "c2"]
+
+
+
+def test_pool_crash_requeues_in_flight_chunks_without_charging_them(tmp_path, monkeypatch):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    from splitter import splitter
+
+    class CrashingPool(ThreadPoolExecutor):
+        """Thread pool that fails every in-flight chunk once one chunk 'kills a worker'."""
+        def __init__(self):
+            super().__init__(max_workers=3)
+            self.crashed = threading.Event()
+
+    pools = [CrashingPool()]
+    calls = []
+
+    def get_pool(broken=None):
+        if broken is pools[-1]:
+            pools.append(CrashingPool())
+        return pools[-1]
+
+    def separate(chunk_path, out_dir, stems_num, splitter_type):
+        pool = pools[-1]
+        calls.append(chunk_path)
+        if chunk_path == "c1" and calls.count("c1") == 1:
+            pool.crashed.set()
+            raise BrokenProcessPool("worker died")
+        if pool.crashed.wait(0.3):
+            raise BrokenProcessPool("worker died")
+        return f"{chunk_path}-stems"
+
+    monkeypatch.setattr(splitter, "CHUNK_WORKERS", 3)
+    monkeypatch.setattr(splitter, "CHUNK_RETRIES", 0)  # any charged failure would abort
+    monkeypatch.setattr(splitter, "get_chunk_pool", get_pool)
+    monkeypatch.setattr(splitter, "_separate_chunk", separate)
+    chunks = ["c0", "c1", "c2"]
+    result = list(splitter.iter_separated_chunks(3, chunks.__getitem__, str(tmp_path)))
+    assert result == ["c0-stems", "c1-stems", "c2-stems"]
+    assert len(pools) == 2
+
+def test_split_chunked_streams_stems_in_order(tmp_path, monkeypatch):
+    import wave
+    from concurrent.futures import ThreadPoolExecutor
+    import numpy as np
+    from splitter import splitter
+
+    rate = 1000
+
+    def fake_decode(file_path, start_ms, length_ms, dest_path):
+        # 2500 ms of audio, whatever length the container claims
+        frames = max(0, int(min(length_ms, 2500 - start_ms) * rate / 1000))
+        arr = np.full((frames, 2), start_ms / 10000.0, dtype=np.float32)
+        splitter.write_wav(dest_path, arr, rate)
+        return dest_path
+
+    def fake_separate(chunk_path, out_dir, stems_num, splitter_type):
+        os.makedirs(out_dir, exist_ok=True)
+        splitter.shutil.copy(chunk_path, os.path.join(out_dir, "vocals.wav"))
+        return out_dir
+
+    monkeypatch.setattr(splitter, "STEMS_DIR", str(tmp_path))
+    monkeypatch.setattr(splitter, "STEM_TYPE", ["vocals"])
+    monkeypatch.setattr(splitter, "SPLITTER_TYPE", "SPLEETER")
+    monkeypatch.setattr(splitter, "CHUNK_WORKERS", 1)
+    monkeypatch.setattr(splitter, "decode_window", fake_decode)
+    monkeypatch.setattr(splitter, "_separate_chunk", fake_separate)
+    splitter.split_chunked("song.mp3", "song", 1000, duration=400)  # a low guess
+
+    out = tmp_path / "song" / "vocals.wav"
+    assert out.exists() and not (tmp_path / "song" / "vocals.wav.part").exists()
+    with wave.open(str(out)) as w:
+        assert w.getnframes() == 2500
+        pcm = np.frombuffer(w.readframes(2500), dtype="<i2").reshape(-1, 2)
+    assert pcm[0, 0] == 0 and pcm[1500, 0] > pcm[500, 0] and pcm[2400, 0] > pcm[1500, 0]
+
+    # a high guess on the pool path: windows past the end stop the plan, not fail it
+    pool = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(splitter, "CHUNK_WORKERS", 2)
+    monkeypatch.setattr(splitter, "get_chunk_pool", lambda broken=None: pool)
+    splitter.split_chunked("song.mp3", "song", 1000, duration=9000)
+    with wave.open(str(out)) as w:
+        assert w.getnframes() == 2500
+
+
+def test_stem_cache_hit_miss_and_lru_eviction(fake_redis, tmp_path, monkeypatch):
+    from splitter import splitter
+
+    monkeypatch.setattr(splitter, "STEM_CACHE_DIR", str(tmp_path / ".cache"))
+    monkeypatch.setattr(splitter, "STEM_CACHE_MAX_BYTES", 150)
+
+    song_a = tmp_path / "a"
+    song_a.mkdir()
+    (song_a / "vocals.wav").write_bytes(b"x" * 100)
+    song_b = tmp_path / "b"
+    song_b.mkdir()
+    (song_b / "vocals.wav").write_bytes(b"y" * 100)
+
+    assert not splitter.stem_cache_lookup("key-a", str(tmp_path / "copy"), ["vocals"])
+    splitter.stem_cache_store("key-a", str(song_a), ["vocals"])
+    assert splitter.stem_cache_lookup("key-a", str(tmp_path / "copy"), ["vocals"])
+    assert (tmp_path / "copy" / "vocals.wav").read_bytes() == b"x" * 100
+
+    # storing a second entry exceeds the bound and evicts the older one
+    splitter.stem_cache_store("key-b", str(song_b), ["vocals"])
+    assert not (tmp_path / ".cache" / "key-a").exists()
+    assert (tmp_path / ".cache" / "key-b").exists()
+    stats = splitter.get_stem_cache_stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (1, 1, 1, 100)
+
+
+
+def test_stem_cache_store_merges_stems_missing_from_entry(fake_redis, tmp_path, monkeypatch):
+    from splitter import splitter
+
+    monkeypatch.setattr(splitter, "STEM_CACHE_DIR", str(tmp_path / ".cache"))
+    song = tmp_path / "song"
+    song.mkdir()
+    (song / "vocals.wav").write_bytes(b"v" * 10)
+    (song / "drums.wav").write_bytes(b"d" * 20)
+
+    splitter.stem_cache_store("key", str(song), ["vocals"])
+    assert not splitter.stem_cache_lookup("key", str(tmp_path / "out"), ["vocals", "drums"])
+    splitter.stem_cache_store("key", str(song), ["vocals", "drums"])
+    assert splitter.stem_cache_lookup("key", str(tmp_path / "out"), ["vocals", "drums"])
+    assert splitter.get_stem_cache_stats()["bytes"] == 30
+    assert [p.name for p in (tmp_path / ".cache").iterdir()] == ["key"]
+
+def test_stem_cache_key_ignores_id3_tags(tmp_path):
+    from splitter import splitter
+
+    audio = b"\xff\xfb" + b"\x01" * 500
+    plain = tmp_path / "plain.mp3"
+    plain.write_bytes(audio)
+    tagged = tmp_path / "tagged.mp3"
+    tagged.write_bytes(b"ID3\x03\x00\x00\x00\x00\x00\x05" + b"T" * 5 + audio + b"TAG" + b"\0" * 125)
+    assert splitter.stem_cache_key(str(plain)) == splitter.stem_cache_key(str(tagged))
+
+
+def test_filter_and_export_stems_skips_reencode(tmp_path, monkeypatch):
+    from splitter import splitter
+
+    def no_decode(*a, **k):
+        raise AssertionError("same-format export must not decode")
+
+    monkeypatch.setattr(splitter.AudioSegment, "from_file", no_decode)
+    src = tmp_path / "sep"
+    src.mkdir()
+    (src / "vocals.wav").write_bytes(b"RIFF" + b"\1" * 100)
+    (src / "accompaniment.wav").write_bytes(b"RIFF" + b"\2" * 100)
+    dest = tmp_path / "song"
+    exported = splitter.filter_and_export_stems(
+        str(src), ["vocals", "accompaniment"], str(dest), "SPLEETER", 2, move=True, target_format=""
+    )
+    assert exported == ["vocals", "accompaniment"]
+    assert (dest / "vocals.wav").read_bytes() == b"RIFF" + b"\1" * 100
+    assert not (src / "vocals.wav").exists()
+
+
+def test_split_file_uses_job_params(fake_redis, monkeypatch, tmp_path):
+    import json
+    from pipeline_utils import pipeline_utils
+    from splitter import splitter
+
+    monkeypatch.setattr(splitter, "STEM_CACHE_ENABLED", False)
+    calls = []
+    monkeypatch.setattr(splitter, "process_file", lambda *a: calls.append(a) or True)
+
+    job = pipeline_utils.make_job("song.mp3", params={"splitter": "demucs", "stems": 4,
+                                                     "stem_types": ["drums", "bass"]})
+    job["duration"] = 2.5
+    splitter.handle_message({"file": "song.mp3", "job": json.dumps(job)})
+
+    [(path, song, splitter_type, stems_num, keep, out_dir, duration_ms)] = calls
+    assert (splitter_type, stems_num, keep, duration_ms) == ("DEMUCS", 4, ["drums", "bass"], 2500)
+    [(_, data)] = fake_redis.xrange(pipeline_utils.STREAM_SPLIT_DONE)
+    assert pipeline_utils.parse_job(data)["stems"] == ["drums", "bass"]
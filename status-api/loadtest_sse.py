@@ -0,0 +1,100 @@
+# status-api/loadtest_sse.py
+"""
+Find how many concurrent /stream clients a status-api instance holds.
+
+    python status-api/loadtest_sse.py --url http://localhost:5001 --connections 5000
+
+Opens SSE connections in steps and, after every step, times a plain
+GET /status next to them. The ceiling is the last step at which every
+stream was accepted and /status still answered within --timeout. Run
+it against both modes to compare:
+
+    STATUS_API_SERVER=flask python status-api/status_api.py
+    STATUS_API_SERVER=async python status-api/status_api.py
+
+Only the standard library is used, so it runs from any host.
+"""
+
+import time
+import asyncio
+import argparse
+import resource
+from urllib.parse import urlsplit
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+async def request_head(host, port, path, headers=""):
+    """Open a connection, send GET `path` and read the status line and headers."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n{headers}\r\n".encode())
+    await writer.drain()
+    status = await reader.readline()
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    if b" 200 " not in status and b" 206 " not in status:
+        writer.close()
+        raise ConnectionError(status.decode(errors="replace").strip() or "connection closed")
+    return reader, writer
+
+async def open_stream(host, port, timeout, streams):
+    try:
+        _reader, writer = await asyncio.wait_for(
+            request_head(host, port, "/stream", "Accept: text/event-stream\r\n"), timeout,
+        )
+    except (OSError, asyncio.TimeoutError):
+        return False
+    streams.append(writer)
+    return True
+
+async def probe(host, port, timeout):
+    """Seconds for GET /status?limit=1, or None if it failed or timed out."""
+    start = time.perf_counter()
+    try:
+        _reader, writer = await asyncio.wait_for(
+            request_head(host, port, "/status?limit=1", "Connection: close\r\n"), timeout,
+        )
+    except (OSError, asyncio.TimeoutError):
+        return None
+    writer.close()
+    return time.perf_counter() - start
+
+async def run(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    streams = []
+    ceiling = 0
+    print(f"{'streams':>8} {'accepted':>9} {'failed':>7} {'/status (ms)':>13}")
+    while len(streams) < args.connections:
+        step = min(args.step, args.connections - len(streams))
+        results = await asyncio.gather(*(open_stream(host, port, args.timeout, streams) for _ in range(step)))
+        failed = results.count(False)
+        latency = await probe(host, port, args.timeout)
+        shown = "timeout" if latency is None else f"{latency * 1000:.1f}"
+        print(f"{len(streams) + failed:>8} {len(streams):>9} {failed:>7} {shown:>13}")
+        if failed or latency is None:
+            break
+        ceiling = len(streams)
+        await asyncio.sleep(args.pause)
+    print(f"ceiling: {ceiling} concurrent streams with /status answering in under {args.timeout}s")
+    for writer in streams:
+        writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", default="http://localhost:5001")
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--step", type=int, default=250, help="streams opened per step")
+    parser.add_argument("--pause", type=float, default=1.0, help="seconds between steps")
+    parser.add_argument("--timeout", type=float, default=5.0)
+    args = parser.parse_args()
+    limit = raise_fd_limit()
+    if limit < args.connections + 100:
+        print(f"warning: open-file limit is {limit}; the client may run out before the server does")
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
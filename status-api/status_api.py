@@ -1,16 +1,22 @@
 import os
+import sys
 import json
 import time
 import logging
 import requests
 import shutil
+import queue
+import threading
+from collections import deque
 from flask import Flask, jsonify, request, Response, abort, make_response, stream_with_context
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 from pipeline_utils.pipeline_utils import (
     redis_client,
-    get_files_by_status,
+    count_files_by_status,
     get_file_status,
+    get_file_statuses,
+    page_files,
     set_file_status,
     notify_all,
     STREAM_QUEUED,
@@ -30,7 +36,7 @@ logger.info(f"Logging initialized at {LOG_LEVEL}")
 # ————— Flask + CORS —————
 app = Flask(__name__)
 DASHBOARD_ORIGIN = os.environ.get("DASHBOARD_ORIGIN", "https://mydash.vectorhost.net")
-CORS(app, origins=[DASHBOARD_ORIGIN], expose_headers=["Content-Range"])
+CORS(app, origins=[DASHBOARD_ORIGIN], expose_headers=["Content-Range", "Accept-Ranges"])
 
 # ————— Upload —————
 INPUT = os.environ.get("INPUT_DIR", "/input")
@@ -46,41 +52,73 @@ def upload_file():
     return jsonify({'status':'success','filename':fn}), 201
 
 # ————— REST endpoints —————
+STATUS_PAGE_SIZE = int(os.environ.get("STATUS_PAGE_SIZE", 100))
+STATUS_MAX_PAGE  = int(os.environ.get("STATUS_MAX_PAGE", 1000))
+
+def page_bounds(range_header, offset=None, limit=None):
+    """
+    (offset, limit) from a `Range: items=0-49` header, else from the
+    offset/limit query args; defaults to the first STATUS_PAGE_SIZE
+    items. Raises ValueError for a malformed Range.
+    """
+    if range_header.startswith("items="):
+        start, end = (int(x) for x in range_header[len("items="):].split("-", 1))
+        if end < start:
+            raise ValueError(range_header)
+        offset, limit = start, end - start + 1
+    offset = 0 if offset is None else offset
+    limit = STATUS_PAGE_SIZE if limit is None else limit
+    return max(0, offset), max(1, min(limit, STATUS_MAX_PAGE))
+
+def page_headers(range_header, offset, count, total):
+    """
+    (status code, headers) for a page of `count` items out of `total`:
+    416 when a Range header starts past the last item, 206 for any other
+    partial Range, 200 otherwise (query-arg paging never gets 206/416).
+    """
+    explicit = range_header.startswith("items=")
+    if explicit and offset and offset >= total:
+        return 416, {"Content-Range": f"items */{total}", "Accept-Ranges": "items"}
+    content_range = f"items {offset}-{offset + count - 1}/{total}" if count else f"items */{total}"
+    return 206 if explicit and count < total else 200, {"Content-Range": content_range, "Accept-Ranges": "items"}
+
+def range_error(total):
+    return {"error": f"Range not satisfiable: {total} items"}
+
+def requested_page():
+    try:
+        return page_bounds(
+            request.headers.get("Range", ""),
+            request.args.get("offset", type=int),
+            request.args.get("limit", type=int),
+        )
+    except ValueError:
+        abort(416, f"Bad Range header: {request.headers.get('Range')}")
+
+def paged_response(items, offset, total):
+    code, headers = page_headers(request.headers.get("Range", ""), offset, len(items), total)
+    resp = make_response(jsonify(range_error(total) if code == 416 else items), code)
+    resp.headers.update(headers)
+    return resp
+
 @app.route("/status")
 def list_status():
-    all_bases = set()
-    suffixes = {
-        "input": ".mp3","queued": ".ready","metadata_extracted": ".json",
-        "split": "","packaged": ".zip","organized": ".mp3","error": ".error",
-    }
-    for stage, suf in suffixes.items():
-        path = {
-            "input": os.environ.get("INPUT_DIR","/input"),
-            "queued": os.environ.get("QUEUE_DIR","/queue"),
-            "metadata_extracted": os.environ.get("META_DIR","/metadata"),
-            "split": os.environ.get("STEMS_DIR","/stems"),
-            "packaged": os.environ.get("OUTPUT_DIR","/output"),
-            "organized": os.environ.get("ORG_DIR","/organized"),
-            "error": os.environ.get("QUEUE_DIR","/queue"),
-        }[stage]
-        if os.path.exists(path):
-            for f in os.listdir(path):
-                if f.endswith(suf):
-                    all_bases.add(os.path.splitext(f)[0])
-    statuses = [get_file_status(f"{b}.mp3") for b in sorted(all_bases)]
-    total = len(statuses)
-    resp = make_response(jsonify(statuses), 200)
-    resp.headers["Content-Range"] = f"items 0-{total-1}/{total}"
-    return resp
+    """
+    Files by last update from the Redis status index. Query args:
+    status=queued,error (filter), order=desc|asc, offset/limit or a
+    `Range: items=a-b` header. One pipelined HGETALL per page.
+    """
+    statuses = [st for st in request.args.get("status", "").split(",") if st] or None
+    descending = request.args.get("order", "desc").lower() != "asc"
+    offset, limit = requested_page()
+    filenames, total = page_files(statuses, offset, limit, descending)
+    return paged_response(get_file_statuses(filenames), offset, total)
 
 @app.route("/error-files")
 def list_error_files():
-    errs = get_files_by_status("error")
-    details = [get_file_status(f) for f in errs]
-    total = len(details)
-    resp = make_response(jsonify(details), 200)
-    resp.headers["Content-Range"] = f"items 0-{total-1}/{total}"
-    return resp
+    offset, limit = requested_page()
+    errs, total = page_files(["error"], offset, limit)
+    return paged_response(get_file_statuses(errs), offset, total)
 
 @app.route("/status/<filename>")
 def status_single(filename):
@@ -105,33 +143,217 @@ def retry_file():
     notify_all("File Retry","🔄 Reset to queued: "+fn)
     return jsonify({"message":"ok"}),200
 
+HEALTH_STAGES = ["queued","metadata_extracted","split","packaged","organized","duplicate","retrying","error"]
+
 @app.route("/pipeline-health")
 def pipeline_health():
-    stages = ["queued","metadata_extracted","split","packaged","organized","error"]
-    counts = {s: len(get_files_by_status(s)) for s in stages}
+    counts = {s: count_files_by_status(s) for s in HEALTH_STAGES}
     return jsonify(counts)
 
 # ————— SSE stream for real-time updates —————
-@app.route("/stream")
-def stream():
-    streams = [STREAM_QUEUED, STREAM_METADATA_DONE, STREAM_SPLIT_DONE, STREAM_PACKAGED, STREAM_ORGANIZED]
-    last_ids = {s: "0-0" for s in streams}
+SSE_STREAMS      = [STREAM_QUEUED, STREAM_METADATA_DONE, STREAM_SPLIT_DONE, STREAM_PACKAGED, STREAM_ORGANIZED]
+SSE_CLIENT_QUEUE = int(os.environ.get("SSE_CLIENT_QUEUE", 256))
+SSE_REPLAY_SIZE  = int(os.environ.get("SSE_REPLAY_SIZE", 2048))
+SSE_REPLAY_MAX   = int(os.environ.get("SSE_REPLAY_MAX", 1000))
+SSE_KEEPALIVE    = float(os.environ.get("SSE_KEEPALIVE", 15))
+SSE_RETRY_MS     = int(os.environ.get("SSE_RETRY_MS", 3000))
 
-    def event_gen():
+def stream_id(msg_id):
+    ms, _, seq = msg_id.partition("-")
+    return int(ms), int(seq or 0)
+
+def encode_cursor(cursor):
+    """Event id: the last delivered entry id of every SSE stream, in SSE_STREAMS order."""
+    return ",".join(cursor)
+
+def decode_cursor(event_id):
+    """Cursor from a Last-Event-ID header, or None if absent or malformed."""
+    ids = (event_id or "").split(",")
+    if len(ids) != len(SSE_STREAMS):
+        return None
+    try:
+        for msg_id in ids:
+            stream_id(msg_id)
+    except ValueError:
+        return None
+    return ids
+
+def sse_event(stream_name, data, cursor):
+    payload = json.dumps({"stream": stream_name, "file": data.get("file")})
+    return f"id: {encode_cursor(cursor)}\nevent: {stream_name}\ndata: {payload}\n\n"
+
+class Subscriber:
+    """A /stream client's bounded event queue."""
+    queue_class, Full, Empty = queue.Queue, queue.Full, queue.Empty
+
+    def __init__(self, maxsize):
+        self.queue = self.queue_class(maxsize)
+        self.dropped = False
+
+    def offer(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except self.Full:
+            return False
+
+    def close(self):
+        self.dropped = True
+        # Wake the client's generator so it closes the connection now
+        try:
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+        except (self.Empty, self.Full):
+            pass
+
+class StreamBroadcaster:
+    """
+    One XREAD loop per process fanned out to every /stream client.
+
+    Each client gets a bounded queue; a client whose queue fills up is
+    dropped (its connection ends and the browser reconnects with
+    Last-Event-ID) instead of stalling the reader. Every event id is the
+    full per-stream cursor, so a reconnect resumes from the in-memory
+    ring of recent events, or from XRANGE when the ring no longer
+    reaches back far enough.
+    """
+    subscriber_class = Subscriber
+
+    def __init__(self, streams=SSE_STREAMS, client_queue=SSE_CLIENT_QUEUE, replay_size=SSE_REPLAY_SIZE):
+        self.streams = list(streams)
+        self.client_queue = client_queue
+        self.ring = deque(maxlen=replay_size)
+        self.floor = None
+        self.cursor = None
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self._begin(self._tail_ids())
+                self.thread = threading.Thread(target=self._run, name="sse-broadcaster", daemon=True)
+                self.thread.start()
+
+    def _tail_ids(self):
+        pipe = redis_client.pipeline(transaction=False)
+        for stream_name in self.streams:
+            pipe.xrevrange(stream_name, count=1)
+        return [tail[0][0] if tail else "0-0" for tail in pipe.execute()]
+
+    def _begin(self, tail_ids):
+        self.cursor = tail_ids
+        self.floor = list(tail_ids)
+
+    def _run(self):
         while True:
-            streams_dict = {s: last_ids[s] for s in streams}
-            resp = redis_client.xread(
-                streams=streams_dict,
-                block=5000,
-                count=10
-            )
-            if not resp:
+            try:
+                resp = redis_client.xread(
+                    streams=dict(zip(self.streams, self.cursor)), block=5000, count=100,
+                )
+            except Exception as e:
+                logger.warning(f"SSE reader: {e}")
+                time.sleep(1)
                 continue
-            for stream_name, messages in resp:
+            for stream_name, messages in resp or []:
                 for msg_id, data in messages:
-                    last_ids[stream_name] = msg_id
-                    payload = json.dumps({"stream": stream_name, "file": data.get("file")})
-                    yield f"event: {stream_name}\ndata: {payload}\n\n"
+                    self.publish(stream_name, msg_id, data)
+
+    def publish(self, stream_name, msg_id, data):
+        with self.lock:
+            cursor = list(self.cursor)
+            cursor[self.streams.index(stream_name)] = msg_id
+            self.cursor = cursor
+            if len(self.ring) == self.ring.maxlen:
+                self.floor = self.ring[0][2]
+            event = sse_event(stream_name, data, cursor)
+            self.ring.append((stream_name, msg_id, cursor, event))
+            for sub in list(self.subscribers):
+                if not sub.offer(event):
+                    self.subscribers.discard(sub)
+                    sub.close()
+
+    def subscribe(self, last_event_id=None):
+        """
+        Register a client; returns (subscriber, backlog). The backlog holds
+        the events after `last_event_id` that predate the registration;
+        everything later arrives on the subscriber's queue. Without an id
+        the client only sees new events.
+        """
+        self.start()
+        resume = decode_cursor(last_event_id)
+        sub, backlog, upto = self._attach(resume)
+        if upto:
+            pipe = self._queue_replay(redis_client.pipeline(transaction=False), resume, upto)
+            backlog = self._replay(resume, pipe.execute())
+        return sub, backlog
+
+    def _attach(self, resume):
+        """
+        Add a subscriber under the lock. Returns (sub, backlog, upto): the
+        backlog from the ring, or the cursor `upto` which the caller must
+        replay from Redis when the ring does not reach back to `resume`.
+        """
+        sub = self.subscriber_class(self.client_queue)
+        with self.lock:
+            self.subscribers.add(sub)
+            if resume is None:
+                return sub, [], None
+            if all(stream_id(have) >= stream_id(low) for have, low in zip(resume, self.floor)):
+                backlog = [
+                    event for stream_name, msg_id, _cursor, event in self.ring
+                    if stream_id(msg_id) > stream_id(resume[self.streams.index(stream_name)])
+                ]
+                return sub, backlog, None
+            return sub, [], list(self.cursor)
+
+    def _queue_replay(self, pipe, resume, upto):
+        for stream_name, low, high in zip(self.streams, resume, upto):
+            pipe.xrange(stream_name, min=f"({low}", max=high, count=SSE_REPLAY_MAX)
+        return pipe
+
+    def _replay(self, resume, replies):
+        """Events between two cursors from the streams themselves (ring fell short)."""
+        entries = [
+            (stream_id(msg_id), stream_name, msg_id, data)
+            for stream_name, messages in zip(self.streams, replies)
+            for msg_id, data in messages
+        ]
+        entries.sort(key=lambda e: e[0])
+        cursor = list(resume)
+        backlog = []
+        for _key, stream_name, msg_id, data in entries:
+            cursor[self.streams.index(stream_name)] = msg_id
+            backlog.append(sse_event(stream_name, data, list(cursor)))
+        return backlog
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+broadcaster = StreamBroadcaster()
+
+@app.route("/stream")
+def stream():
+    sub, backlog = broadcaster.subscribe(request.headers.get("Last-Event-ID"))
+
+    def event_gen():
+        try:
+            # first chunk flushes the response headers; also the browser's reconnect delay
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            yield from backlog
+            while not sub.dropped:
+                try:
+                    event = sub.queue.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield event
+        finally:
+            broadcaster.unsubscribe(sub)
     return Response(stream_with_context(event_gen()), mimetype="text/event-stream")
 
 # ————— Health —————
@@ -139,5 +361,22 @@ def stream():
 def health():
     return jsonify({"status":"ok"}),200
 
+# ————— Server —————
+# flask: Werkzeug's threaded server (a thread per connection)
+# async: status_api_async on uvicorn (one event loop per worker)
+STATUS_API_SERVER  = os.environ.get("STATUS_API_SERVER", "flask").lower()
+STATUS_API_WORKERS = int(os.environ.get("STATUS_API_WORKERS", 1))
+
 if __name__=="__main__":
-    app.run(host="0.0.0.0",port=int(os.environ.get("STATUS_API_PORT",5001)))
+    port = int(os.environ.get("STATUS_API_PORT",5001))
+    if STATUS_API_SERVER == "async":
+        # exec rather than uvicorn.run(): this script is __main__, so letting
+        # uvicorn import status_api_async here would load status_api a second time
+        os.execv(sys.executable, [
+            sys.executable, "-m", "uvicorn", "status_api_async:app",
+            "--app-dir", os.path.dirname(os.path.abspath(__file__)),
+            "--host", "0.0.0.0", "--port", str(port), "--workers", str(STATUS_API_WORKERS),
+            "--backlog", "4096", "--log-level", LOG_LEVEL.lower(),
+        ])
+    else:
+        app.run(host="0.0.0.0",port=port)
@@ -0,0 +1,231 @@
+# status-api/status_api_async.py
+"""
+Async serving mode for status-api: the endpoints of status_api.py on
+Starlette with redis.asyncio, so a long-lived /stream connection or a
+slow /input upload holds a coroutine rather than an OS thread.
+
+    STATUS_API_SERVER=async python status_api.py
+    uvicorn status_api_async:app --host 0.0.0.0 --port 5001
+
+Request parsing, paging and the SSE broadcaster come from status_api;
+only the I/O differs.
+"""
+
+import os
+import shutil
+import asyncio
+import contextlib
+import redis.asyncio as aioredis
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+from werkzeug.utils import secure_filename
+from pipeline_utils.pipeline_utils import (
+    REDIS_HOST,
+    REDIS_PORT,
+    STATUS_INDEX_PREFIX,
+    clear_file_error,
+    file_status_row,
+    merge_page,
+    notify_all,
+    queue_page,
+)
+from status_api import (
+    logger,
+    INPUT,
+    DASHBOARD_ORIGIN,
+    HEALTH_STAGES,
+    SSE_KEEPALIVE,
+    SSE_RETRY_MS,
+    StreamBroadcaster,
+    Subscriber,
+    decode_cursor,
+    page_bounds,
+    page_headers,
+    range_error,
+)
+
+redis_client = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+
+# ————— Upload —————
+def save_upload(src, dst):
+    with open(dst, "wb") as out:
+        shutil.copyfileobj(src, out, 1024 * 1024)
+
+async def upload_file(request):
+    async with request.form() as form:
+        f = form.get("file")
+        if f is None or isinstance(f, str):
+            raise HTTPException(400, "No file part")
+        if not f.filename:
+            raise HTTPException(400, "No selected file")
+        fn = secure_filename(f.filename)
+        await run_in_threadpool(save_upload, f.file, os.path.join(INPUT, fn))
+    return JSONResponse({"status": "success", "filename": fn}, 201)
+
+# ————— REST endpoints —————
+def query_int(request, name):
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return None
+
+async def paged_response(request, statuses, descending=True):
+    range_header = request.headers.get("range", "")
+    try:
+        offset, limit = page_bounds(range_header, query_int(request, "offset"), query_int(request, "limit"))
+    except ValueError:
+        raise HTTPException(416, f"Bad Range header: {range_header}")
+    pipe = queue_page(redis_client.pipeline(transaction=False), statuses, offset, limit, descending)
+    filenames, total = merge_page(await pipe.execute(), offset, limit, descending)
+    rows = []
+    if filenames:
+        pipe = redis_client.pipeline(transaction=False)
+        for filename in filenames:
+            pipe.hgetall(f"file:{filename}")
+        rows = [file_status_row(f, data) for f, data in zip(filenames, await pipe.execute())]
+    code, headers = page_headers(range_header, offset, len(rows), total)
+    return JSONResponse(range_error(total) if code == 416 else rows, code, headers)
+
+async def list_status(request):
+    statuses = [st for st in request.query_params.get("status", "").split(",") if st] or None
+    descending = request.query_params.get("order", "desc").lower() != "asc"
+    return await paged_response(request, statuses, descending)
+
+async def list_error_files(request):
+    return await paged_response(request, ["error"])
+
+async def status_single(request):
+    filename = request.path_params["filename"]
+    data = await redis_client.hgetall(f"file:{filename}")
+    if not data.get("status"):
+        raise HTTPException(404, f"{filename} not found")
+    return JSONResponse(file_status_row(filename, data))
+
+async def retry_file(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    fn = (data or {}).get("filename")
+    if not fn:
+        return JSONResponse({"error": "No filename provided"}, 400)
+    if not await redis_client.exists(f"file:{fn}"):
+        return JSONResponse({"error": "File not found"}, 404)
+    # rare admin action: reuse the sync helpers (Lua status update, notifiers) off the loop
+    await run_in_threadpool(clear_file_error, fn)
+    await run_in_threadpool(notify_all, "File Retry", "🔄 Reset to queued: " + fn)
+    return JSONResponse({"message": "ok"}, 200)
+
+async def pipeline_health(request):
+    pipe = redis_client.pipeline(transaction=False)
+    for stage in HEALTH_STAGES:
+        pipe.zcard(f"{STATUS_INDEX_PREFIX}{stage}")
+    return JSONResponse(dict(zip(HEALTH_STAGES, await pipe.execute())))
+
+# ————— SSE stream for real-time updates —————
+class AsyncSubscriber(Subscriber):
+    queue_class, Full, Empty = asyncio.Queue, asyncio.QueueFull, asyncio.QueueEmpty
+
+class AsyncStreamBroadcaster(StreamBroadcaster):
+    """StreamBroadcaster driven by one reader task on the event loop."""
+    subscriber_class = AsyncSubscriber
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.task = None
+        self.starting = asyncio.Lock()
+
+    async def start(self):
+        async with self.starting:
+            if self.task is None:
+                pipe = redis_client.pipeline(transaction=False)
+                for stream_name in self.streams:
+                    pipe.xrevrange(stream_name, count=1)
+                self._begin([tail[0][0] if tail else "0-0" for tail in await pipe.execute()])
+                self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                resp = await redis_client.xread(
+                    streams=dict(zip(self.streams, self.cursor)), block=5000, count=100,
+                )
+            except Exception as e:
+                logger.warning(f"SSE reader: {e}")
+                await asyncio.sleep(1)
+                continue
+            for stream_name, messages in resp or []:
+                for msg_id, data in messages:
+                    self.publish(stream_name, msg_id, data)
+
+    async def subscribe(self, last_event_id=None):
+        await self.start()
+        resume = decode_cursor(last_event_id)
+        sub, backlog, upto = self._attach(resume)
+        if upto:
+            pipe = self._queue_replay(redis_client.pipeline(transaction=False), resume, upto)
+            backlog = self._replay(resume, await pipe.execute())
+        return sub, backlog
+
+broadcaster = AsyncStreamBroadcaster()
+
+async def stream(request):
+    sub, backlog = await broadcaster.subscribe(request.headers.get("last-event-id"))
+
+    async def event_gen():
+        try:
+            # first chunk flushes the response headers; also the browser's reconnect delay
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            for event in backlog:
+                yield event
+            while not sub.dropped:
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if event is None:
+                    break
+                yield event
+        finally:
+            broadcaster.unsubscribe(sub)
+    return StreamingResponse(event_gen(), media_type="text/event-stream")
+
+# ————— Health —————
+async def health(request):
+    return JSONResponse({"status": "ok"}, 200)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    yield
+    if broadcaster.task:
+        broadcaster.task.cancel()
+    await redis_client.aclose()
+
+app = Starlette(
+    routes=[
+        Route("/input", upload_file, methods=["POST"]),
+        Route("/status", list_status),
+        Route("/error-files", list_error_files),
+        Route("/status/{filename}", status_single),
+        Route("/retry", retry_file, methods=["POST"]),
+        Route("/pipeline-health", pipeline_health),
+        Route("/stream", stream),
+        Route("/health", health),
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=[DASHBOARD_ORIGIN],
+            allow_methods=["*"],
+            allow_headers=["*"],
+            expose_headers=["Content-Range", "Accept-Ranges"],
+        ),
+    ],
+    lifespan=lifespan,
+)
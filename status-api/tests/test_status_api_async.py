@@ -0,0 +1,94 @@
+# status-api/tests/test_status_api_async.py
+import os
+import sys
+import json
+import asyncio
+import pytest
+
+pytest.importorskip("starlette")
+pytest.importorskip("httpx")
+fakeredis = pytest.importorskip("fakeredis")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import status_api_async  # noqa: E402
+from starlette.testclient import TestClient  # noqa: E402
+from pipeline_utils import pipeline_utils  # noqa: E402
+
+
+@pytest.fixture
+def redis_pair(fake_redis, fake_redis_server, monkeypatch):
+    """The shared sync fake plus an async client on its server (helpers use sync, the app async)."""
+    async_client = fakeredis.aioredis.FakeRedis(server=fake_redis_server, decode_responses=True)
+    monkeypatch.setattr(status_api_async, "redis_client", async_client)
+    return fake_redis
+
+
+@pytest.fixture
+def client(redis_pair, monkeypatch, tmp_path):
+    monkeypatch.setattr(status_api_async, "INPUT", str(tmp_path))
+    monkeypatch.setattr(status_api_async, "notify_all", lambda *a: None)
+    for i in range(5):
+        pipeline_utils.set_file_status(f"song{i}.mp3", "queued")
+    pipeline_utils.set_file_status("bad.mp3", "error", error="boom")
+    return TestClient(status_api_async.app)
+
+
+def test_status_pages(client):
+    resp = client.get("/status", headers={"Range": "items=1-2"})
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == "items 1-2/6"
+    assert len(resp.json()) == 2
+
+    resp = client.get("/status?status=queued&order=asc")
+    assert resp.status_code == 200
+    assert [row["filename"] for row in resp.json()] == [f"song{i}.mp3" for i in range(5)]
+
+    resp = client.get("/status", headers={"Range": "items=6-9"})
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == "items */6"
+    assert client.get("/status", headers={"Range": "items=x"}).status_code == 416
+
+    [row] = client.get("/error-files").json()
+    assert (row["filename"], row["last_error"]) == ("bad.mp3", "boom")
+    assert client.get("/pipeline-health").json()["queued"] == 5
+
+
+def test_single_status_retry_and_upload(client, tmp_path):
+    assert client.get("/status/song0.mp3").json()["status"] == "queued"
+    assert client.get("/status/nope.mp3").status_code == 404
+
+    assert client.post("/retry", json={}).status_code == 400
+    assert client.post("/retry", json={"filename": "nope.mp3"}).status_code == 404
+    assert client.post("/retry", json={"filename": "bad.mp3"}).status_code == 200
+    assert client.get("/status/bad.mp3").json()["status"] == "queued"
+
+    resp = client.post("/input", files={"file": ("../new song.mp3", b"ID3data")})
+    assert resp.status_code == 201
+    assert resp.json()["filename"] == "new_song.mp3"
+    assert (tmp_path / "new_song.mp3").read_bytes() == b"ID3data"
+    assert client.post("/input", data={"x": "1"}).status_code == 400
+
+
+def test_async_broadcaster_streams_and_replays(redis_pair):
+    first = redis_pair.xadd(pipeline_utils.STREAM_QUEUED, {"file": "old.mp3"})
+
+    async def scenario():
+        b = status_api_async.AsyncStreamBroadcaster(client_queue=4)
+        await b.start()
+        try:
+            sub, backlog = await b.subscribe()
+            assert backlog == []
+            redis_pair.xadd(pipeline_utils.STREAM_QUEUED, {"file": "new.mp3"})
+            event = await asyncio.wait_for(sub.queue.get(), 5)
+            payload = json.loads(event.rsplit("data: ", 1)[1])
+            assert payload == {"stream": pipeline_utils.STREAM_QUEUED, "file": "new.mp3"}
+
+            # a cursor from before the reader started is below the ring's floor: replayed from XRANGE
+            start = ",".join(["0-0"] * len(b.streams))
+            _sub, backlog = await b.subscribe(start)
+            assert [json.loads(e.rsplit("data: ", 1)[1])["file"] for e in backlog] == ["old.mp3", "new.mp3"]
+            assert backlog[0].startswith(f"id: {first},")
+        finally:
+            b.task.cancel()
+
+    asyncio.run(scenario())
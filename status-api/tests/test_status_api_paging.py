@@ -0,0 +1,41 @@
+# status-api/tests/test_status_api_paging.py
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import status_api  # noqa: E402
+from pipeline_utils import pipeline_utils  # noqa: E402
+
+
+@pytest.fixture
+def client(fake_redis):
+    for i in range(5):
+        pipeline_utils.set_file_status(f"song{i}.mp3", "queued")
+    with status_api.app.test_client() as c:
+        yield c
+
+
+def test_page_headers():
+    def headers(content_range):
+        return {"Content-Range": content_range, "Accept-Ranges": "items"}
+
+    assert status_api.page_headers("", 0, 5, 5) == (200, headers("items 0-4/5"))
+    assert status_api.page_headers("items=0-1", 0, 2, 5)[0] == 206
+    assert status_api.page_headers("items=0-49", 0, 0, 0) == (200, headers("items */0"))
+    assert status_api.page_headers("items=5-9", 5, 0, 5) == (416, headers("items */5"))
+    assert status_api.page_headers("", 5, 0, 5)[0] == 200  # query-arg paging
+
+
+def test_range_pages_and_unsatisfiable_range(client):
+    resp = client.get("/status", headers={"Range": "items=1-2"})
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == "items 1-2/5"
+    assert len(resp.get_json()) == 2
+
+    resp = client.get("/status", headers={"Range": "items=10-19"})
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == "items */5"
+
+    assert client.get("/status", headers={"Range": "items=9-1"}).status_code == 416
+    assert client.get("/status?offset=10").get_json() == []
@@ -0,0 +1,69 @@
+# status-api/tests/test_stream_broadcaster.py
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import status_api  # noqa: E402
+
+
+@pytest.fixture
+def broadcaster(fake_redis):
+    b = status_api.StreamBroadcaster(client_queue=2, replay_size=3)
+    b._begin(b._tail_ids())
+    b.thread = "no reader"  # events are published by the test
+
+    clock = iter(range(1000, 2000))
+
+    def add(stream_name, filename):
+        # distinct ms across streams, so the XRANGE replay order is unambiguous
+        msg_id = fake_redis.xadd(stream_name, {"file": filename}, id=f"{next(clock)}-0")
+        b.publish(stream_name, msg_id, {"file": filename})
+        return b.ring[-1][3]
+    b.add = add
+    return b
+
+
+def event_id(event):
+    return event.split("\n", 1)[0][len("id: "):]
+
+
+def test_resume_inside_the_ring(broadcaster):
+    start = status_api.encode_cursor(broadcaster.cursor)
+    events = [
+        broadcaster.add(status_api.STREAM_QUEUED, "a.mp3"),
+        broadcaster.add(status_api.STREAM_METADATA_DONE, "a.mp3"),
+        broadcaster.add(status_api.STREAM_QUEUED, "b.mp3"),
+        broadcaster.add(status_api.STREAM_SPLIT_DONE, "a.mp3"),
+    ]
+    _sub, backlog = broadcaster.subscribe(event_id(events[1]))
+    assert backlog == events[2:]
+    _sub, backlog = broadcaster.subscribe(event_id(events[0]))  # exactly the ring's floor
+    assert backlog == events[1:]
+    _sub, backlog = broadcaster.subscribe(event_id(events[-1]))
+    assert backlog == []
+    # below the floor: the ring no longer has events[0], so it comes from XRANGE
+    _sub, backlog = broadcaster.subscribe(start)
+    assert backlog == events
+
+
+def test_no_or_malformed_last_event_id_sees_only_new_events(broadcaster):
+    broadcaster.add(status_api.STREAM_QUEUED, "a.mp3")
+    for last_event_id in (None, "garbage"):
+        sub, backlog = broadcaster.subscribe(last_event_id)
+        assert backlog == []
+        event = broadcaster.add(status_api.STREAM_QUEUED, "b.mp3")
+        assert sub.queue.get_nowait() == event
+
+
+def test_slow_subscriber_is_dropped(broadcaster):
+    slow, _ = broadcaster.subscribe()
+    fast, _ = broadcaster.subscribe()
+    for name in ("a.mp3", "b.mp3", "c.mp3"):
+        event = broadcaster.add(status_api.STREAM_QUEUED, name)
+        assert fast.queue.get_nowait() == event
+    assert slow.dropped and slow not in broadcaster.subscribers
+    assert fast in broadcaster.subscribers and not fast.dropped
+    # the dropped client's generator is woken with the end-of-stream marker
+    slow.queue.get_nowait()
+    assert slow.queue.get_nowait() is None
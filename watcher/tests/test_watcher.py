@@ -1,6 +1,9 @@
 # watcher/tests/test_watcher.py
+import time
 from unittest import mock
-from watcher.watcher import MP3Handler, app
+from pipeline_utils import pipeline_utils
+from watcher import watcher
+from watcher.watcher import MP3Handler, StabilityTracker, app
 
 
 def test_healthcheck():
@@ -9,20 +12,54 @@ def test_healthcheck():
         assert resp.status_code == 200
 
 
-def test_mp3_detection_and_queueing(tmp_path):
-    handler = MP3Handler()
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_mp3_detection_and_queueing(tmp_path, monkeypatch):
+    monkeypatch.setattr(watcher, "QUEUE_DIR", str(tmp_path / "queue"))
+    (tmp_path / "queue").mkdir()
+    handler = MP3Handler(StabilityTracker(watcher.queue_file, interval=0.01, checks=2))
     mp3 = tmp_path / "test.mp3"
     mp3.write_bytes(b"ID3" + b"\0" * 1000)
     with mock.patch(
         "watcher.watcher.set_file_status"
     ) as m_set_status, mock.patch(
+        "watcher.watcher.is_file_status", return_value=False
+    ), mock.patch(
+        "watcher.watcher.redis_client"
+    ), mock.patch(
         "watcher.watcher.clean_string", side_effect=lambda x: x
     ):
         event = mock.Mock()
         event.is_directory = False
         event.src_path = str(mp3)
         handler.on_created(event)
-        m_set_status.assert_called_once_with("test.mp3", "queued")
+        assert wait_for(lambda: m_set_status.called)
+        m_set_status.assert_called_once_with(
+            "test.mp3", "queued", extra={"handoff": "hardlink"}, pipe=mock.ANY
+        )
+    assert (tmp_path / "queue" / "test.mp3").exists()
+
+
+def test_close_write_queues_without_waiting(tmp_path):
+    queued = []
+    tracker = StabilityTracker(queued.append, interval=3600, checks=4)
+    handler = MP3Handler(tracker)
+    mp3 = tmp_path / "slow.mp3"
+    mp3.write_bytes(b"ID3")
+    event = mock.Mock(is_directory=False, src_path=str(mp3))
+    with mock.patch("watcher.watcher.is_file_status", return_value=False):
+        handler.on_created(event)
+        assert tracker.pending() == 1
+        handler.on_closed(event)
+    assert wait_for(lambda: queued == [str(mp3)])
+    assert tracker.pending() == 0
 
 
 def test_ignore_non_mp3_files(tmp_path):
@@ -46,7 +83,7 @@ def test_error_file_excluded(tmp_path):
     mp3 = tmp_path / "err.mp3"
     mp3.write_bytes(b"ID3" + b"\0" * 1000)
     with mock.patch(
-        "watcher.watcher.get_files_by_status", return_value=["err.mp3"]
+        "watcher.watcher.is_file_status", return_value=True
     ), mock.patch(
         "watcher.watcher.set_file_status"
     ) as m_set_status, mock.patch(
@@ -57,3 +94,163 @@ def test_error_file_excluded(tmp_path):
         event.src_path = str(mp3)
         handler.on_created(event)
         m_set_status.assert_not_called()
+
+
+def test_handoff_rename_moves_input(tmp_path, monkeypatch):
+    queue = tmp_path / "queue"
+    queue.mkdir()
+    monkeypatch.setattr(watcher, "QUEUE_DIR", str(queue))
+    monkeypatch.setattr(watcher, "HANDOFF_MODE", "rename")
+    src = tmp_path / "song.mp3"
+    src.write_bytes(b"ID3data")
+    assert watcher.hand_off(str(src), "song.mp3") == "rename"
+    assert not src.exists()
+    assert (queue / "song.mp3").read_bytes() == b"ID3data"
+    assert watcher.handoff_modes("auto") == ("hardlink", "reflink", "copy")
+
+
+def test_initial_scan_skips_unchanged_files(fake_redis, tmp_path, monkeypatch):
+    client = fake_redis
+    monkeypatch.setattr(watcher, "INPUT_DIR", str(tmp_path / "input"))
+    monkeypatch.setattr(watcher, "QUEUE_DIR", str(tmp_path / "queue"))
+    nested = tmp_path / "input" / "artist" / "album"
+    nested.mkdir(parents=True)
+    (nested / "a.mp3").write_bytes(b"ID3a")
+    (tmp_path / "input" / "b.mp3").write_bytes(b"ID3b")
+    (tmp_path / "input" / "notes.txt").write_text("x")
+
+    assert watcher.initial_scan_and_queue(batch_size=1) == 2
+    assert client.xlen(pipeline_utils.STREAM_QUEUED) == 2
+    assert sorted(client.hkeys(watcher.INGEST_INDEX)) == ["artist/album/a.mp3", "b.mp3"]
+    assert pipeline_utils.count_files_by_status("queued") == 2
+
+    # restart: nothing changed, nothing requeued; a removed file is pruned
+    (nested / "a.mp3").unlink()
+    assert watcher.initial_scan_and_queue() == 0
+    assert client.xlen(pipeline_utils.STREAM_QUEUED) == 2
+    assert client.hkeys(watcher.INGEST_INDEX) == ["b.mp3"]
+
+
+
+def test_initial_scan_requeues_claimed_files_that_were_never_published(fake_redis, tmp_path, monkeypatch):
+    client = fake_redis
+    monkeypatch.setattr(watcher, "INPUT_DIR", str(tmp_path / "input"))
+    monkeypatch.setattr(watcher, "QUEUE_DIR", str(tmp_path / "queue"))
+    (tmp_path / "input").mkdir()
+    (tmp_path / "queue").mkdir()
+    for name in ("lost.mp3", "done.mp3"):
+        (tmp_path / "input" / name).write_bytes(b"audio-" + name.encode())
+        (tmp_path / "queue" / name).write_bytes(b"audio-" + name.encode())
+    # a crash left both handed off and claimed, but only done.mp3 was published
+    for name in ("lost.mp3", "done.mp3"):
+        fp = pipeline_utils.audio_sample_hash(str(tmp_path / "input" / name))
+        client.set(f"{watcher.INGEST_FP_PREFIX}{fp}", name)
+    pipeline_utils.set_file_status("done.mp3", "queued")
+
+    # a same-audio upload compared against the unpublished owner must not
+    # make it look published
+    (tmp_path / "dup.mp3").write_bytes(b"audio-lost.mp3")
+    assert watcher.claim_ingest(str(tmp_path / "dup.mp3"), "dup.mp3")[0] == "lost.mp3"
+    assert not client.exists("file:lost.mp3")
+
+    assert watcher.initial_scan_and_queue() == 1
+    [(_id, entry)] = client.xrange(pipeline_utils.STREAM_QUEUED)
+    assert entry["file"] == "lost.mp3"
+    assert sorted(client.hkeys(watcher.INGEST_INDEX)) == ["done.mp3", "lost.mp3"]
+
+def id3(title):
+    return b"ID3\x03\x00\x00\x00\x00\x00" + bytes([len(title)]) + title
+
+
+def test_ingest_dedup_by_audio_content(fake_redis, tmp_path, monkeypatch):
+    client = fake_redis
+    monkeypatch.setattr(watcher, "INPUT_DIR", str(tmp_path / "input"))
+    monkeypatch.setattr(watcher, "QUEUE_DIR", str(tmp_path / "queue"))
+    monkeypatch.setattr(watcher, "INGEST_DEDUP_MODE", "link")
+    (tmp_path / "input").mkdir()
+    (tmp_path / "queue").mkdir()
+    org = tmp_path / "organized"
+    org.mkdir()
+    audio = bytes(range(256)) * 2000
+    first = tmp_path / "input" / "first.mp3"
+    first.write_bytes(id3(b"one") + audio)
+    copy = tmp_path / "input" / "copy.mp3"
+    copy.write_bytes(id3(b"another tag") + audio)
+
+    assert watcher.queue_file(str(first)) is True
+    assert watcher.queue_file(str(first)) is False  # same file again: idempotent
+    assert watcher.queue_file(str(copy)) is False
+    assert client.xlen(pipeline_utils.STREAM_QUEUED) == 1
+    assert client.hget("file:copy.mp3", "duplicate_of") == "first.mp3"
+
+    # once the original is organized, the duplicate gets its result under its own name
+    (org / "first_karaoke.MP3").write_bytes(b"karaoke")
+    outputs = [str(org / "first_karaoke.MP3")]
+    assert pipeline_utils.resolve_duplicates("first.mp3", outputs) == ["copy.mp3"]
+    assert (org / "copy_karaoke.MP3").read_bytes() == b"karaoke"
+    assert pipeline_utils.is_file_status("copy.mp3", "organized")
+    assert pipeline_utils.resolve_duplicates("first.mp3", outputs) == []
+
+
+def test_failed_publish_releases_content_claim(fake_redis, tmp_path, monkeypatch):
+    client = fake_redis
+    monkeypatch.setattr(watcher, "QUEUE_DIR", str(tmp_path / "queue"))
+    monkeypatch.setattr(watcher, "notify_all", lambda *a: None)
+    (tmp_path / "queue").mkdir()
+    song = tmp_path / "song.mp3"
+    song.write_bytes(b"audio" * 100)
+
+    def broken_publish(*a, **k):
+        raise ConnectionError("redis went away")
+
+    monkeypatch.setattr(watcher, "publish_job", broken_publish)
+    assert watcher.queue_file(str(song)) is False
+    assert not client.keys(f"{watcher.INGEST_FP_PREFIX}*")
+
+    # after a retry from the dashboard the same upload goes through
+    monkeypatch.setattr(watcher, "publish_job", pipeline_utils.publish_job)
+    pipeline_utils.clear_file_error("song.mp3")
+    assert watcher.queue_file(str(song)) is True
+    assert client.xlen(pipeline_utils.STREAM_QUEUED) == 1
+
+
+def test_netfs_watcher_reports_new_files_within_budget(tmp_path):
+    root = tmp_path / "input"
+    (root / "a" / "b").mkdir(parents=True)
+    (root / "old.mp3").write_bytes(b"x")
+    index = tmp_path / "netfs.json"
+    seen = []
+    poller = watcher.NetFSWatcher(str(root), seen.append, budget=1, index_path=str(index))
+
+    # baseline: one directory listing per pass, pre-existing files not reported
+    assert [poller.poll_once() for _ in range(3)] == [1, 1, 1]
+    assert poller.quiet == 0
+    assert sorted(poller.dirs) == [str(root), str(root / "a"), str(root / "a" / "b")]
+    assert seen == []
+
+    (root / "a" / "b" / "new.mp3").write_bytes(b"x")
+    (root / "a" / "b" / "notes.txt").write_text("x")
+    for _ in range(6):
+        poller.poll_once()
+    assert seen == [str(root / "a" / "b" / "new.mp3")]
+
+    # a restarted watcher picks up files created while it was down
+    (root / "a" / "later.mp3").write_bytes(b"x")
+    seen.clear()
+    restarted = watcher.NetFSWatcher(str(root), seen.append, budget=10, index_path=str(index))
+    restarted.poll_once()
+    restarted.poll_once()
+    assert seen == [str(root / "a" / "later.mp3")]
+
+    # a directory relisted before the initial walk finishes still reports new files
+    wide = tmp_path / "wide"
+    for name in "abcde":
+        (wide / name).mkdir(parents=True)
+    seen.clear()
+    poller = watcher.NetFSWatcher(str(wide), seen.append, budget=4, index_path="")
+    poller.poll_once()  # root plus three subdirs, all racy
+    first = list(poller.racy)[1]
+    (wide / first / "new.mp3").write_bytes(b"x")
+    poller.poll_once()  # the last two subdirs, then relists root and `first`
+    assert poller.quiet == 0
+    assert seen == [str(wide / first / "new.mp3")]
@@ -1,19 +1,30 @@
 import time
 import os
-import shutil
+import json
+import heapq
 import logging
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent
 from pipeline_utils.pipeline_utils import (
     redis_client,
     STREAM_QUEUED,
     set_file_status,
-    get_files_by_status,
+    is_file_status,
     set_file_error,
     notify_all,
     clean_string,
+    link_or_copy,
+    HANDOFF_MODES,
+    audio_sample_hash,
+    audio_content_hash,
+    register_duplicate,
+    resolve_duplicates,
+    make_job,
+    publish_job,
 )
 import traceback
 import datetime
@@ -39,80 +50,573 @@ logger.info(f"Logging initialized at {LOG_LEVEL} level")
 INPUT_DIR = os.environ.get("INPUT_DIR", "/input")
 QUEUE_DIR = os.environ.get("QUEUE_DIR", "/queue")
 STABILITY_CHECKS = int(os.environ.get("FILE_STABILITY_CHECKS", 4))
+STABILITY_INTERVAL = float(os.environ.get("FILE_STABILITY_INTERVAL", 2))
+QUEUE_WORKERS = int(os.environ.get("WATCHER_QUEUE_WORKERS", 4))
+# auto | rename | hardlink | reflink | copy
+HANDOFF_MODE = os.environ.get("HANDOFF_MODE", "auto").lower()
+SCAN_BATCH_SIZE = int(os.environ.get("SCAN_BATCH_SIZE", 500))
+# skip: park duplicates as "duplicate" | link: give them the original's results | off
+INGEST_DEDUP_MODE = os.environ.get("INGEST_DEDUP_MODE", "skip").lower()
+# native (inotify & co.) | netfs (directory-snapshot polling for NFS/SMB)
+WATCH_MODE = os.environ.get("WATCH_MODE", "native").lower()
+NETFS_INTERVAL = float(os.environ.get("NETFS_INTERVAL", 5))
+NETFS_SCAN_BUDGET = int(os.environ.get("NETFS_SCAN_BUDGET", 500))
+NETFS_INDEX_PATH = os.environ.get("NETFS_INDEX_PATH")
+# {"<profile>": {"splitter": "DEMUCS", "stems": 4, "stem_types": [...], "variants": [...]}}
+# Files under INPUT_DIR/<profile>/ get that profile's job params; others get "default" (if any).
+JOB_PROFILES = json.loads(os.environ.get("JOB_PROFILES", "{}") or "{}")
+
+# hash: path relative to INPUT_DIR -> "<size>:<mtime_ns>" of the version last queued
+INGEST_INDEX = "watcher:ingest_index"
+
+def ingest_signature(st):
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+def ingest_key(path):
+    return os.path.relpath(path, INPUT_DIR)
+
+def job_params(path):
+    """Per-job separation/packaging params from the JOB_PROFILES entry the file falls under."""
+    parts = ingest_key(path).split(os.sep)
+    name = parts[0] if len(parts) > 1 and parts[0] in JOB_PROFILES else "default"
+    if name not in JOB_PROFILES:
+        return {}
+    return {**JOB_PROFILES[name], "profile": name}
+
+def handoff_modes(mode=None):
+    """Modes to try for INPUT_DIR → QUEUE_DIR; plain copy is always the last resort."""
+    mode = mode or HANDOFF_MODE
+    if mode == "auto":
+        return ("hardlink", "reflink", "copy")
+    if mode not in HANDOFF_MODES:
+        raise ValueError(f"HANDOFF_MODE must be auto or one of {HANDOFF_MODES}, got {mode!r}")
+    return (mode, "copy") if mode != "copy" else ("copy",)
+
+def hand_off(src, fname):
+    """Move/link src into QUEUE_DIR as fname; returns the hand-off mode used."""
+    mode = link_or_copy(src, os.path.join(QUEUE_DIR, fname), handoff_modes())
+    if mode == "copy" and HANDOFF_MODE not in ("auto", "copy"):
+        logger.warning(f"HANDOFF_MODE={HANDOFF_MODE} not possible for {fname}; copied instead")
+    return mode
+
+# ————— Ingest deduplication —————
+INGEST_FP_PREFIX      = "ingest:fp:"       # sampled fingerprint -> first filename seen
+INGEST_HASH_PREFIX    = "ingest:hash:"     # full audio hash -> first filename seen
+INGEST_CONTENT_PREFIX = "ingest:content:"  # filename -> its full audio hash
+
+def claim_ingest(path, fname, profile=None):
+    """
+    Claim the content of `path` for `fname`. Returns (owner, claimed keys):
+    owner is None when fname now owns the content, fname itself when it
+    was already claimed by this name, or the name of an earlier file with
+    identical audio. A sampled fingerprint is claimed first; the full hash
+    is computed only when fingerprints collide. Claims are per job
+    profile, since other params produce other results.
+    """
+    scope = f"{profile}:" if profile else ""
+    fp_key = f"{INGEST_FP_PREFIX}{scope}{audio_sample_hash(path)}"
+    if redis_client.set(fp_key, fname, nx=True):
+        return None, [fp_key]
+    owner = redis_client.get(fp_key)
+    if owner == fname:
+        return fname, []
+
+    content = audio_content_hash(path)
+    # not on file:<owner>: creating that hash would read as "published"
+    owner_hash = redis_client.get(f"{INGEST_CONTENT_PREFIX}{owner}")
+    owner_path = os.path.join(QUEUE_DIR, clean_string(owner))
+    if not owner_hash and os.path.exists(owner_path):
+        owner_hash = audio_content_hash(owner_path)
+        redis_client.set(f"{INGEST_CONTENT_PREFIX}{owner}", owner_hash)
+    if owner_hash:
+        redis_client.set(f"{INGEST_HASH_PREFIX}{scope}{owner_hash}", owner, nx=True)
+    hash_key = f"{INGEST_HASH_PREFIX}{scope}{content}"
+    if redis_client.set(hash_key, fname, nx=True):
+        return None, [hash_key]  # fingerprint collision, different audio
+    return redis_client.get(hash_key), []
+
+def release_ingest_claim(keys, fname):
+    for key in keys:
+        if redis_client.get(key) == fname:
+            redis_client.delete(key)
+
+def ingest_file(path, fname, pipe):
+    """
+    Dedupe, hand off and publish one input file. The status write and the
+    publish go out in one transaction right after the hand-off, so a file
+    never sits claimed in QUEUE_DIR without its stream entry; only the
+    ingest index entry is queued on `pipe`. Returns the hand-off mode,
+    "duplicate", or None when the file had already been queued under this
+    name.
+    """
+    signature = ingest_signature(os.stat(path))
+    params = job_params(path)
+    profile = params.get("profile")
+    owner, claimed = (None, []) if INGEST_DEDUP_MODE == "off" else claim_ingest(path, fname, profile)
+    if owner == fname and redis_client.exists(f"file:{fname}"):
+        logger.info(f"{fname} is already queued; not enqueueing again")
+        pipe.hset(INGEST_INDEX, ingest_key(path), signature)
+        return None
+    if owner == fname:
+        owner = None  # claimed, but the publish never happened: queue it again
+    if owner:
+        if INGEST_DEDUP_MODE == "link":
+            register_duplicate(owner, fname)
+            if is_file_status(owner, "organized"):
+                resolve_duplicates(owner)
+        else:
+            set_file_status(fname, "duplicate", extra={"duplicate_of": owner}, pipe=pipe)
+        logger.info(f"{fname} duplicates {owner}; not reprocessing ({INGEST_DEDUP_MODE})")
+        pipe.hset(INGEST_INDEX, ingest_key(path), signature)
+        return "duplicate"
+    try:
+        mode = hand_off(path, fname)
+        extra = {"handoff": mode, "profile": profile} if profile else {"handoff": mode}
+        step = redis_client.pipeline()
+        set_file_status(fname, "queued", extra=extra, pipe=step)
+        # Publish to Redis Stream for the metadata service
+        publish_job(STREAM_QUEUED, make_job(fname, params=params), pipe=step)
+        step.execute()
+    except Exception:
+        # without this the content would read as "already queued" forever
+        release_ingest_claim(claimed, fname)
+        raise
+    pipe.hset(INGEST_INDEX, ingest_key(path), signature)
+    return mode
+
+def queue_file(src_path):
+    """Hand a finished upload off to QUEUE_DIR and publish it to STREAM_QUEUED."""
+    fname = clean_string(os.path.basename(src_path))
+    if is_file_status(fname, "error"):
+        logger.warning(f"File {fname} is in error state, skipping.")
+        return False
+    try:
+        pipe = redis_client.pipeline()
+        mode = ingest_file(src_path, fname, pipe)
+        pipe.execute()
+        if mode is None or mode == "duplicate":
+            return False
+        logger.info(f"Queued {fname} ({mode}) and published to stream {STREAM_QUEUED}")
+        return True
+    except Exception as e:
+        tb = traceback.format_exc()
+        timestamp = datetime.datetime.now().isoformat()
+        error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
+        set_file_error(fname, error_details)
+        notify_all(
+            "Karaoke Pipeline Error",
+            f"Error in watcher for {fname} at {timestamp}:\n{e}",
+        )
+        return False
+
+class StabilityTracker:
+    """
+    Waits for many files at once to finish being written.
+
+    Pending files sit on a timer heap and one thread re-stats whichever is
+    due next; a file is handed to `on_stable` (on a small worker pool) once
+    its size and mtime are unchanged for `checks` consecutive intervals.
+    `mark_closed` short-circuits the wait when the platform reports a
+    close-after-write (inotify IN_CLOSE_WRITE), so polling only matters for
+    files that arrive without one, e.g. moved in from another directory.
+    """
+
+    def __init__(self, on_stable, interval=None, checks=None, workers=None):
+        self.on_stable = on_stable
+        self.interval = interval if interval is not None else STABILITY_INTERVAL
+        self.checks = checks if checks is not None else STABILITY_CHECKS
+        self._pending = {}  # path -> (size, mtime_ns, stable count)
+        self._heap = []     # (due, path)
+        self._cond = threading.Condition()
+        self._pool = ThreadPoolExecutor(max_workers=workers or QUEUE_WORKERS,
+                                        thread_name_prefix="watcher-queue")
+        self._thread = None
+
+    def track(self, path):
+        with self._cond:
+            if path in self._pending:
+                return
+            self._pending[path] = (None, None, 0)
+            heapq.heappush(self._heap, (time.monotonic() + self.interval, path))
+            self._ensure_started()
+            self._cond.notify()
+
+    def mark_closed(self, path):
+        with self._cond:
+            if self._pending.pop(path, None) is None:
+                return
+        logger.debug(f"Close-write for {path}; queueing without polling")
+        self._pool.submit(self.on_stable, path)
+
+    def ready(self, path):
+        """Hand off a file known to be complete."""
+        self.forget(path)
+        self._pool.submit(self.on_stable, path)
+
+    def forget(self, path):
+        with self._cond:
+            self._pending.pop(path, None)
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True, name="stability-tracker")
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                due, path = self._heap[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if path not in self._pending:
+                    continue  # already queued via close-write
+                prev_size, prev_mtime, stable = self._pending[path]
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                with self._cond:
+                    self._pending.pop(path, None)
+                continue
+            stable = stable + 1 if (st.st_size, st.st_mtime_ns) == (prev_size, prev_mtime) else 0
+            with self._cond:
+                if path not in self._pending:
+                    continue
+                if stable >= self.checks:
+                    del self._pending[path]
+                    self._pool.submit(self.on_stable, path)
+                else:
+                    self._pending[path] = (st.st_size, st.st_mtime_ns, stable)
+                    heapq.heappush(self._heap, (time.monotonic() + self.interval, path))
 
 class MP3Handler(FileSystemEventHandler):
-    def on_created(self, event):
-        if event.is_directory or not event.src_path.endswith(".mp3"):
-            return
-        fname = clean_string(os.path.basename(event.src_path))
-        if fname in get_files_by_status("error"):
+    def __init__(self, tracker=None):
+        super().__init__()
+        self.tracker = tracker or StabilityTracker(queue_file)
+
+    def _wanted(self, path):
+        if not path.endswith(".mp3"):
+            return False
+        fname = clean_string(os.path.basename(path))
+        if is_file_status(fname, "error"):
             logger.warning(f"File {fname} is in error state, skipping.")
+            return False
+        return True
+
+    def on_created(self, event):
+        if not event.is_directory and self._wanted(event.src_path):
+            self.tracker.track(event.src_path)
+
+    def on_closed(self, event):
+        # inotify close-after-write: the writer is done with the file
+        if not event.is_directory and event.src_path.endswith(".mp3"):
+            self.tracker.mark_closed(event.src_path)
+
+    def on_moved(self, event):
+        # uploaders that write to a temp name and rename it when complete
+        if event.is_directory:
             return
+        self.tracker.forget(event.src_path)
+        if self._wanted(event.dest_path):
+            self.tracker.ready(event.dest_path)
+
+def iter_input_files(root):
+    """Recursive scandir walk yielding (path, stat) for every MP3 under root."""
+    stack = [root]
+    while stack:
         try:
-            stable_count = 0
-            while True:
-                if not os.path.exists(event.src_path):
-                    return
-                initial_size = os.path.getsize(event.src_path)
-                initial_mtime = os.path.getmtime(event.src_path)
-                time.sleep(2)
-                if not os.path.exists(event.src_path):
-                    return
-                current_size = os.path.getsize(event.src_path)
-                current_mtime = os.path.getmtime(event.src_path)
-                if initial_size == current_size and initial_mtime == current_mtime:
-                    stable_count += 1
-                else:
-                    stable_count = 0
-                if stable_count >= STABILITY_CHECKS:
-                    break
-
-            dest = os.path.join(QUEUE_DIR, fname)
-            shutil.copy2(event.src_path, dest)
-            set_file_status(fname, "queued")
-            # Publish to Redis Stream for the metadata service
-            redis_client.xadd(STREAM_QUEUED, {"file": fname})
-            logger.info(f"Queued {fname} and published to stream {STREAM_QUEUED}")
-
-        except Exception as e:
-            tb = traceback.format_exc()
-            timestamp = datetime.datetime.now().isoformat()
-            error_details = f"{timestamp}\nException: {e}\n\nTraceback:\n{tb}"
-            set_file_error(fname, error_details)
-            notify_all(
-                "Karaoke Pipeline Error",
-                f"Error in watcher for {fname} at {timestamp}:\n{e}",
-            )
-
-def initial_scan_and_queue():
+            entries = os.scandir(stack.pop())
+        except OSError as e:
+            logger.warning(f"Cannot scan directory: {e}")
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.endswith(".mp3") and entry.is_file():
+                        yield entry.path, entry.stat()
+                except OSError as e:
+                    logger.warning(f"Cannot stat {entry.path}: {e}")
+
+def load_ingest_index():
+    return dict(redis_client.hscan_iter(INGEST_INDEX, count=SCAN_BATCH_SIZE))
+
+def initial_scan_and_queue(tracker=None, batch_size=None):
+    """
+    Queue MP3s that appeared or changed while the watcher was down.
+
+    Each file's (size, mtime) is compared against the persisted ingest
+    index, so unchanged files cost one stat of the input and nothing
+    else. Each newly queued file is published as it is handed off; only
+    index updates go out in pipelined batches. Files modified within the
+    stability window are still being written and are left to `tracker`.
+    Index entries for files that no longer exist under INPUT_DIR are
+    pruned.
+    """
     os.makedirs(QUEUE_DIR, exist_ok=True)
-    for fname in os.listdir(INPUT_DIR):
-        if not fname.endswith(".mp3"):
+    batch_size = batch_size or SCAN_BATCH_SIZE
+    index = load_ingest_index()
+    seen = set()
+    settle = STABILITY_INTERVAL * STABILITY_CHECKS
+    pipe = redis_client.pipeline(transaction=False)
+    pending = queued = skipped = 0
+
+    for path, st in iter_input_files(INPUT_DIR):
+        key = ingest_key(path)
+        seen.add(key)
+        signature = ingest_signature(st)
+        if index.get(key) == signature:
+            skipped += 1
+            continue
+        fname = clean_string(os.path.basename(path))
+        if (key not in index and os.path.exists(os.path.join(QUEUE_DIR, fname))
+                and redis_client.exists(f"file:{fname}")):
+            # queued before the index existed (or before a crash flushed the
+            # batch); adopt it without requeueing. A queue file with no status
+            # was never published and falls through to be queued again.
+            pipe.hset(INGEST_INDEX, key, signature)
+            pending += 1
+        elif tracker is not None and time.time() - st.st_mtime < settle:
+            tracker.track(path)
             continue
-        src = os.path.join(INPUT_DIR, fname)
-        dest = os.path.join(QUEUE_DIR, fname)
-        if not os.path.exists(dest):
+        else:
             try:
-                shutil.copy2(src, dest)
-                set_file_status(fname, "queued")
-                redis_client.xadd(STREAM_QUEUED, {"file": fname})
-                logger.info(f"Initial scan queued and streamed {fname}")
+                mode = ingest_file(path, fname, pipe)
             except Exception as e:
                 logger.error(f"Failed to queue {fname} on initial scan: {e}")
+                continue
+            pending += 1
+            if mode and mode != "duplicate":
+                queued += 1
+                logger.info(f"Initial scan queued and streamed {fname} ({mode})")
+        if pending >= batch_size:
+            pipe.execute()
+            pending = 0
+
+    stale = [key for key in index if key not in seen]
+    for i in range(0, len(stale), batch_size):
+        pipe.hdel(INGEST_INDEX, *stale[i:i + batch_size])
+    pipe.execute()
+    logger.info(
+        f"Initial scan: {queued} queued, {skipped} unchanged, "
+        f"{len(stale)} stale index entries pruned"
+    )
+    return queued
+
+class NetFSWatcher:
+    """
+    Change detection for network filesystems, where inotify never fires.
+
+    Keeps a snapshot of every directory under root (its mtime plus the MP3
+    names in it). Creating or removing an entry bumps the parent's mtime,
+    so each pass only stats directories and relists the ones whose mtime
+    moved. At most `budget` directory operations (stat or listing) are
+    spent per interval: changed directories are relisted first and the
+    remaining budget re-stats the rest round-robin, so a huge tree is
+    covered over several passes instead of hammering the metadata server.
+
+    Directories whose mtime is within the filesystem's timestamp
+    granularity of "now" are relisted again on the next pass, since a
+    second change in the same tick would not move the mtime. With
+    `index_path` the snapshot is persisted as JSON, and files created
+    while the watcher was down are reported on the first pass.
+
+    The first listing of a directory found by the initial walk (marked
+    "quiet") only records what is there; every later listing, and the
+    first listing of a directory created afterwards, reports new files.
+    """
+
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, root, on_file, interval=None, budget=None, index_path=None):
+        self.root = root
+        self.on_file = on_file
+        self.interval = interval if interval is not None else NETFS_INTERVAL
+        self.budget = budget or NETFS_SCAN_BUDGET
+        self.index_path = index_path if index_path is not None else NETFS_INDEX_PATH
+        self.dirs = {}         # path -> {"mtime": ns, "files": [names], "subdirs": [names]}
+        self.dirty = deque()   # directories to relist, oldest first
+        self.racy = {}         # ordered set: listed too close to their mtime, relist later
+        self.round_robin = deque()
+        self.quiet = 0         # directories of the initial walk not yet listed
+        self._changed = False
+        self._stop = threading.Event()
+        self.load()
+        if self.root not in self.dirs:
+            self._add_dir(self.root, quiet=True)
+
+    # ---- persistence ----
+    def load(self):
+        if not (self.index_path and os.path.exists(self.index_path)):
+            return
+        try:
+            with open(self.index_path, encoding="utf-8") as f:
+                self.dirs = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable netfs index {self.index_path}: {e}")
+            self.dirs = {}
+            return
+        self.round_robin.extend(self.dirs)
+        self.quiet = sum(1 for e in self.dirs.values() if e.get("quiet"))
+        logger.info(f"Loaded netfs snapshot of {len(self.dirs)} directories")
+
+    def save(self):
+        if not (self.index_path and self._changed):
+            return
+        tmp = f"{self.index_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.dirs, f)
+        os.replace(tmp, self.index_path)
+        self._changed = False
+
+    # ---- scanning ----
+    def _add_dir(self, path, quiet=False):
+        self.dirs[path] = {"mtime": None, "files": [], "subdirs": []}
+        if quiet:
+            self.dirs[path]["quiet"] = True
+            self.quiet += 1
+        self.dirty.append(path)
+        self.round_robin.append(path)
+
+    def _drop_dir(self, path):
+        entry = self.dirs.pop(path, None)
+        if entry:
+            if entry.get("quiet"):
+                self.quiet -= 1
+            for sub in entry["subdirs"]:
+                self._drop_dir(os.path.join(path, sub))
+            self._changed = True
+
+    def _list(self, path):
+        entry = self.dirs.get(path)
+        if entry is None:
+            return
+        try:
+            mtime = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                files, subdirs = set(), set()
+                for e in it:
+                    if e.is_dir(follow_symlinks=False):
+                        subdirs.add(e.name)
+                    elif e.name.endswith(".mp3"):
+                        files.add(e.name)
+        except FileNotFoundError:
+            self._drop_dir(path)
+            return
+        quiet = entry.pop("quiet", False)
+        if quiet:
+            self.quiet -= 1
+            if not self.quiet:
+                logger.info(f"netfs baseline complete: {len(self.dirs)} directories")
+        else:
+            for name in sorted(files - set(entry["files"])):
+                self.on_file(os.path.join(path, name))
+        for name in subdirs - set(entry["subdirs"]):
+            self._add_dir(os.path.join(path, name), quiet=quiet)
+        for name in set(entry["subdirs"]) - subdirs:
+            self._drop_dir(os.path.join(path, name))
+        entry.update(mtime=mtime, files=sorted(files), subdirs=sorted(subdirs))
+        self._changed = True
+        if time.time_ns() - mtime < self.RACY_NS:
+            self.racy[path] = None
+
+    def _check(self, path):
+        entry = self.dirs.get(path)
+        if entry is None:
+            return
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self._drop_dir(path)
+            return
+        if mtime != entry["mtime"]:
+            self.dirty.append(path)
+
+    def poll_once(self):
+        """One budgeted pass. Returns the number of directory operations spent."""
+        spent = 0
+        listed = set()
+        racy, self.racy = self.racy, {}
+        while self.dirty and spent < self.budget:
+            path = self.dirty.popleft()
+            if path in listed:
+                continue
+            listed.add(path)
+            self._list(path)
+            spent += 1
+        # racy relists only get what real changes left over, oldest first
+        carry = {}
+        for path in racy:
+            if path in listed:
+                continue
+            if spent >= self.budget:
+                carry[path] = None
+                continue
+            self._list(path)
+            spent += 1
+        self.racy = {**carry, **self.racy}
+        checks = min(len(self.round_robin), self.budget - spent)
+        for _ in range(checks):
+            path = self.round_robin.popleft()
+            if path not in self.dirs:
+                continue
+            self.round_robin.append(path)
+            self._check(path)
+            spent += 1
+        self.save()
+        return spent
+
+    def run(self):
+        logger.info(
+            f"netfs watch on {self.root}: every {self.interval}s, "
+            f"budget {self.budget} directory ops per pass"
+        )
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error(f"netfs scan failed: {e}")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def stop(self):
+        self._stop.set()
 
 def run_watcher():
-    initial_scan_and_queue()
     event_handler = MP3Handler()
-    observer = Observer()
-    observer.schedule(event_handler, INPUT_DIR, recursive=True)
-    observer.start()
-    logger.info("Watcher started and listening for new MP3 files.")
+    if WATCH_MODE == "netfs":
+        observer = NetFSWatcher(
+            INPUT_DIR, lambda path: event_handler.on_created(FileCreatedEvent(path))
+        )
+        threading.Thread(target=observer.run, daemon=True, name="netfs-watch").start()
+    else:
+        observer = Observer()
+        observer.schedule(event_handler, INPUT_DIR, recursive=True)
+        observer.start()
+    # Events: on_created starts polling a file for stability, on_closed
+    # (close-after-write, inotify only) queues it at once, and on_moved
+    # queues a file renamed into place. The netfs poller only reports
+    # creations, so there every file is polled. Scan after the observer is
+    # up so nothing written meanwhile is missed; ingest_file's content
+    # claim keeps a file caught by both from being queued twice.
+    initial_scan_and_queue(event_handler.tracker)
+    logger.info(f"Watcher started ({WATCH_MODE}) and listening for new MP3 files.")
     try:
         while True:
             time.sleep(1)
     except KeyboardInterrupt:
         observer.stop()
-    observer.join()
+    if WATCH_MODE != "netfs":
+        observer.join()
 
 app = Flask(__name__)
 